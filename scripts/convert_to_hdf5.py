@@ -12,13 +12,15 @@ from seismiqb import SeismicGeometry
 # Help message
 MSG = """Convert SEG-Y cube to HDF5.
 Input SEG-Y file must have correctly filled `INLINE_3D` and `CROSSLINE_3D` headers.
-A lot of various statistics about traces are also inferred and stored in the resulting file,
-so this script takes some time.
+A lot of various statistics about traces are also inferred and stored in the resulting file
+during the same pass through the data; blocks of ilines can be read by multiple processes.
 """
 
 # Argname, description, dtype, default
 ARGS = [
     ('cube-path', 'path to the SEG-Y cube to convert to HDF5', str, None),
+    ('workers', 'number of processes to read the cube with', int, 1),
+    ('block-size', 'number of ilines to read at once', int, 64),
 ]
 
 
@@ -29,6 +31,5 @@ if __name__ == '__main__':
         config['cube-path'],
         headers=SeismicGeometry.HEADERS_POST_FULL,
         index_headers=SeismicGeometry.INDEX_POST,
-        collect_stats=True, spatial=True,
     )
-    geometry.make_hdf5()
+    geometry.make_hdf5(n_workers=config['workers'], block_size=config['block-size'])
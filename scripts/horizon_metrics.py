@@ -30,6 +30,7 @@ ARGS = [
     ('metrics', 'which metrics to compute', str, ['support_corrs', 'local_corrs']),
     ('add-prefix', 'whether to prepend horizon name to the saved file names', str2bool, True),
     ('save-txt', 'whether to save point cloud of metrics to disk', str2bool, False),
+    ('disk-cache', 'size of cache of metrics next to the cube in gigabytes, 0 to disable', float, 10),
 ]
 
 
@@ -54,6 +55,7 @@ if __name__ == '__main__':
 
 
     geometry = SeismicGeometry(config['cube-path'])
+    geometry.set_disk_cache(gigabytes=config['disk-cache'] or None)
     safe_mkdir(config['savedir'])
 
     for horizon_path in config['horizon-path']:
@@ -41,6 +41,7 @@ ARGS = [
     ('save-pdf', 'whether to save pdf with report to disk. Default is True', str2bool, True),
     ('save-zip', 'whether to zip the entire report folder and save next to it. Default is True', str2bool, True),
     ('remove-images', 'whether to remove images from the resulting folder. Default is False', str2bool, False),
+    ('disk-cache', 'size of cache of metrics next to the cube in gigabytes, 0 to disable. Default is 10', float, 10),
 ]
 
 
@@ -74,6 +75,7 @@ if __name__ == '__main__':
 
 
     geometry = SeismicGeometry(config['cube-path'])
+    geometry.set_disk_cache(gigabytes=config['disk-cache'] or None)
     safe_mkdir(config['savedir'])
 
     horizons = [Horizon(path, geometry=geometry) for path in config['horizon-path']]
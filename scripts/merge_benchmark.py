@@ -0,0 +1,109 @@
+""" Benchmark merging of horizon chunks against the pairwise merging on synthetic data. """
+import os
+import sys
+from copy import copy
+from time import perf_counter
+
+import numpy as np
+
+from utils import str2bool, make_config
+
+sys.path.append('..')
+from seismiqb import Horizon # pylint: disable=wrong-import-position
+
+
+
+# Help message
+MSG = """Benchmark `Horizon.merge_list` on synthetic sets of horizons.
+A number of smooth surfaces is cut into small rectangular chunks, which are then shuffled and merged back.
+The same chunks are also merged by checking every pair of horizons, and results of both methods are compared.
+"""
+
+# Argname, description, dtype, default
+ARGS = [
+    ('shape', 'spatial shape of the synthetic cube', [int], [1000, 1000]),
+    ('n-surfaces', 'number of surfaces in the cube', int, 10),
+    ('chunk-size', 'spatial size of chunks of surfaces', int, 50),
+    ('coverage', 'ratio of chunks to keep', float, 0.8),
+    ('seed', 'random seed', int, 42),
+    ('pairwise', 'whether to run pairwise merging for comparison', str2bool, True),
+]
+
+
+class SyntheticGeometry:
+    """ Minimal geometry to create horizons from points. """
+    def __init__(self, shape):
+        self.name = 'synthetic'
+        self.cube_shape = np.array(shape)
+
+
+def make_chunks(shape, n_surfaces, chunk_size, coverage, seed):
+    """ Cut smooth surfaces into shuffled rectangular chunks. """
+    rng = np.random.default_rng(seed)
+    geometry = SyntheticGeometry((*shape, 100 * (n_surfaces + 1)))
+
+    i_grid, x_grid = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing='ij')
+    chunks = []
+    for k in range(n_surfaces):
+        phase = rng.uniform(0, 2 * np.pi, size=2)
+        depths = 100 * (k + 1) + 10 * np.sin(i_grid / 150 + phase[0]) + 10 * np.cos(x_grid / 150 + phase[1])
+        depths = np.rint(depths).astype(np.int32)
+
+        for i_start in range(0, shape[0], chunk_size):
+            for x_start in range(0, shape[1], chunk_size):
+                if rng.uniform() > coverage:
+                    continue
+                slc = slice(i_start, i_start + chunk_size), slice(x_start, x_start + chunk_size)
+                points = np.stack([i_grid[slc].ravel(), x_grid[slc].ravel(), depths[slc].ravel()], axis=1)
+                chunks.append(points)
+
+    order = rng.permutation(len(chunks))
+    return [Horizon(chunks[i], geometry, name=f'chunk_{i}') for i in order]
+
+
+def merge_list_pairwise(horizons, mean_threshold=2.0, adjacency=3, minsize=50):
+    """ Reference merging: try to merge every horizon to every next one, without any index. """
+    horizons = [horizon for horizon in horizons if len(horizon) >= minsize]
+
+    i = 0
+    while i < len(horizons):
+        j = i + 1
+        while j < len(horizons):
+            merge_code, _ = Horizon.verify_merge(horizons[i], horizons[j],
+                                                 mean_threshold=mean_threshold, adjacency=adjacency)
+            if merge_code == 3:
+                merged = Horizon.overlap_merge(horizons[i], horizons[j], inplace=True)
+            elif merge_code == 2:
+                merged = Horizon.adjacent_merge(horizons[i], horizons[j], inplace=True,
+                                                mean_threshold=mean_threshold, adjacency=adjacency)
+            else:
+                merged = False
+
+            if merged:
+                _ = horizons.pop(j)
+            else:
+                j += 1
+        i += 1
+    return horizons
+
+
+if __name__ == '__main__':
+    config = make_config(MSG, ARGS, os.path.basename(__file__).split('.')[0])
+    horizon_chunks = make_chunks(config['shape'], config['n-surfaces'], config['chunk-size'],
+                                 config['coverage'], config['seed'])
+    print(f'Number of chunks: {len(horizon_chunks)}')
+
+    start = perf_counter()
+    merged_indexed = Horizon.merge_list([copy(chunk) for chunk in horizon_chunks])
+    print(f'Indexed merge:  {perf_counter() - start:8.3f} s, {len(merged_indexed)} horizons')
+
+    if config['pairwise']:
+        start = perf_counter()
+        merged_pairwise = merge_list_pairwise([copy(chunk) for chunk in horizon_chunks])
+        print(f'Pairwise merge: {perf_counter() - start:8.3f} s, {len(merged_pairwise)} horizons')
+
+        same = len(merged_indexed) == len(merged_pairwise) and all(
+            (one.i_min, one.x_min) == (other.i_min, other.x_min) and np.array_equal(one.matrix, other.matrix)
+            for one, other in zip(merged_indexed, merged_pairwise)
+        )
+        print(f'Results match:  {same}')
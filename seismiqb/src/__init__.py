@@ -1,6 +1,8 @@
 """Init file. """
 from .cubeset import SeismicCubeset
 from .crop_batch import SeismicCropBatch
+from .stream import CropStream
+from .accumulator import CropAccumulator
 from .geometry import SeismicGeometry
 from .horizon import UnstructuredHorizon, StructuredHorizon, Horizon
 from .facies import GeoBody
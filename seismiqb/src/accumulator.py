@@ -0,0 +1,178 @@
+""" Accumulator of predictions on crops into one array. """
+import os
+
+import numpy as np
+from numba import njit
+
+
+AGGREGATIONS = {'max': 0, 'mean': 1, 'weighted': 2}
+
+
+class CropAccumulator:
+    """ Array of `shape`, that predictions on crops are added to as soon as they are made.
+    Crops are scattered into a preallocated (or memory-mapped) background by a jit-compiled kernel,
+    so that neither the list of all the crops nor any temporary full-size arrays are needed.
+
+    Overlapping crops are blended by one of the `aggregation` methods:
+        - `max` keeps the maximum value at each point;
+        - `mean` averages values at each point;
+        - `weighted` averages values with `weights`, defined for each point of a crop, so that
+          predictions near the crop borders can be trusted less.
+
+    Parameters
+    ----------
+    shape : sequence of 3 ints
+        Shape of the assembled array.
+    aggregation : {'max', 'mean', 'weighted'}
+        Method of blending overlapping crops.
+    weights : np.ndarray, optional
+        Weights of points in a crop for `weighted` aggregation. By default, weights linearly
+        decrease from the center of the crop to its borders.
+    crop_shape : sequence of 3 ints, optional
+        Shape of crops after transposition by `order`. Required only for default `weights`.
+    order : sequence of 3 ints
+        Axes of crops, transposed before adding them to the array.
+    fill_value : float, optional
+        Value for points, not covered by crops. If not provided, minimum value of crops is used.
+    dtype : np.dtype
+        Type of the assembled array.
+    path : str, optional
+        If provided, the array is created as `.npy` memory-mapped file at this path, so that it can be larger
+        than available memory. Weights of points for `mean` aggregations are stored in the `_weights` file next to it.
+
+    Examples
+    --------
+    Assemble predictions along the grid, as they are made:
+
+    >>> dataset.make_grid(cube_name, crop_shape, batch_size=64)
+    >>> accumulator = dataset.make_accumulator(aggregation='mean')
+    >>> for batch in dataset.make_crop_stream(batch_size=64):
+    ...     accumulator.push(model.predict(batch['images']))
+    >>> prediction = accumulator.aggregate()
+    """
+    def __init__(self, shape, aggregation='max', weights=None, crop_shape=None, order=(0, 1, 2), fill_value=None,
+                 dtype=np.float32, path=None):
+        if aggregation not in AGGREGATIONS:
+            raise ValueError(f'Unknown aggregation `{aggregation}`: use one of {list(AGGREGATIONS)}.')
+        self.shape = tuple(shape)
+        self.aggregation = aggregation
+        self.order = tuple(order)
+        self.fill_value = fill_value
+        self.path = path
+
+        # Preallocated background and, for averaging, total weights of each point
+        initial = -np.inf if aggregation == 'max' else 0
+        self.background = self.allocate(path, dtype, initial)
+        self.counts = None
+        if aggregation != 'max':
+            weights_path = None if path is None else f'{os.path.splitext(path)[0]}_weights.npy'
+            self.counts = self.allocate(weights_path, np.float32, 0)
+
+        if aggregation == 'weighted' and weights is None:
+            if crop_shape is None:
+                raise ValueError('Pass `weights` or `crop_shape` to use `weighted` aggregation.')
+            weights = np.ones(tuple(crop_shape), dtype=np.float32)
+            for axis, size in enumerate(crop_shape):
+                ramp = np.minimum(np.arange(1, size + 1), np.arange(size, 0, -1)).astype(np.float32)
+                weights *= ramp.reshape([-1 if k == axis else 1 for k in range(3)])
+        self.weights = np.ones((1, 1, 1), dtype=np.float32) if weights is None else weights.astype(np.float32)
+
+        self.minimum = np.inf
+        self.grid_array, self.position = None, 0
+
+    @classmethod
+    def from_grid(cls, grid_info, order=None, **kwargs):
+        """ Create accumulator for crops along the grid, made by :meth:`.SeismicCubeset.make_grid`.
+        Crops can be then added by :meth:`.push` in the order of the grid.
+        """
+        order = order or (2, 0, 1)
+        accumulator = cls(grid_info['predict_shape'], crop_shape=grid_info['crop_shape'], order=order, **kwargs)
+        accumulator.grid_array = np.array(grid_info['grid_array'], dtype=np.int64).reshape(-1, 3)
+        return accumulator
+
+    def allocate(self, path, dtype, fill_value):
+        """ Create array of the accumulator shape in memory or in `.npy` file. """
+        if path is None:
+            return np.full(self.shape, fill_value, dtype=dtype)
+        array = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=self.shape)
+        array[:] = fill_value
+        return array
+
+
+    def update(self, crops, locations):
+        """ Add each of `crops` to the array at its location of upper leftmost corner.
+        Locations may be negative or go out of the array: crops are cut to fit in it.
+        """
+        for crop, location in zip(crops, locations):
+            crop = np.transpose(crop, self.order)
+            if crop.size:
+                self.minimum = min(self.minimum, crop.min())
+            _scatter_crop(self.background, self.counts, crop, self.weights,
+                          np.asarray(location, dtype=np.int64), AGGREGATIONS[self.aggregation])
+
+    def push(self, crops):
+        """ Add `crops` at the next locations of the grid. """
+        if self.grid_array is None:
+            raise ValueError('Locations of crops are unknown: create accumulator with `from_grid` or use `update`.')
+        if self.position + len(crops) > len(self.grid_array):
+            raise ValueError('Number of crops is bigger than number of crops in a grid')
+
+        locations = self.grid_array[self.position : self.position + len(crops)]
+        self.update(crops, locations)
+        self.position += len(crops)
+
+    def aggregate(self):
+        """ Finalize the array: average accumulated values and fill points, not covered by crops.
+        Done in-place, so should be called only once, after all the crops are added.
+        """
+        fill_value = self.fill_value
+        if fill_value is None:
+            fill_value = self.minimum if np.isfinite(self.minimum) else 0
+
+        counts = self.counts if self.counts is not None else np.zeros((1, 1, 1), dtype=np.float32)
+        _finalize(self.background, counts, fill_value, AGGREGATIONS[self.aggregation])
+
+        if self.path is not None:
+            self.background.flush()
+        return self.background
+
+
+@njit
+def _scatter_crop(background, counts, crop, weights, location, mode):
+    """ Add `crop` to the `background` at `location`: keep maximum for `mode` 0, add values and weights otherwise. """
+    starts, stops = np.zeros(3, dtype=np.int64), np.zeros(3, dtype=np.int64)
+    for k in range(3):
+        starts[k] = max(0, -location[k])
+        stops[k] = min(crop.shape[k], background.shape[k] - location[k])
+
+    for i in range(starts[0], stops[0]):
+        i_ = location[0] + i
+        for x in range(starts[1], stops[1]):
+            x_ = location[1] + x
+            for h in range(starts[2], stops[2]):
+                h_ = location[2] + h
+                value = crop[i, x, h]
+                if mode == 0:
+                    if value > background[i_, x_, h_]:
+                        background[i_, x_, h_] = value
+                elif mode == 1:
+                    background[i_, x_, h_] += value
+                    counts[i_, x_, h_] += 1
+                else:
+                    weight = weights[i, x, h]
+                    background[i_, x_, h_] += value * weight
+                    counts[i_, x_, h_] += weight
+
+@njit
+def _finalize(background, counts, fill_value, mode):
+    """ Average accumulated values in-place and fill points, that were not covered by crops. """
+    for i in range(background.shape[0]):
+        for x in range(background.shape[1]):
+            for h in range(background.shape[2]):
+                if mode == 0:
+                    if background[i, x, h] == -np.inf:
+                        background[i, x, h] = fill_value
+                elif counts[i, x, h] > 0:
+                    background[i, x, h] /= counts[i, x, h]
+                else:
+                    background[i, x, h] = fill_value
@@ -53,12 +53,15 @@ class BaseController:
         If callable, then it is used directly to log messages.
     bar : bool
         Whether to show progress bars for training and inference.
+    cache_budget : number, optional
+        If provided, then the total size of slides, cached by all of the cubes in created datasets,
+        is limited by this amount of gigabytes. Otherwise, each cube keeps a fixed amount of slides.
     """
     #pylint: disable=unused-argument, logging-fstring-interpolation, no-member, too-many-public-methods
     #pylint: disable=access-member-before-definition, attribute-defined-outside-init
     def __init__(self, batch_size=64, crop_shape=(1, 256, 256),
                  model_config=None, model_path=None, device=None,
-                 show_plots=False, save_dir=None, logger=None, bar=True):
+                 show_plots=False, save_dir=None, logger=None, bar=True, cache_budget=None):
         for key, value in locals().items():
             if key != 'self':
                 setattr(self, key, value)
@@ -133,6 +136,8 @@ class BaseController:
         dataset = SeismicCubeset(dsi)
 
         dataset.load_geometries()
+        if self.cache_budget is not None:
+            dataset.set_cache_budget(self.cache_budget)
 
         if horizon_paths:
             if isinstance(horizon_paths, str):
@@ -289,6 +294,7 @@ class BaseController:
         self.log(f'Used batch size is: {self.batch_size}; actual batch size is: {len(batch)}')
         self.log(f'Cache sizes: {[item.cache_size for item in dataset.geometries.values()]}')
         self.log(f'Cache lengths: {[item.cache_length for item in dataset.geometries.values()]}')
+        self.log(f'Cache stats: {[item.cache_stats for item in dataset.geometries.values()]}')
         self.batch_size = bs
 
         model_pipeline.run(D('size'), n_iters=n_iters + np.random.randint(100),
@@ -300,7 +306,8 @@ class BaseController:
         last_loss = np.mean(model_pipeline.v('loss_history')[-50:])
         self.log(f'Train finished; last loss is {last_loss}')
         self.log(f'Cache sizes: {[item.cache_size for item in dataset.geometries.values()]}')
-        self.log(f'Cache lengths: {[len(item._cached_load.cache()) for item in dataset.geometries.values()]}')
+        self.log(f'Cache lengths: {[item.cache_length for item in dataset.geometries.values()]}')
+        self.log(f'Cache stats: {[item.cache_stats for item in dataset.geometries.values()]}')
 
         # Cleanup
         torch.cuda.empty_cache()
@@ -329,7 +336,11 @@ class BaseController:
             If 0, then cube is split into chunks of `crop_shape` size,
             model is used to create predictions for each of them,
             then chunks are aggregated into huge 3D array, from which the horizon surface is extracted.
-            This approach is fast but very memory intensive: it is advised to use it only on small (<10GB) cubes.
+            This approach is fast but memory intensive, as the whole array is kept. Surfaces are extracted from it
+            in spatial chunks, so that no other full-size arrays are created.
+            Additional parameters are:
+            mask_chunk_size : int
+                Spatial size of chunks to extract surfaces from the assembled array in.
 
             If 1, then cube is split into `big` chunks, each of them is split again into `crop_shape` pieces,
             model is used to create predictions for the latter,
@@ -423,10 +434,61 @@ class BaseController:
             config['order'] = (1, 0, 2)
         return config, crop_shape_grid
 
+    def stream_predict(self, dataset, config, prefetch=2, accumulator=None):
+        """ Predict on the current grid of `dataset` without creating batches and pipelines:
+        crops are loaded by :class:`.CropStream` in a background thread, while the model works on the previous ones.
+        If `accumulator` is provided, predictions are pushed to it after each batch instead of being returned.
+        """
+        model = config['model_pipeline'].get_model_by_name('model')
+        stream = dataset.make_crop_stream(batch_size=self.batch_size, shape=self.crop_shape,
+                                          normalize='q', prefetch=max(prefetch, 1) + 1)
+
+        predictions = []
+        for batch in stream:
+            if accumulator is not None:
+                accumulator.push(model.predict(batch['images'], fetches='predictions'))
+            else:
+                predictions.extend(model.predict(batch['images'], fetches='predictions'))
+        return accumulator if accumulator is not None else predictions
+
+    def predict_on_grid(self, dataset, config, prefetch=1, stream=False, pbar=False, bar_desc=None, **kwargs):
+        """ Predict on the current grid of `dataset` and assemble predictions into one array.
+        Predictions are added to :class:`.CropAccumulator` after each batch and are not kept,
+        so that the memory usage is defined by the assembled array only.
+
+        Parameters
+        ----------
+        stream : bool
+            Whether to load crops by :meth:`.stream_predict` instead of the inference pipeline.
+        kwargs : dict
+            Other parameters of :class:`.CropAccumulator`, for example, `aggregation` or `path`.
+        """
+        accumulator = dataset.make_accumulator(order=config.get('order'), **kwargs)
+
+        if stream:
+            self.stream_predict(dataset, config, prefetch=prefetch, accumulator=accumulator)
+        else:
+            inference_pipeline = (self.get_inference_template() << config) << dataset
+            for _ in inference_pipeline.gen_batch(D('size'), n_iters=dataset.grid_iters, prefetch=prefetch,
+                                                  bar=pbar, bar_desc=bar_desc):
+                # Take only crops, that are already predicted: the next batches can be processed at the same time
+                predicted_masks = inference_pipeline.v('predicted_masks')
+                crops = predicted_masks[:]
+                del predicted_masks[:len(crops)]
+                accumulator.push(crops)
+                crops = None
+            inference_pipeline.reset('variables')
+        return accumulator.aggregate()
+
 
     def inference_0(self, dataset, heights_range=None, orientation='i', overlap_factor=2,
-                    filtering_matrix=None, filter_threshold=0, prefetch=1, **kwargs):
-        """ Inference on chunks, assemble into massive 3D array, extract horizon surface. """
+                    filtering_matrix=None, filter_threshold=0, prefetch=1, stream=False, mask_chunk_size=256,
+                    aggregation='max', prediction_path=None, **kwargs):
+        """ Inference on chunks, assemble into massive 3D array, extract horizon surface.
+        If `stream` is True, crops are loaded by :meth:`.stream_predict` instead of the inference pipeline.
+        Crops are blended with `aggregation` as soon as they are predicted: if `prediction_path` is provided,
+        the array is memory-mapped to it. Surfaces are extracted from the array in spatial chunks of `mask_chunk_size`.
+        """
         _ = kwargs
         spatial_ranges, heights_range = self.make_inference_ranges(dataset, heights_range)
         config, crop_shape_grid = self.make_inference_config(orientation)
@@ -439,30 +501,29 @@ class BaseController:
                           filtering_matrix=filtering_matrix,
                           filter_threshold=filter_threshold)
 
-        inference_pipeline = (self.get_inference_template() << config) << dataset
-        inference_pipeline.run(D('size'), n_iters=dataset.grid_iters, bar=self.bar,
-                               prefetch=prefetch)
-
         # Assemble crops together in accordance to the created grid
-        assembled_pred = dataset.assemble_crops(inference_pipeline.v('predicted_masks'),
-                                                order=config.get('order'))
+        assembled_pred = self.predict_on_grid(dataset, config, prefetch=prefetch, stream=stream, pbar=self.bar,
+                                              aggregation=aggregation, path=prediction_path)
 
         # Log memory usage info and clean up
         self.log(f'Cache sizes: {[item.cache_size for item in dataset.geometries.values()]}')
         self.log(f'Cache lengths: {[item.cache_length for item in dataset.geometries.values()]}')
+        self.log(f'Cache stats: {[item.cache_stats for item in dataset.geometries.values()]}')
 
-        inference_pipeline.reset('variables')
-        inference_pipeline = None
         for item in dataset.geometries.values():
             item.reset_cache()
         gc.collect()
 
         # Convert to Horizon instances
-        return Horizon.from_mask(assembled_pred, dataset.grid_info, threshold=0.5, minsize=50)
+        return Horizon.from_mask(assembled_pred, dataset.grid_info, threshold=0.5, minsize=50,
+                                 chunk_size=mask_chunk_size)
 
     def inference_1(self, dataset, heights_range=None, orientation='i', overlap_factor=2, prefetch=1,
-                    chunk_size=100, chunk_overlap=0.2, filtering_matrix=None, filter_threshold=0, **kwargs):
-        """ Split area for inference into `big` chunks, inference on each of them, merge results. """
+                    chunk_size=100, chunk_overlap=0.2, filtering_matrix=None, filter_threshold=0,
+                    *, stream=False, aggregation='max', **kwargs):
+        """ Split area for inference into `big` chunks, inference on each of them, merge results.
+        If `stream` is True, crops are loaded by :meth:`.stream_predict` instead of the inference pipeline.
+        """
         _ = kwargs
         geometry = dataset.geometries[0]
         spatial_ranges, heights_range = self.make_inference_ranges(dataset, heights_range)
@@ -489,24 +550,21 @@ class BaseController:
             total_length += dataset.grid_info['length']
             total_unfiltered_length += dataset.grid_info['unfiltered_length']
 
-            inference_pipeline = (self.get_inference_template() << config) << dataset
-            inference_pipeline.run(D('size'), n_iters=dataset.grid_iters, prefetch=prefetch)
-
             # Assemble crops together in accordance to the created grid
-            assembled_pred = dataset.assemble_crops(inference_pipeline.v('predicted_masks'),
-                                                    order=config.get('order'))
+            assembled_pred = self.predict_on_grid(dataset, config, prefetch=prefetch, stream=stream,
+                                                  aggregation=aggregation)
 
             # Extract Horizon instances
             chunk_horizons = Horizon.from_mask(assembled_pred, dataset.grid_info, threshold=0.5, minsize=50)
             horizons.extend(chunk_horizons)
 
             # Cleanup
-            inference_pipeline.reset('variables')
-            inference_pipeline = None
+            assembled_pred = None
             gc.collect()
 
         self.log(f'Cache sizes: {[item.cache_size for item in dataset.geometries.values()]}')
         self.log(f'Cache lengths: {[item.cache_length for item in dataset.geometries.values()]}')
+        self.log(f'Cache stats: {[item.cache_stats for item in dataset.geometries.values()]}')
         self.log(f'Inferenced total of {total_length} out of {total_unfiltered_length} crops possible')
         for item in dataset.geometries.values():
             item.reset_cache()
@@ -540,12 +598,16 @@ class BaseController:
         If targets are provided, also l1 differences.
         """
         #pylint: disable=cell-var-from-loop, invalid-name, protected-access
+        # Cut data along the horizons by groups, keeping only a few of them in memory at once
+        metrics = []
+        for horizon in self.predictions[:n]:
+            horizon._horizon_metrics = None
+            metrics.append(HorizonMetrics((horizon, self.targets)))
+
         results = []
-        for i in range(n):
+        for i, hm in enumerate(HorizonMetrics.iterate_loaded(metrics)):
             info = {}
             horizon = self.predictions[i]
-            horizon._horizon_metrics = None
-            hm = HorizonMetrics((horizon, self.targets))
             prefix = [horizon.geometry.short_name, f'{i}_horizon'] if add_prefix else []
 
             # Basic demo: depth map and properties
@@ -9,7 +9,7 @@ import torch
 
 from ...batchflow import Pipeline, B, V, C, D, P, R, L
 
-from ..horizon import Horizon
+from ..extension import HorizonExtension
 
 from .enhancer import Enhancer
 from .best_practices import MODEL_CONFIG_EXTENSION
@@ -51,20 +51,19 @@ class Extender(Enhancer):
             'batch_size': batch_size,
             'model_pipeline': self.model_pipeline
         }
-        horizon = copy(horizon)
+        # Depths, border points and coverage by crops are updated only where the horizon changes
+        extension = HorizonExtension(horizon, crop_shape=self.crop_shape, stride=stride)
 
-        prev_len = len(horizon)
+        prev_len = extension.length
         self.log(f'Inference started for {n_steps} with stride {stride}.')
         for _ in self.make_pbar(range(n_steps), desc=f'Extender inference on {horizon.name}'):
             # Create grid of crops near horizon holes
-            dataset.make_extension_grid(dataset.indices[0],
-                                        crop_shape=self.crop_shape,
-                                        stride=stride,
-                                        labels_src=horizon,
-                                        batch_size=batch_size)
+            crops, shapes, orders = extension.make_grid()
+            dataset.set_extension_grid(dataset.indices[0], crops, shapes, orders,
+                                       batch_size=batch_size, geometry=horizon.geometry)
 
             # Add current horizon to dataset labels in order to make create_masks work
-            dataset.labels[dataset.indices[0]] = [horizon]
+            dataset.labels[dataset.indices[0]] = [extension.horizon]
 
             inference_pipeline = (self.get_inference_template() << config) << dataset
             try:
@@ -76,15 +75,10 @@ class Extender(Enhancer):
 
             # Merge surfaces on crops to the horizon itself
             horizons = [*inference_pipeline.v('predicted_horizons')]
-            for hor in horizons:
-                merge_code, _ = Horizon.verify_merge(horizon, hor,
-                                                     mean_threshold=5.5,
-                                                     adjacency=5)
-                if merge_code == 3:
-                    _ = horizon.overlap_merge(hor, inplace=True)
+            extension.merge(horizons, mean_threshold=5.5)
 
             # Log length increase
-            curr_len = len(horizon)
+            curr_len = extension.length
             if (curr_len - prev_len) < 25:
                 break
             self.log(f'Extended from {prev_len} to {curr_len}, + {curr_len - prev_len}')
@@ -95,7 +89,8 @@ class Extender(Enhancer):
             inference_pipeline = None
 
         torch.cuda.empty_cache()
-        horizon.name = f'extended_{horizon.name[8:]}' # get rid of `copy_of_` postfix
+        horizon = copy(extension.horizon)
+        horizon.name = f'extended_{extension.name}'
         self.predictions = [horizon]
 
 
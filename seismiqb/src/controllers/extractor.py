@@ -58,6 +58,15 @@ class Extractor(BaseController):
         )
 
 
+    @staticmethod
+    def compute_std_coeff(horizon):
+        """ Std of the Sobel filter over the depth map: measure of horizon roughness. """
+        horizon_matrix = horizon.matrix
+        matrix = sobel(np.copy(horizon_matrix))
+        matrix[horizon_matrix == Horizon.FILL_VALUE] = 0
+        matrix[abs(matrix) > 100] = 0
+        return np.std(matrix)
+
     def inference_1(self, dataset, heights_range=None, orientation='i', overlap_factor=2,
                     filter=True, thresholds=None, coverage_threshold=0.5, std_threshold=5.,
                     metric_threshold=0.5, chunk_size=100, chunk_overlap=0.2, minsize=10000,
@@ -87,12 +96,8 @@ class Extractor(BaseController):
                               filtering_matrix=filtering_matrix,
                               filter_threshold=filter_threshold)
 
-            inference_pipeline = (self.get_inference_template() << config) << dataset
-            inference_pipeline.run(D('size'), n_iters=dataset.grid_iters, bar=self.bar,
-                                   bar_desc=f'Inference on {geometry.name} | {orientation}')
-
-            assembled_pred = dataset.assemble_crops(inference_pipeline.v('predicted_masks'),
-                                                    order=config.get('order'))
+            assembled_pred = self.predict_on_grid(dataset, config, pbar=self.bar,
+                                                  bar_desc=f'Inference on {geometry.name} | {orientation}')
             # Specific to Extractor:
             for sign in [-1, +1]:
                 mask = sign * assembled_pred
@@ -110,36 +115,37 @@ class Extractor(BaseController):
         merged_horizons = Horizon.merge_list(merged_horizons, mean_threshold=0.5)
         del storage
 
-        filtered_horizons = []
+        candidates = []
         for horizon in merged_horizons:
             # CHECK 1: coverage
             if horizon.coverage >= coverage_threshold:
 
                 # CHECK 2: std
-                matrix = sobel(np.copy(horizon.matrix))
-                matrix[horizon.matrix == Horizon.FILL_VALUE] = 0
-                matrix[abs(matrix) > 100] = 0
-                std_coeff = np.std(matrix)
-
+                std_coeff = self.compute_std_coeff(horizon)
                 if std_coeff <= std_threshold:
+                    candidates.append((horizon, std_coeff))
 
-                    # CHECK 3: metric
-                    hm = HorizonMetrics(horizon)
-                    corrs = hm.evaluate('support_corrs', supports=50, agg='nanmean')
+        # Cut data along the remaining horizons by groups, keeping only a few of them in memory at once
+        metrics = [HorizonMetrics(horizon) for horizon, _ in candidates]
 
-                    if filter:
-                        horizon.filter(filtering_matrix=(corrs <= metric_threshold).astype(np.int32))
-                        if horizon.coverage <= coverage_threshold:
-                            continue
-
-                    corr_coeff = np.nanmean(corrs)
-
-                    if corr_coeff >= metric_threshold:
-                        horizon._corr_coeff = corr_coeff
-                        filtered_horizons.append(horizon)
-                        self.log(f'depth: {horizon.h_mean:6.6}; cov: {horizon.coverage:6.6};'
-                                 f' std: {std_coeff:6.6}; metric: {corr_coeff:6.6}')
-        del merged_horizons
+        filtered_horizons = []
+        for hm, (horizon, std_coeff) in zip(HorizonMetrics.iterate_loaded(metrics), candidates):
+            # CHECK 3: metric
+            corrs = hm.evaluate('support_corrs', supports=50, agg='nanmean')
+
+            if filter:
+                horizon.filter(filtering_matrix=(corrs <= metric_threshold).astype(np.int32))
+                if horizon.coverage <= coverage_threshold:
+                    continue
+
+            corr_coeff = np.nanmean(corrs)
+
+            if corr_coeff >= metric_threshold:
+                horizon._corr_coeff = corr_coeff
+                filtered_horizons.append(horizon)
+                self.log(f'depth: {horizon.h_mean:6.6}; cov: {horizon.coverage:6.6};'
+                         f' std: {std_coeff:6.6}; metric: {corr_coeff:6.6}')
+        del candidates, metrics, merged_horizons
 
 
         horizons = []
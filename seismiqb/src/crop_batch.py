@@ -11,7 +11,7 @@ from scipy.signal import butter, lfilter, hilbert
 
 from ..batchflow import FilesIndex, Batch, action, inbatch_parallel, SkipBatchException, apply_parallel
 
-from .horizon import Horizon
+from .horizon import Horizon, HorizonMergeIndex
 from .plotters import plot_image
 
 
@@ -305,9 +305,11 @@ class SeismicCropBatch(Batch):
 
 
     @action
-    @inbatch_parallel(init='indices', post='_assemble', target='for')
-    def load_cubes(self, ix, dst, src_locations='locations', src_geometry='geometries', slicing='custom', **kwargs):
+    def load_cubes(self, dst, src_locations='locations', src_geometry='geometries', slicing='custom',
+                   n_workers=1, executor=None, **kwargs):
         """ Load data from cube in given positions.
+        Crops from the same cube are loaded at once by `load_crops` method of its geometry:
+        slides and hyperslabs, shared between multiple crops, are read only once.
 
         Parameters
         ----------
@@ -316,16 +318,48 @@ class SeismicCropBatch(Batch):
         slicing : str
             if 'native', crop will be looaded as a slice of geometry. If 'custom', use `load_crop` method to make crops.
             The 'native' option is prefered to 3D crops to speed up loading.
+        n_workers : int
+            Number of workers to load crops from each of the cubes with. Used only with `custom` slicing.
+        executor : 'threads', 'processes' or None
+            Type of workers. By default, threads are used for HDF5 and NPZ cubes, and processes for SEG-Y.
         """
-        geometry = self.get(ix, src_geometry)
-        location = self.get(ix, src_locations)
-        if slicing == 'native':
-            crop = geometry[tuple(location)]
-        elif slicing == 'custom':
-            crop = geometry.load_crop(location, **kwargs)
-        else:
+        if slicing not in ['native', 'custom']:
             raise ValueError(f"slicing must be 'native' or 'custom' but {slicing} were given.")
-        return crop
+
+        # Group items by geometry
+        groups = {}
+        for i, ix in enumerate(self.indices):
+            groups.setdefault(self.get(ix, src_geometry), []).append(i)
+        locations = [self.get(ix, src_locations) for ix in self.indices]
+
+        crops = [None] * len(self)
+        for geometry, positions in groups.items():
+            if slicing == 'native':
+                loaded = [geometry[tuple(locations[i])] for i in positions]
+            else:
+                loaded = geometry.load_crops([locations[i] for i in positions],
+                                             n_workers=n_workers, executor=executor, **kwargs)
+
+            # Crops from one geometry are already stacked in the order of the batch
+            if len(groups) == 1 and isinstance(loaded, np.ndarray):
+                crops = loaded
+                break
+            for i, crop in zip(positions, loaded):
+                crops[i] = crop
+
+        if isinstance(crops, list):
+            if len({crop.shape for crop in crops}) == 1:
+                crops = np.stack(crops)
+            else:
+                crops_ = np.empty(len(crops), dtype=object)
+                crops_[:] = crops
+                crops = crops_
+
+        if hasattr(self, dst):
+            setattr(self, dst, crops)
+        else:
+            self.add_components(dst, crops)
+        return self
 
     def get_nearest_horizon(self, ix, src_labels, heights_slice):
         """ Get horizon with its `h_mean` closest to mean of `heights_slice`. """
@@ -359,6 +393,8 @@ class SeismicCropBatch(Batch):
         -----
         This method loads rectified data, e.g. amplitudes are croped relative
         to horizon and will form a straight plane in the resulting crop.
+
+        Items are processed one by one; pass `target='threads'` and `n_workers` to process them concurrently.
         """
         location = self.get(ix, locations)
         nearest_horizon = self.get_nearest_horizon(ix, src_labels, location[2])
@@ -401,6 +437,8 @@ class SeismicCropBatch(Batch):
         Notes
         -----
         Can be run only after labels-dict is loaded into labels-component.
+
+        Items are processed one by one; pass `target='threads'` and `n_workers` to process them concurrently.
         """
         location = self.get(ix, src_locations)
         crop_shape = self.get(ix, 'shapes')
@@ -416,6 +454,8 @@ class SeismicCropBatch(Batch):
         if isinstance(use_labels, (tuple, list, np.ndarray)):
             labels = [labels[idx] for idx in use_labels]
         elif use_labels == 'single':
+            # Shuffle a copy: the list of labels is shared between items and threads
+            labels = list(labels)
             np.random.shuffle(labels)
         elif use_labels in ['nearest', 'nearest_to_center']:
             labels = [self.get_nearest_horizon(ix, src_labels, location[2])]
@@ -640,23 +680,19 @@ class SeismicCropBatch(Batch):
             setattr(self, dst, [hor for hor_list in horizons_lists for hor in hor_list])
             return self
 
+        # Only targets, that are close to a candidate, are checked
+        index = HorizonMergeIndex(mean_threshold=mean_threshold, adjacency=adjacency)
+        for horizon_target in dst:
+            index.add(horizon_target)
+
         for horizons in horizons_lists:
             for horizon_candidate in horizons:
-                for horizon_target in dst:
-                    merge_code, _ = Horizon.verify_merge(horizon_target, horizon_candidate,
-                                                         mean_threshold=mean_threshold,
-                                                         adjacency=adjacency)
-                    if merge_code == 3:
-                        merged = Horizon.overlap_merge(horizon_target, horizon_candidate, inplace=True)
-                    elif merge_code == 2:
-                        merged = Horizon.adjacent_merge(horizon_target, horizon_candidate, inplace=True,
-                                                        adjacency=adjacency, mean_threshold=mean_threshold)
-                    else:
-                        merged = False
-                    if merged:
+                for target in index.candidates(horizon_candidate):
+                    if index.merge(target, horizon_candidate):
                         break
                 else:
                     # If a horizon can't be merged to any of the previous ones, we append it as it is
+                    index.add(horizon_candidate)
                     dst.append(horizon_candidate)
         return self
 
@@ -16,11 +16,14 @@ from ..batchflow import NumpySampler
 
 from .geometry import SeismicGeometry
 from .crop_batch import SeismicCropBatch
+from .stream import CropStream
+from .accumulator import CropAccumulator
 
 from .horizon import Horizon, UnstructuredHorizon
 from .metrics import HorizonMetrics
 from .plotters import plot_image
-from .utils import IndexedDict, round_to_array, gen_crop_coordinates, make_axis_grid, infer_tuple
+from .utils import IndexedDict, MemoryBudget, SharedCache, round_to_array, gen_crop_coordinates_batch, \
+                   make_axis_grid, infer_tuple, sum_windows
 
 
 
@@ -58,6 +61,8 @@ class SeismicCubeset(Dataset):
         self.grid_gen, self.grid_info, self.grid_iters = None, None, None
         self.shapes_gen, self.orders_gen = None, None
         self._cached_attributes = {'geometries'}
+        self.cache_budget = None
+        self.shared_cache = None
 
 
     @classmethod
@@ -324,6 +329,46 @@ class SeismicCubeset(Dataset):
                 cached_attr = cached_attr if isinstance(cached_attr, list) else [cached_attr]
                 _ = [item.reset_cache() for item in cached_attr]
 
+    def set_cache_budget(self, gigabytes=None):
+        """ Limit the total size of slides, cached by all of the geometries, instead of amount of slides for each one.
+        Least recently used slides are evicted first, regardless of the cube they are from.
+        Resets the caches of geometries.
+
+        Parameters
+        ----------
+        gigabytes : number or None
+            Maximum total size of cached slides. If None, then each geometry uses its own count-based cache.
+        """
+        self.cache_budget = MemoryBudget(gigabytes * 1024 ** 3) if gigabytes is not None else None
+        for geometry in self.geometries.values():
+            if hasattr(geometry, 'structured'):
+                geometry.reset_cache()
+            geometry.cache_budget = self.cache_budget
+
+    def set_shared_cache(self, gigabytes=None, maxitems=4096):
+        """ Store loaded slides of all of the geometries in shared memory, so that processes, loading batches,
+        reuse slides loaded by each other and keep only one copy of them. Previously used shared cache is closed.
+
+        Parameters
+        ----------
+        gigabytes : number or None
+            Maximum total size of stored slides. If None, then each geometry caches slides in its own process.
+        maxitems : int
+            Maximum amount of stored slides.
+        """
+        if self.shared_cache is not None:
+            self.shared_cache.close()
+        self.shared_cache = SharedCache(gigabytes * 1024 ** 3, maxitems=maxitems) if gigabytes is not None else None
+        for geometry in self.geometries.values():
+            geometry.shared_cache = self.shared_cache
+
+    def set_disk_cache(self, gigabytes=10, path=None):
+        """ Store attributes and metrics of horizons on disk next to each of the cubes, so that they are reused
+        by other runs. See :meth:`.SeismicGeometry.set_disk_cache` for details.
+        """
+        for geometry in self.geometries.values():
+            geometry.set_disk_cache(gigabytes=gigabytes, path=path)
+
 
     def dump_labels(self, path, fmt='npy', separate=False):
         """ Dump points to file. """
@@ -680,35 +725,25 @@ class SeismicCubeset(Dataset):
         xlines_grid = make_axis_grid(xlines, strides[1], geometry.xlines_len, crop_shape[1])
         heights_grid = make_axis_grid(heights, strides[2], geometry.depth, crop_shape[2])
 
-        # Every point in grid contains reference to cube
-        # in order to be valid input for `crop` action of SeismicCropBatch
-        grid = []
-        for il in ilines_grid:
-            for xl in xlines_grid:
-                if np.prod(crop_shape[:2]) - np.sum(filtering_matrix[il: il + crop_shape[0],
-                                                                     xl: xl + crop_shape[1]]) > filter_threshold:
-                    for h in heights_grid:
-                        point = [cube_name, il, xl, h]
-                        grid.append(point)
-        grid = np.array(grid, dtype=object)
-
-        # Creating and storing all the necessary things
-        # Check if grid is not empty
+        # Keep only spatial positions with enough non-gap traces in a crop
+        filtered = sum_windows(filtering_matrix, ilines_grid, xlines_grid, crop_shape)
+        present_i, present_x = np.nonzero(np.prod(crop_shape[:2]) - filtered > filter_threshold)
+
+        # Grid is stored as ints relative to the ranges: reference to cube is added only to produced batches
         shifts = np.array([ilines[0], xlines[0], heights[0]])
-        if len(grid) > 0:
-            grid_gen = (grid[i:i+batch_size]
-                        for i in range(0, len(grid), batch_size))
-            grid_array = grid[:, 1:].astype(int) - shifts
-        else:
-            grid_gen = iter(())
-            grid_array = []
+        grid_array = np.empty((len(present_i) * len(heights_grid), 3), dtype=np.int32)
+        grid_array[:, 0] = np.repeat(np.array(ilines_grid)[present_i], len(heights_grid))
+        grid_array[:, 1] = np.repeat(np.array(xlines_grid)[present_x], len(heights_grid))
+        grid_array[:, 2] = np.tile(heights_grid, len(present_i))
+        grid_array -= shifts.astype(np.int32)
+        grid_gen = self._grid_generator(cube_name, grid_array, shifts, batch_size)
 
         predict_shape = (ilines[1] - ilines[0],
                          xlines[1] - xlines[0],
                          heights[1] - heights[0])
 
         self.grid_gen = lambda: next(grid_gen)
-        self.grid_iters = - (-len(grid) // batch_size)
+        self.grid_iters = - (-len(grid_array) // batch_size)
         self.grid_info = {
             'grid_array': grid_array,
             'predict_shape': predict_shape,
@@ -723,6 +758,58 @@ class SeismicCubeset(Dataset):
         }
 
 
+    @staticmethod
+    def _grid_generator(cube_name, grid_array, shifts, batch_size):
+        """ Yield batches of grid points: each point contains reference to cube
+        in order to be valid input for `crop` action of SeismicCropBatch.
+        """
+        for start in range(0, len(grid_array), batch_size):
+            points = grid_array[start:start + batch_size] + shifts
+            batch = np.empty((len(points), 4), dtype=object)
+            batch[:, 0] = cube_name
+            batch[:, 1:] = points
+            yield batch
+
+
+    def make_crop_stream(self, grid_info='grid_info', sampler=None, **kwargs):
+        """ Create an iterator over batches of crops, that are loaded in the background.
+        By default, crops are taken along the grid, created by :meth:`.make_grid`.
+
+        Parameters
+        ----------
+        grid_info : dict or str
+            Dictionary with information about grid or name of the attribute to get it from. Not used with `sampler`.
+        sampler : callable or str, optional
+            Sampler of points or name of the attribute to get it from, for example, `train_sampler`.
+        kwargs : dict
+            Other parameters of :class:`.CropStream`.
+        """
+        if sampler is not None:
+            sampler = getattr(self, sampler) if isinstance(sampler, str) else sampler
+            return CropStream(self, sampler=sampler, **kwargs)
+
+        grid_info = getattr(self, grid_info) if isinstance(grid_info, str) else grid_info
+        return CropStream(self, grid_info=grid_info, **kwargs)
+
+    def make_accumulator(self, grid_info='grid_info', order=None, **kwargs):
+        """ Create an array to add predictions on crops along the grid to, as soon as they are made.
+
+        Parameters
+        ----------
+        grid_info : dict or str
+            Dictionary with information about grid or name of the attribute to get it from.
+        order : tuple of int
+            Axes-param for `transpose`-operation, applied to each crop. Same as in :meth:`.assemble_crops`.
+        kwargs : dict
+            Other parameters of :class:`.CropAccumulator`, for example, `aggregation` or `path`.
+        """
+        if isinstance(grid_info, str):
+            if not hasattr(self, grid_info):
+                raise ValueError('Pass grid_info dictionary or call `make_grid` method to create grid_info.')
+            grid_info = getattr(self, grid_info)
+        return CropAccumulator.from_grid(grid_info, order=order, **kwargs)
+
+
     def show_grid(self, src_labels='labels', labels_indices=None, attribute='cube_values', plot_dict=None):
         """ Plot grid over selected surface to visualize how it overlaps data.
 
@@ -993,34 +1080,40 @@ class SeismicCubeset(Dataset):
         coverage_matrix = np.zeros_like(zero_traces) if isinstance(coverage, bool) else coverage
 
         # get horizon boundary points in horizon.matrix coordinates
-        border_points = np.array(list(zip(*np.where(horizon.boundaries_matrix))))
+        border_points = np.stack(np.nonzero(horizon.boundaries_matrix), axis=1)
 
         # shift border_points to global coordinates
         border_points[:, 0] += horizon.i_min
         border_points[:, 1] += horizon.x_min
 
-        crops, orders, shapes = [], [], []
-
-        for i, point in enumerate(border_points):
-            if coverage_matrix[point[0], point[1]] == 1:
-                continue
+        # Crops for all the border points at once: points inside crops of the previous ones are skipped
+        crops, shapes, orders = gen_crop_coordinates_batch(border_points,
+                                                           hor_matrix, zero_traces,
+                                                           stride, crop_shape, horizon.geometry.depth,
+                                                           horizon.FILL_VALUE,
+                                                           coverage=coverage_matrix if coverage is not False else None,
+                                                           **kwargs)
 
-            result = gen_crop_coordinates(point,
-                                          hor_matrix, zero_traces,
-                                          stride, crop_shape, horizon.geometry.depth,
-                                          horizon.FILL_VALUE, **kwargs)
-            if not result:
-                continue
-            new_point, shape, order = result
-            crops.extend(new_point)
-            shapes.extend(shape)
-            orders.extend(order)
+        self.set_extension_grid(cube_name, crops, shapes, orders, batch_size=batch_size, geometry=horizon.geometry)
 
-            if coverage is not False:
-                for _point, _shape in zip(new_point, shape):
-                    coverage_matrix[_point[0]: _point[0] + _shape[0],
-                                    _point[1]: _point[1] + _shape[1]] = 1
+    def set_extension_grid(self, cube_name, crops, shapes, orders, batch_size=16, geometry=None):
+        """ Set generators of crops for extension procedure: see :meth:`.make_extension_grid`.
 
+        Parameters
+        ----------
+        cube_name : str
+            Reference to the cube.
+        crops : sequence
+            Upper leftmost corners of crops.
+        shapes : sequence
+            Shapes of crops.
+        orders : sequence
+            Axes orders of crops.
+        batch_size : int
+            Batch size fed to the model.
+        geometry : :class:`.SeismicGeometry`, optional
+            Geometry of the cube. By default, taken from the dataset.
+        """
         crops = np.array(crops, dtype=np.object).reshape(-1, 3)
         cube_names = np.array([cube_name] * len(crops), dtype=np.object).reshape(-1, 1)
         shapes = np.array(shapes)
@@ -1038,11 +1131,13 @@ class SeismicCubeset(Dataset):
         self.orders_gen = lambda: next(orders_gen)
         self.grid_iters = - (-len(crops) // batch_size)
         self.grid_info = {'cube_name': cube_name,
-                          'geometry': horizon.geometry}
+                          'geometry': geometry if geometry is not None else self.geometries[cube_name]}
 
 
-    def assemble_crops(self, crops, grid_info='grid_info', order=None, fill_value=0):
+    def assemble_crops(self, crops, grid_info='grid_info', order=None, fill_value=0, aggregation='max', **kwargs):
         """ Glue crops together in accordance to the grid.
+        Crops are added one by one to :class:`.CropAccumulator`: to assemble predictions as soon as they are made,
+        without keeping all of them, use :meth:`.make_accumulator` instead.
 
         Note
         ----
@@ -1060,6 +1155,10 @@ class SeismicCubeset(Dataset):
             applied to images-tensor.
         fill_value : float
             Fill_value for background array if `len(crops) == 0`.
+        aggregation : {'max', 'mean', 'weighted'}
+            Method of blending overlapping crops.
+        kwargs : dict
+            Other parameters of :class:`.CropAccumulator`, for example, `path` to assemble crops in a memmap.
 
         Returns
         -------
@@ -1074,39 +1173,25 @@ class SeismicCubeset(Dataset):
         # Do nothing if number of crops differ from number of points in the grid.
         if len(crops) != len(grid_info['grid_array']):
             raise ValueError('Length of crops must be equal to number of crops in a grid')
-        order = order or (2, 0, 1)
-        crops = np.array(crops)
-        if len(crops) != 0:
-            fill_value = np.min(crops)
-
-        grid_array = grid_info['grid_array']
-        crop_shape = grid_info['crop_shape']
-        background = np.full(grid_info['predict_shape'], fill_value)
-
-        for j, (i, x, h) in enumerate(grid_array):
-            crop_slice, background_slice = [], []
-
-            for k, start in enumerate((i, x, h)):
-                if start >= 0:
-                    end = min(background.shape[k], start + crop_shape[k])
-                    crop_slice.append(slice(0, end - start))
-                    background_slice.append(slice(start, end))
-                else:
-                    crop_slice.append(slice(-start, None))
-                    background_slice.append(slice(None))
-
-            crop = np.transpose(crops[j], order)
-            crop = crop[crop_slice]
-            previous = background[background_slice]
-            background[background_slice] = np.maximum(crop, previous)
 
-        return background
+        accumulator = CropAccumulator.from_grid(grid_info, order=order, aggregation=aggregation,
+                                                fill_value=fill_value if len(crops) == 0 else None, **kwargs)
+        accumulator.push(crops)
+        return accumulator.aggregate()
 
     def make_prediction(self, path_hdf5, pipeline, crop_shape, crop_stride,
                         idx=0, src='predictions', chunk_shape=None, chunk_stride=None, batch_size=8,
-                        pbar=True):
+                        pbar=True, aggregation='max', projections=('cube',), storage_chunks=True,
+                        max_memory=None):
         """ Create hdf5 file with prediction.
 
+        Cube is split into spatial chunks, each of them is predicted by the crops along the grid, and then
+        added to the `cube` dataset, so that only one chunk is in memory at a time. Overlapping chunks are averaged.
+        At last, prediction is normalized by blocks of ilines, that are also written into other `projections`.
+
+        Besides the `projections`, the file contains the `weights` dataset of (ilines, xlines) shape
+        with the number of chunks, covering each trace.
+
         Parameters
         ----------
         path_hdf5 : str
@@ -1122,19 +1207,38 @@ class SeismicCubeset(Dataset):
         src : str
             pipeline variable for predictions
         chunk_shape : int, tuple or None
-            shape of chunks.
+            shape of chunks. If None, then the whole cube is predicted as one chunk,
+            unless `max_memory` is provided: then, the shape is inferred from it.
         chunk_stride : int
-            stride for chunks
+            stride for chunks. By default, equals to `chunk_shape`. For chunks, inferred from `max_memory`,
+            default stride makes them overlap by the size of crop, so that crops at the borders of chunks are averaged.
         batch_size : int
 
         pbar : bool
             progress bar
+        aggregation : {'max', 'mean', 'weighted'}
+            Method of blending overlapping crops inside each chunk, same as in :class:`.CropAccumulator`.
+        projections : sequence of str
+            Datasets to write prediction to: any of `cube`, `cube_x` and `cube_h`,
+            in the same order of axes as in :meth:`.SeismicGeometry.make_hdf5`.
+        storage_chunks : bool or tuple
+            Shape of HDF5 chunks for each of the datasets, in the order of its axes. If True, guessed by `h5py`.
+        max_memory : int, optional
+            Approximate limit on memory, used for prediction of one chunk or normalization of one block, in bytes.
+            If not provided, chunks are not limited, and normalization uses blocks of about 2GB.
         """
         geometry = self.geometries[idx]
-        chunk_shape = infer_tuple(chunk_shape, geometry.cube_shape)
+        cube_shape = geometry.cube_shape
+
+        # Each trace of a chunk needs memory for accumulated crops, their weights and already written values
+        if chunk_shape is None and max_memory is not None:
+            side = int((max_memory / (3 * geometry.depth * 4)) ** 0.5)
+            chunk_shape = [min(max(side, 2 * crop_shape[i]), cube_shape[i]) for i in range(2)] + [cube_shape[2]]
+            if chunk_stride is None:
+                chunk_stride = [max(chunk_shape[i] - crop_shape[i], 1) for i in range(2)] + [cube_shape[2]]
+        chunk_shape = infer_tuple(chunk_shape, cube_shape)
         chunk_stride = infer_tuple(chunk_stride, chunk_shape)
 
-        cube_shape = geometry.cube_shape
         chunk_grid = [
             make_axis_grid((0, cube_shape[i]), chunk_stride[i], cube_shape[i], crop_shape[i])
             for i in range(2)
@@ -1144,22 +1248,21 @@ class SeismicCubeset(Dataset):
         if os.path.exists(path_hdf5):
             os.remove(path_hdf5)
 
-        if pbar:
-            total = 0
-            for i_min, x_min in chunk_grid:
-                i_max = min(i_min+chunk_shape[0], cube_shape[0])
-                x_max = min(x_min+chunk_shape[1], cube_shape[1])
-                self.make_grid(
-                    self.indices[idx], crop_shape,
-                    [i_min, i_max], [x_min, x_max], [0, geometry.depth-1],
-                    strides=crop_stride, batch_size=batch_size
-                )
-                total += self.grid_iters
-
         with h5py.File(path_hdf5, "a") as file_hdf5:
-            aggregation_map = np.zeros(cube_shape[:-1])
-            cube_hdf5 = file_hdf5.create_dataset('cube', cube_shape)
-            context = tqdm(total=total) if pbar else contextlib.suppress()
+            orders = {'cube': [0, 1, 2], 'cube_x': [1, 2, 0], 'cube_h': [2, 0, 1]}
+            datasets = {}
+            for name in ['cube'] + [name for name in projections if name != 'cube']:
+                shape = tuple(np.array(cube_shape)[orders[name]])
+                chunks = storage_chunks
+                if isinstance(chunks, (tuple, list)):
+                    chunks = tuple(min(c, s) for c, s in zip(chunks, shape))
+                datasets[name] = file_hdf5.create_dataset(name, shape, dtype=np.float32, chunks=chunks,
+                                                          fillvalue=0)
+            weights_hdf5 = file_hdf5.create_dataset('weights', cube_shape[:2], dtype=np.float32,
+                                                    chunks=True, fillvalue=0)
+
+            # Total number of batches is known only after the grid for each chunk is made
+            context = tqdm(total=0) if pbar else contextlib.suppress()
             with context as progress_bar:
                 for i_min, x_min in chunk_grid:
                     i_max = min(i_min+chunk_shape[0], cube_shape[0])
@@ -1169,18 +1272,52 @@ class SeismicCubeset(Dataset):
                         [i_min, i_max], [x_min, x_max], [0, geometry.depth-1],
                         strides=crop_stride, batch_size=batch_size
                     )
+                    if pbar:
+                        progress_bar.total += self.grid_iters
+                        progress_bar.refresh()
+
+                    # Crops are added to the chunk and freed after each batch
+                    accumulator = self.make_accumulator(order=(0, 1, 2), aggregation=aggregation)
                     chunk_pipeline = pipeline << self
                     for _ in range(self.grid_iters):
                         _ = chunk_pipeline.next_batch(len(self))
+                        predictions = chunk_pipeline.v(src)
+                        accumulator.push(predictions)
+                        predictions.clear()
                         if pbar:
                             progress_bar.update()
 
-                    # Write to hdf5
+                    # Add to already written chunks
                     slices = tuple([slice(*item) for item in self.grid_info['range']])
-                    prediction = self.assemble_crops(chunk_pipeline.v(src), order=(0, 1, 2))
-                    aggregation_map[tuple(slices[:-1])] += 1
-                    cube_hdf5[slices[0], slices[1], slices[2]] = +prediction
-                cube_hdf5[:] = cube_hdf5 / np.expand_dims(aggregation_map, axis=-1)
+                    self._add_chunk(datasets['cube'], weights_hdf5, accumulator.aggregate(), slices)
+                    accumulator = None
+
+            self._normalize_prediction(datasets, weights_hdf5, max_memory=max_memory or 2 * 1024 ** 3)
+
+    @staticmethod
+    def _add_chunk(cube_hdf5, weights_hdf5, prediction, slices):
+        """ Add predicted chunk to the values, already written at `slices`, and count it in `weights`. """
+        prediction += cube_hdf5[slices]
+        cube_hdf5[slices] = prediction
+        weights_hdf5[slices[:2]] = weights_hdf5[slices[:2]] + 1
+
+    @staticmethod
+    def _normalize_prediction(datasets, weights_hdf5, max_memory):
+        """ Divide prediction by `weights` in blocks of ilines, writing each of them into all of the projections. """
+        cube_hdf5 = datasets['cube']
+        cube_shape = cube_hdf5.shape
+        block_size = max(1, int(max_memory // (2 * cube_shape[1] * cube_shape[2] * 4)))
+        for start in range(0, cube_shape[0], block_size):
+            stop = min(start + block_size, cube_shape[0])
+            block = cube_hdf5[start:stop]
+            weights = weights_hdf5[start:stop][..., np.newaxis]
+            np.divide(block, weights, out=block, where=weights > 0)
+
+            cube_hdf5[start:stop] = block
+            if 'cube_x' in datasets:
+                datasets['cube_x'][:, :, start:stop] = block.transpose((1, 2, 0))
+            if 'cube_h' in datasets:
+                datasets['cube_h'][:, start:stop, :] = block.transpose((2, 0, 1))
 
 
     def make_labels_prediction(self, pipeline, crop_shape, overlap_factor,
@@ -0,0 +1,173 @@
+""" Incremental state of the horizon extension procedure. """
+import numpy as np
+from numba import njit
+from scipy.ndimage import binary_erosion
+
+from .horizon import Horizon
+from .utils import gen_crop_coordinates_batch
+
+
+
+class HorizonExtension:
+    """ Mutable state of the iterative extension of a horizon: depths on the whole cube spatial range,
+    border points of the horizon and area, already covered by crops.
+
+    At each step, :meth:`.make_grid` creates crops next to the border points, and :meth:`.merge` adds surfaces,
+    predicted on them, to the horizon. All the state is updated only near the changed points:
+        - border points are re-computed in the 3x3 neighbourhood of added points;
+        - coverage by crops is kept between steps and reset only in the blocks of `reach` size around changed points,
+          so that crops are not generated again in places, where nothing has changed since the previous step;
+        - crops are generated only for border points in these blocks, all at once
+          with :func:`.gen_crop_coordinates_batch`.
+    Therefore, cost of each step is proportional to the changed area, not to the size of the horizon.
+
+    Parameters
+    ----------
+    horizon : :class:`.Horizon`
+        Horizon to extend. Not changed by the procedure.
+    crop_shape : sequence of 3 ints
+        Shape of crops. Crops of both (iline, xline) and (xline, iline) orientation are generated.
+    stride : int
+        Distance between a border point and a corner of a crop.
+    zeros_threshold : int
+        A maximum number of bad traces in a crop.
+    empty_threshold : int
+        A minimum number of points with unknown horizon per crop.
+    safe_stripe : int
+        Distance between a crop and the ends of the cube.
+    num_points : int
+        Number of crops to make for each border point. The maximum is four.
+    """
+    def __init__(self, horizon, crop_shape, stride=16, zeros_threshold=0, empty_threshold=5,
+                 safe_stripe=0, num_points=2):
+        self.geometry = horizon.geometry
+        self.name = horizon.name
+        self.crop_shape = np.array(crop_shape)
+        self.stride = stride
+        self.zeros_threshold, self.empty_threshold = zeros_threshold, empty_threshold
+        self.safe_stripe, self.num_points = safe_stripe, num_points
+
+        # Mutable state
+        self.full_matrix = horizon.full_matrix.astype(np.int32)
+        presence = self.full_matrix != Horizon.FILL_VALUE
+        self.boundaries = presence ^ binary_erosion(presence, np.ones((3, 3)), border_value=0)
+        self.coverage = np.zeros_like(presence)
+        self.length = len(horizon)
+        self.i_min, self.i_max = horizon.i_min, horizon.i_max
+        self.x_min, self.x_max = horizon.x_min, horizon.x_max
+
+        # Border points to make crops for at the next step
+        self.pending = np.stack(np.nonzero(self.boundaries), axis=1)
+        self.reach = max(stride, *self.crop_shape[:2])
+
+    @property
+    def horizon(self):
+        """ Current state of the horizon. Shares data with the `full_matrix`, so must be copied to be kept. """
+        matrix = self.full_matrix[self.i_min:self.i_max + 1, self.x_min:self.x_max + 1]
+        return Horizon(matrix, self.geometry, name=self.name, i_min=self.i_min, x_min=self.x_min, length=self.length)
+
+
+    def make_grid(self):
+        """ Make crops next to the pending border points, that are not covered by crops yet.
+        Each crop covers the area it is made in, so that the next border points inside it are skipped.
+
+        Returns
+        -------
+        locations : np.ndarray
+            Array of (N, 3) shape with the upper leftmost corner of each crop.
+        shapes : np.ndarray
+            Array of (N, 3) shape with the shape of each crop.
+        orders : np.ndarray
+            Array of (N, 3) shape with axes order of each crop.
+        """
+        points, self.pending = self.pending, np.zeros((0, 2), dtype=np.int64)
+        return gen_crop_coordinates_batch(points, self.full_matrix, self.geometry.zero_traces,
+                                          self.stride, self.crop_shape, self.geometry.depth, Horizon.FILL_VALUE,
+                                          zeros_threshold=self.zeros_threshold, empty_threshold=self.empty_threshold,
+                                          safe_stripe=self.safe_stripe, num_points=self.num_points,
+                                          coverage=self.coverage)
+
+
+    def merge(self, horizons, mean_threshold=5.5):
+        """ Merge predicted horizons into the current one, if they are overlapping and close enough to it.
+        Depths are averaged on overlap, same as in :meth:`.Horizon.overlap_merge`.
+
+        Returns
+        -------
+        int
+            Number of added points.
+        """
+        changed = []
+        n_added = 0
+        for horizon in horizons:
+            window = self.full_matrix[horizon.i_min:horizon.i_max + 1, horizon.x_min:horizon.x_max + 1]
+            matrix = horizon.matrix
+            present, other_present = window != Horizon.FILL_VALUE, matrix != Horizon.FILL_VALUE
+
+            both = present & other_present
+            if not both.any() or np.mean(np.abs(window[both] - matrix[both])) >= mean_threshold:
+                continue
+
+            added = ~present & other_present
+            averaged = (window[both] + matrix[both]) // 2
+            moved = both.copy()
+            moved[both] = averaged != window[both]
+
+            window[both] = averaged
+            window[added] = matrix[added]
+
+            shift = np.array([horizon.i_min, horizon.x_min])
+            added_points = np.stack(np.nonzero(added), axis=1) + shift
+            _update_boundaries(self.full_matrix, self.boundaries, added_points, Horizon.FILL_VALUE)
+            changed.extend([added_points, np.stack(np.nonzero(moved), axis=1) + shift])
+            n_added += len(added_points)
+
+            self.i_min, self.i_max = min(self.i_min, horizon.i_min), max(self.i_max, horizon.i_max)
+            self.x_min, self.x_max = min(self.x_min, horizon.x_min), max(self.x_max, horizon.x_max)
+
+        self.length += n_added
+        if changed:
+            self.invalidate(np.concatenate(changed))
+        return n_added
+
+    def invalidate(self, points):
+        """ Reset coverage in blocks of `reach` size around changed `points`, and mark border points there as pending.
+        Any crop that can contain a changed point is made from a border point in these blocks.
+        """
+        reach = self.reach
+        grid_shape = -(-np.array(self.full_matrix.shape) // reach)
+        dirty = np.zeros(grid_shape, dtype=bool)
+        blocks = np.unique(points // reach, axis=0)
+        for shift_i in (-1, 0, 1):
+            for shift_x in (-1, 0, 1):
+                shifted = np.clip(blocks + np.array([shift_i, shift_x]), 0, grid_shape - 1)
+                dirty[shifted[:, 0], shifted[:, 1]] = True
+
+        pending = [self.pending]
+        for block_i, block_x in zip(*np.nonzero(dirty)):
+            region = (slice(block_i * reach, (block_i + 1) * reach), slice(block_x * reach, (block_x + 1) * reach))
+            self.coverage[region] = False
+            pending.append(np.stack(np.nonzero(self.boundaries[region]), axis=1) + [block_i * reach, block_x * reach])
+        self.pending = np.unique(np.concatenate(pending).astype(np.int64), axis=0)
+
+
+
+@njit
+def _update_boundaries(matrix, boundaries, points, fill_value):
+    """ Re-compute border status of points in 3x3 neighbourhood of each of the `points`. """
+    ilines_len, xlines_len = matrix.shape
+    for point in points:
+        for i in range(point[0] - 1, point[0] + 2):
+            for x in range(point[1] - 1, point[1] + 2):
+                if 0 <= i < ilines_len and 0 <= x < xlines_len:
+                    boundaries[i, x] = matrix[i, x] != fill_value and _is_border(matrix, i, x, fill_value)
+
+@njit
+def _is_border(matrix, i, x, fill_value):
+    """ A point is on the border, if any of its neighbours is absent or outside of the cube. """
+    ilines_len, xlines_len = matrix.shape
+    for i_ in range(i - 1, i + 2):
+        for x_ in range(x - 1, x + 2):
+            if i_ < 0 or x_ < 0 or i_ >= ilines_len or x_ >= xlines_len or matrix[i_, x_] == fill_value:
+                return True
+    return False
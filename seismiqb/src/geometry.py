@@ -2,10 +2,14 @@
 import os
 import sys
 import shutil
+import weakref
 import itertools
 
+from collections import deque, defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import get_context
+from threading import local
 from textwrap import dedent
-from random import random
 from itertools import product
 from tqdm.auto import tqdm
 
@@ -16,8 +20,9 @@ import segyio
 import cv2
 from scipy.ndimage import zoom
 
-from .utils import lru_cache, find_min_max, file_print, \
-                   SafeIO, attr_filter, make_axis_grid, infer_tuple
+from .utils import lru_cache, find_strided_runs, ibm_to_ieee, compute_trace_stats, update_reservoir, \
+                   file_print, SafeIO, attr_filter, make_axis_grid, infer_tuple, gather_windows, DiskCache, \
+                   MemoryBudget
 from .plotters import plot_image
 
 
@@ -102,7 +107,8 @@ class SeismicGeometry:
 
         - `load_slide` (2D entity) or `load_crop` (3D entity) methods to load data from the cube.
           Load slides takes a number of slide and axis to cut along; makes use of `lru_cache` to work
-          faster for subsequent loads. Cache is bound for each instance.
+          faster for subsequent loads. Cache is bound for each instance, unless a `cache_budget` is shared between them.
+          With `shared_cache`, loaded slides are stored in shared memory and reused by all of the worker processes.
           Load crops works off of complete location specification (3D slice).
 
         - `quality_map` attribute is a spatial matrix that estimates cube hardness;
@@ -114,6 +120,9 @@ class SeismicGeometry:
     Refer to the documentation of respective classes to learn more about their structure, attributes and methods.
     """
     #TODO: add separate class for cube-like labels
+    # Default type of workers in `load_crops`: formats, that allow concurrent reads, use threads
+    EXECUTOR = 'threads'
+
     SEGY_ALIASES = ['sgy', 'segy', 'seg']
     HDF5_ALIASES = ['hdf5', 'h5py']
     NPZ_ALIASES = ['npz']
@@ -131,6 +140,9 @@ class SeismicGeometry:
         'trace_container', 'min_matrix', 'max_matrix', 'mean_matrix', 'std_matrix', 'hist_matrix',
     ]
 
+    # Attributes, stored in chunks of traces, so that they can be loaded by parts with `load_meta_slice`
+    PRESERVED_SLICED = ['hist_matrix']
+
     # Headers to load from SEG-Y cube
     HEADERS_PRE_FULL = ['FieldRecord', 'TraceNumber', 'TRACE_SEQUENCE_FILE', 'CDP', 'CDP_TRACE', 'offset', ]
     HEADERS_POST_FULL = ['INLINE_3D', 'CROSSLINE_3D', 'CDP_X', 'CDP_Y']
@@ -174,6 +186,15 @@ class SeismicGeometry:
         self.path_meta = None
         self.loaded = []
         self.has_stats = False
+
+        # Shared limit on the total size of cached slides: set by `SeismicCubeset.set_cache_budget`
+        self.cache_budget = None
+        # Slide storage, shared between processes: set by `SeismicCubeset.set_shared_cache`
+        self.shared_cache = None
+        # Persistent storage of horizon attributes and metrics: set by `set_disk_cache`
+        self.disk_cache = None
+        # Pool of workers to load crops with, kept between calls of `load_crops`
+        self.executor, self.executor_params, self._executor_finalizer = None, None, None
         if process:
             self.process(**kwargs)
 
@@ -198,7 +219,13 @@ class SeismicGeometry:
             for attr in self.PRESERVED + self.PRESERVED_LAZY:
                 try:
                     if hasattr(self, attr) and getattr(self, attr) is not None:
-                        file_meta['/info/' + attr] = getattr(self, attr)
+                        value = getattr(self, attr)
+                        if attr in self.PRESERVED_SLICED:
+                            value = np.asarray(value, dtype=np.float32)
+                            chunks = (min(64, value.shape[0]), min(64, value.shape[1]), value.shape[2])
+                            file_meta.create_dataset('/info/' + attr, data=value, chunks=chunks)
+                        else:
+                            file_meta['/info/' + attr] = value
                 except ValueError:
                     # Raised when you try to store post-stack descriptors for pre-stack cube
                     pass
@@ -227,6 +254,16 @@ class SeismicGeometry:
             except KeyError:
                 return None
 
+    def load_meta_slice(self, item, locations):
+        """ Load part of an item at `locations` from stored meta without loading the whole item.
+        If the item is already in memory, it is sliced instead.
+        """
+        locations = tuple(locations)
+        if item in self.__dict__:
+            return self.__dict__[item][locations]
+        with h5py.File(self.path_meta, "r") as file_meta:
+            return file_meta['/info/' + item][locations]
+
     def __getattr__(self, key):
         """ Load item from stored meta, if needed. """
         if key in self.PRESERVED_LAZY and self.path_meta is not None and key not in self.__dict__:
@@ -280,6 +317,193 @@ class SeismicGeometry:
         return locations
 
 
+    def load_crops(self, locations, n_workers=1, executor=None, **kwargs):
+        """ Load multiple crops from the cube. If all of them have the same shape, they are stacked into one array.
+
+        Parameters
+        ----------
+        locations : sequence
+            Locations of crops, each is a sequence of slices along the first index, the second, and depth.
+        n_workers : int
+            Number of workers to load crops with. Crops are split into groups of neighbouring ones,
+            so that data, shared between crops, is still read only once inside each of the groups.
+        executor : 'threads', 'processes' or None
+            Type of workers. If None, then `EXECUTOR` of the class is used.
+            Workers of each type are kept between calls: use :meth:`.shutdown_executor` to release them.
+        kwargs : dict
+            Other parameters of loading, passed directly to the `load_crop` method.
+        """
+        if n_workers <= 1 or len(locations) <= 1:
+            return self._load_crops(locations, **kwargs)
+        buffer = kwargs.pop('buffer', None)
+
+        # Neighbouring crops are loaded by the same worker
+        order = sorted(range(len(locations)), key=lambda i: tuple(slc.start for slc in locations[i]))
+        groups = [group for group in np.array_split(order, n_workers) if len(group)]
+
+        executor = self.get_executor(n_workers=n_workers, executor=executor)
+        function = self._load_crops if isinstance(executor, ThreadPoolExecutor) else _load_crops_in_worker
+        futures = [executor.submit(function, [locations[i] for i in group], **kwargs) for group in groups]
+
+        crops = [None] * len(locations)
+        for group, future in zip(groups, futures):
+            for i, crop in zip(group, future.result()):
+                crops[i] = crop
+
+        if buffer is not None:
+            for i, crop in enumerate(crops):
+                buffer[i][...] = crop
+            return buffer
+        if len({crop.shape for crop in crops}) == 1:
+            return np.stack(crops)
+        return crops
+
+    def _load_crops(self, locations, **kwargs):
+        """ Load multiple crops in the current thread. Subclasses may override it to read data,
+        shared between crops, only once.
+        """
+        crops = [self.load_crop(location, **kwargs) for location in locations]
+        if len({crop.shape for crop in crops}) == 1:
+            return np.stack(crops)
+        return crops
+
+    def get_executor(self, n_workers, executor=None):
+        """ Pool of workers to load crops with. Created on the first call, and re-created if parameters change.
+
+        Threads share this instance, its caches and opened files. Each of the processes opens the cube on its own,
+        restoring already inferred structure of the cube from `worker_state`, and uses the same `shared_cache`.
+        The `cache_budget` is split evenly between processes. Workers are re-created if cache settings change,
+        and stopped, when the instance is garbage collected or its cache is reset.
+        """
+        executor = executor or self.EXECUTOR
+        params = (n_workers, executor, self.shared_cache, self.cache_budget)
+        if self.executor_params != params:
+            self.shutdown_executor()
+
+            if executor == 'threads':
+                self.executor = ThreadPoolExecutor(max_workers=n_workers)
+            elif executor == 'processes':
+                budget = self.cache_budget.maxbytes / n_workers if self.cache_budget is not None else None
+                self.executor = ProcessPoolExecutor(max_workers=n_workers, mp_context=get_context('spawn'),
+                                                   initializer=_init_crop_loader,
+                                                   initargs=(self.path, self.worker_state, self.shared_cache, budget))
+            else:
+                raise ValueError(f'Unknown executor {executor}, use either `threads` or `processes`.')
+            self.executor_params = params
+            self._executor_finalizer = weakref.finalize(self, self.executor.shutdown)
+        return self.executor
+
+    def shutdown_executor(self):
+        """ Stop workers, used to load crops. """
+        if self._executor_finalizer is not None:
+            self._executor_finalizer()
+        self.executor, self.executor_params, self._executor_finalizer = None, None, None
+
+    @property
+    def worker_state(self):
+        """ Inferred structure of the cube to restore in worker processes by :meth:`.restore_worker_state`.
+        If None, then workers process the cube on their own.
+        """
+        return None
+
+
+    # Data along horizons
+    def load_horizons_values(self, horizons, window=23, offset=0, chunk_size=128, compact=False):
+        """ Get values from the cube along multiple horizons in one pass over the cube.
+
+        Windows of all the horizons are split into spatial tiles, aligned to the chunks of the stored cube.
+        Inside each tile, overlapping or close windows are merged into runs along depth, and each run is read only once
+        for all of the horizons, that intersect it. Therefore, total amount of data read is bounded by the cube size,
+        regardless of the number of horizons.
+
+        Parameters
+        ----------
+        horizons : sequence of :class:`.Horizon`
+            Horizons to get values along.
+        window : int or sequence of ints
+            Width of data to cut for all or each of the horizons.
+        offset : int or sequence of ints
+            Value to add to heights of all or each of the horizons.
+        chunk_size : int
+            Spatial size of tiles of traces processed at a time.
+        compact : bool
+            If True, then arrays of (n_points, window) shape are returned, with rows in the order of horizon points.
+            Otherwise, values are put into arrays of (cube_ilines, cube_xlines, window) shape.
+
+        Returns
+        -------
+        list of np.ndarrays
+            Values along each of the horizons. Values on zero traces are replaced with nans.
+        """
+        #pylint: disable=too-many-locals
+        windows = list(window) if isinstance(window, (tuple, list, np.ndarray)) else [window] * len(horizons)
+        offsets = list(offset) if isinstance(offset, (tuple, list, np.ndarray)) else [offset] * len(horizons)
+
+        # Window starts of all the horizons, along with the horizon index and the row of its output
+        results, outputs, starts, rows, owners = [], [], [], [], []
+        for i, (horizon, window_, offset_) in enumerate(zip(horizons, windows, offsets)):
+            points = horizon.points.astype(np.int64)
+            starts_ = points.copy()
+            starts_[:, 2] += offset_ - window_ // 2
+
+            if compact:
+                result = np.zeros((len(points), window_), dtype=np.float32)
+                rows.append(np.arange(len(points)))
+            else:
+                result = np.zeros((self.ilines_len, self.xlines_len, window_), dtype=np.float32)
+                rows.append(points[:, 0] * self.xlines_len + points[:, 1])
+            results.append(result)
+            outputs.append(result.reshape(-1, window_))
+            starts.append(starts_)
+            owners.append(np.full(len(points), i))
+
+        starts, rows, owners = np.concatenate(starts), np.concatenate(rows), np.concatenate(owners)
+        ends = starts[:, 2] + np.array(windows)[owners]
+        gap = max(windows)
+
+        # Split points into tiles, and sort them by depth inside each tile
+        tile_shape = np.maximum(np.ceil(chunk_size / self.spatial_chunks), 1).astype(np.int64) * self.spatial_chunks
+        tiles = starts[:, 0] // tile_shape[0] * (self.xlines_len // tile_shape[1] + 1) + starts[:, 1] // tile_shape[1]
+        order = np.lexsort((starts[:, 2], tiles))
+        bounds = np.nonzero(np.diff(tiles[order]))[0] + 1
+
+        for group in np.split(order, bounds):
+            if len(group) == 0:
+                continue
+
+            # Runs of windows along depth: a new run starts after a gap in coverage
+            reached = np.maximum.accumulate(ends[group])
+            breaks = np.nonzero(starts[group[1:], 2] > reached[:-1] + gap)[0] + 1
+
+            for run in np.split(group, breaks):
+                run_starts = starts[run]
+                mins, maxs = run_starts.min(axis=0), run_starts.max(axis=0)
+                h_start, h_end = max(mins[2], 0), min(ends[run].max(), self.depth)
+                if h_start >= h_end:
+                    continue
+
+                location = [slice(mins[0], maxs[0] + 1), slice(mins[1], maxs[1] + 1), slice(h_start, h_end)]
+                data = self.load_crop(location, axis=0, mode='crop')
+                origin = np.array([mins[0], mins[1], h_start])
+
+                for i in np.unique(owners[run]):
+                    mask = owners[run] == i
+                    gather_windows(data, origin, run_starts[mask], rows[run][mask], outputs[i])
+
+        for horizon, result in zip(horizons, results):
+            if compact:
+                points = horizon.points.astype(np.int64)
+                result[self.zero_traces[points[:, 0], points[:, 1]] == 1] = np.nan
+            else:
+                result[self.zero_traces == 1] = np.nan
+        return results
+
+    @property
+    def spatial_chunks(self):
+        """ Spatial shape of chunks, that the cube is stored with. """
+        return np.array([1, 1])
+
+
     # Spatial matrices
     @lru_cache(100)
     def get_quantile_matrix(self, q):
@@ -361,33 +585,48 @@ class SeismicGeometry:
 
 
     # Instance introspection and visualization methods
+    @property
+    def cached_method(self):
+        """ Method that keeps loaded slides in cache. """
+        return self.load_slide if self.structured is False else self._cached_load
+
     def reset_cache(self):
-        """ Clear cached slides. """
-        if self.structured is False:
-            method = self.load_slide
-        else:
-            method = self._cached_load
-        method.reset(instance=self)
+        """ Clear cached slides. Also stops worker processes, that keep their own caches. """
+        self.cached_method.reset(instance=self)
+        self.shutdown_executor()
+
+    def set_disk_cache(self, gigabytes=10, path=None):
+        """ Store attributes and metrics of horizons on this cube on disk, so that they are computed only once
+        and reused by other runs. Values are keyed by horizon data, path and modification time of the cube,
+        name of the method and its arguments: see :class:`.DiskCache`.
+
+        Parameters
+        ----------
+        gigabytes : number or None
+            Maximum total size of stored values. If None, then disk cache is disabled.
+        path : str, optional
+            Directory to store values in. By default, `<cube name>_cache` directory next to the cube.
+        """
+        if gigabytes is None:
+            self.disk_cache = None
+            return
+        path = path or os.path.join(os.path.dirname(self.path), f'{self.short_name}_cache')
+        self.disk_cache = DiskCache(path, maxbytes=gigabytes * 1024 ** 3)
 
     @property
     def cache_length(self):
         """ Total amount of cached slides. """
-        if self.structured is False:
-            method = self.load_slide
-        else:
-            method = self._cached_load
-
-        return len(method.cache()[self])
+        return len(self.cached_method.cache()[self])
 
     @property
     def cache_size(self):
-        """ Total size of cached slides. """
-        if self.structured is False:
-            method = self.load_slide
-        else:
-            method = self._cached_load
+        """ Total size of cached slides in gigabytes. """
+        return self.cached_method.stats()[self]['nbytes'] / (1024 ** 3)
 
-        return sum(item.nbytes / (1024 ** 3) for item in method.cache()[self].values())
+    @property
+    def cache_stats(self):
+        """ Amount of hits, misses and evictions, as well as total size in bytes of cached slides. """
+        return dict(self.cached_method.stats()[self])
 
     @property
     def nbytes(self):
@@ -397,7 +636,8 @@ class SeismicGeometry:
             *[attr for attr in self.__dict__
               if 'matrix' in attr or '_quality' in attr],
         ]
-        return sum(sys.getsizeof(getattr(self, attr)) for attr in attrs if hasattr(self, attr)) + self.cache_size
+        return (sum(sys.getsizeof(getattr(self, attr)) for attr in attrs if hasattr(self, attr))
+                + self.cached_method.stats()[self]['nbytes'])
 
     @property
     def ngbytes(self):
@@ -743,12 +983,21 @@ class SeismicGeometrySEGY(SeismicGeometry):
     One can add stats to the instance by calling `collect_stats` method, that makes a full pass through
     the cube in order to analyze distribution of amplitudes. It also collects a number of trace examples
     into `trace_container` attribute, that can be used for later evaluation of various statistics.
+
+    If `use_memmap` is passed to the initialization and the cube is a regular post-stack one, then the whole
+    file is viewed as a (ilines, xlines, depth) `memmap` array, and data loading becomes plain slicing of it.
     """
     #pylint: disable=attribute-defined-outside-init, too-many-instance-attributes
+    # Sample formats that can be viewed with `numpy`: format code to dtype
+    MEMMAP_FORMATS = {1: 'u4', 2: 'i4', 3: 'i2', 5: 'f4', 6: 'f8', 8: 'i1', 10: 'u4', 11: 'u2', 16: 'u1'}
+    # File handles of `segyio` can't be used from multiple threads
+    EXECUTOR = 'processes'
+
     def __init__(self, path, headers=None, index_headers=None, **kwargs):
         self.structured = False
         self.dataframe = None
         self.segyfile = None
+        self.memmap = None
 
         self.headers = headers or self.HEADERS_POST
         self.index_headers = index_headers or self.INDEX_POST
@@ -757,15 +1006,19 @@ class SeismicGeometrySEGY(SeismicGeometry):
 
 
     # Methods of inferring dataframe and amplitude stats
-    def process(self, collect_stats=False, recollect=False, **kwargs):
-        """ Create dataframe based on `segy` file headers. """
-        # Note that all the `segyio` structure inference is disabled
-        self.segyfile = SafeIO(self.path, opener=segyio.open, mode='r', strict=False, ignore_geometry=True)
-        self.segyfile.mmap()
+    def process(self, collect_stats=False, recollect=False, use_memmap=False, **kwargs):
+        """ Create dataframe based on `segy` file headers.
 
-        self.depth = len(self.segyfile.trace[0])
-        self.delay = self.segyfile.header[0].get(segyio.TraceField.DelayRecordingTime)
-        self.sample_rate = segyio.dt(self.segyfile) / 1000
+        Parameters
+        ----------
+        collect_stats : bool
+            Whether to make a pass through the cube to collect amplitude stats, if they are not stored already.
+        recollect : bool
+            Whether to collect stats even if they are already stored.
+        use_memmap : bool
+            Whether to try to view the whole cube as `memmap` array. Irregular cubes fall back to the trace reader.
+        """
+        self.open_file()
 
         # Load all the headers
         dataframe = {}
@@ -778,6 +1031,8 @@ class SeismicGeometrySEGY(SeismicGeometry):
         self.dataframe = dataframe.set_index(self.index_headers)
 
         self.add_attributes()
+        if use_memmap:
+            self.make_memmap()
 
         # Create a matrix with ones at fully-zeroes traces
         if self.index_headers == self.INDEX_POST:
@@ -800,6 +1055,16 @@ class SeismicGeometrySEGY(SeismicGeometry):
         self.segy_text = [self.segyfile.text[i] for i in range(1 + self.segyfile.ext_headers)]
         self.add_rotation_matrix()
 
+    def open_file(self):
+        """ Open the SEG-Y file and infer file-wide info: `depth`, `delay` and `sample_rate`. """
+        # Note that all the `segyio` structure inference is disabled
+        self.segyfile = SafeIO(self.path, opener=segyio.open, mode='r', strict=False, ignore_geometry=True)
+        self.segyfile.mmap()
+
+        self.depth = len(self.segyfile.trace[0])
+        self.delay = self.segyfile.header[0].get(segyio.TraceField.DelayRecordingTime)
+        self.sample_rate = segyio.dt(self.segyfile) / 1000
+
     def add_attributes(self):
         """ Infer info about curent index from `dataframe` attribute. """
         self.index_len = len(self.index_headers)
@@ -819,17 +1084,75 @@ class SeismicGeometrySEGY(SeismicGeometry):
 
         self.cube_shape = np.asarray([*self.lens, self.depth])
 
-    def collect_stats(self, spatial=True, bins=25, num_keep=5000, **kwargs):
+    def make_trace_positions(self):
+        """ Positions of traces in the spatial grid of the current index.
+
+        Returns
+        -------
+        ndarray
+            Array of (num_traces, index_len) shape, where i-th row contains position of the trace with index i.
+        """
+        trace_index = self.dataframe['trace_index'].values
+        positions = np.zeros((len(trace_index), self.index_len), dtype=np.int64)
+        for i in range(self.index_len):
+            positions[trace_index, i] = np.searchsorted(self.uniques[i],
+                                                        self.dataframe.index.get_level_values(i).values)
+        return positions
+
+    def make_trace_index_matrix(self):
+        """ Spatial matrix with trace index at each position of the current 2D index and `np.nan` at missing ones. """
+        positions = self.make_trace_positions()
+        matrix = np.full(self.lens, np.nan)
+        matrix[positions[:, 0], positions[:, 1]] = np.arange(len(positions))
+        return matrix
+
+    def make_memmap(self):
+        """ Create `memmap` attribute: view of the whole cube as (ilines, xlines, depth) array, mapped directly
+        onto the SEG-Y file with trace headers skipped by strides. No data is read at this point.
+        Works only for cubes with post-stack index, sorted by ilines and then by xlines, without missing traces.
+
+        Returns
+        -------
+        bool
+            Whether the view was created.
+        """
+        self.memmap = None
+        sample_format = int(self.segyfile.format)
+        if self.index_headers != self.INDEX_POST or sample_format not in self.MEMMAP_FORMATS:
+            return False
+
+        # Position of each trace in the file must be exactly `iline_position * xlines_len + xline_position`
+        positions = self.make_trace_positions()
+        if len(positions) != np.prod(self.lens) or \
+           not np.array_equal(positions[:, 0] * self.lens[1] + positions[:, 1], np.arange(len(positions))):
+            return False
+
+        byteorder = '>' if self.segyfile.endian == 'big' else '<'
+        trace_dtype = np.dtype([('header', 'V240'),
+                                ('data', byteorder + self.MEMMAP_FORMATS[sample_format], self.depth)])
+        offset = 3600 + 3200 * self.segyfile.ext_headers
+        if os.path.getsize(self.path) != offset + trace_dtype.itemsize * len(self.dataframe):
+            return False
+
+        memmap = np.memmap(self.path, dtype=trace_dtype, mode='r', offset=offset, shape=tuple(self.lens))
+        self.memmap = memmap['data']
+        self.memmap_ibm = sample_format == 1
+        return True
+
+    def collect_stats(self, spatial=True, bins=25, num_keep=5000, block_size=10000, **kwargs):
         """ Pass through file data to collect stats:
             - min/max values.
             - q01/q99 quantiles of amplitudes in the cube.
             - certain amount of traces are stored to `trace_container` attribute.
 
-        If `spatial` is True, makes an additional pass through the cube to obtain following:
+        If `spatial` is True, following stats are also stored:
             - min/max/mean/std for every trace - `min_matrix`, `max_matrix` and so on.
             - histogram of values for each trace: - `hist_matrix`.
             - bins for histogram creation: - `bins`.
 
+        Traces are read by blocks, and all of the stats are computed in one pass through the file.
+        Positions of traces are taken from the `dataframe`, so no headers are parsed.
+
         Parameters
         ----------
         spatial : bool
@@ -838,80 +1161,93 @@ class SeismicGeometrySEGY(SeismicGeometry):
             Number of bins or name of automatic algorithm of defining number of bins.
         num_keep : int
             Number of traces to store.
+        block_size : int
+            Number of traces to read at once.
         """
-        #pylint: disable=not-an-iterable
         _ = kwargs
+        num_traces = len(self.dataframe)
+        bins = self.make_provisional_bins(bins, num_keep)
 
-        num_traces = len(self.segyfile.header)
-
-        # Get min/max values, store some of the traces
-        trace_container = []
         value_min, value_max = np.inf, -np.inf
+        reservoir, seen = np.empty((num_keep, self.depth), dtype=self.segyfile.dtype), 0
+        if spatial:
+            positions = self.make_trace_positions()
+            matrices = self.make_stats_matrices(len(bins) - 1)
 
-        for i in tqdm(range(num_traces), desc='Finding min/max', ncols=1000):
-            trace = self.segyfile.trace[i]
+        description = f'Collecting stats for {self.name}'
+        for start in tqdm(range(0, num_traces, block_size), desc=description, ncols=1000):
+            stop = min(start + block_size, num_traces)
+            traces = self.load_traces(np.arange(start, stop))
+            stats = compute_trace_stats(traces, bins)
 
-            trace_min, trace_max = find_min_max(trace)
-            if trace_min < value_min:
-                value_min = trace_min
-            if trace_max > value_max:
-                value_max = trace_max
+            mins, maxs = stats[:2]
+            value_min, value_max = min(value_min, mins.min()), max(value_max, maxs.max())
+            seen = update_reservoir(reservoir, seen, traces[mins != maxs])
 
-            if random() < (num_keep / num_traces) and trace_min != trace_max:
-                trace_container.extend(trace.tolist())
-                #TODO: add dtype for storing
+            if spatial:
+                self.put_trace_stats(matrices, tuple(positions[start:stop].T), stats)
 
-        # Collect more spatial stats: min, max, mean, std, histograms matrices
+        bins[0], bins[-1] = min(bins[0], value_min), max(bins[-1], value_max)
         if spatial:
-            # Make bins
-            bins = np.histogram_bin_edges(None, bins, range=(value_min, value_max)).astype(np.float)
-            self.bins = bins
-
-            # Create containers
-            min_matrix, max_matrix = np.full(self.lens, np.nan), np.full(self.lens, np.nan)
-            hist_matrix = np.full((*self.lens, len(bins)-1), np.nan)
-
-            # Iterate over traces
-            description = f'Collecting stats for {self.name}'
-            for i in tqdm(range(num_traces), desc=description, ncols=1000):
-                trace = self.segyfile.trace[i]
-                header = self.segyfile.header[i]
-
-                # i -> id in a dataframe
-                keys = [header.get(field) for field in self.byte_no]
-                store_key = [self.uniques_inversed[j][item] for j, item in enumerate(keys)]
-                store_key = tuple(store_key)
-
-                # For each trace, we store an entire histogram of amplitudes
-                val_min, val_max = find_min_max(trace)
-                min_matrix[store_key] = val_min
-                max_matrix[store_key] = val_max
-
-                if val_min != val_max:
-                    histogram = np.histogram(trace, bins=bins)[0]
-                    hist_matrix[store_key] = histogram
-
-            # Restore stats from histogram
-            midpoints = (bins[1:] + bins[:-1]) / 2
-            probs = hist_matrix / np.sum(hist_matrix, axis=-1, keepdims=True)
-
-            mean_matrix = np.sum(probs * midpoints, axis=-1)
-            std_matrix = np.sqrt(np.sum((np.broadcast_to(midpoints, (*mean_matrix.shape, len(midpoints))) - \
-                                            mean_matrix.reshape(*mean_matrix.shape, 1))**2 * probs,
-                                        axis=-1))
-
-            # Store everything into instance
-            self.min_matrix, self.max_matrix = min_matrix, max_matrix
-            self.mean_matrix, self.std_matrix = mean_matrix, std_matrix
-            self.hist_matrix = hist_matrix
-            self.zero_traces = (min_matrix == max_matrix).astype(np.int)
-            self.zero_traces[np.isnan(min_matrix)] = 1
+            self.assign_spatial_stats(**matrices, bins=bins)
 
+        self.assign_stats(value_min, value_max, reservoir[:seen].ravel())
+        self.store_meta()
+
+    def make_provisional_bins(self, bins, num_keep=5000):
+        """ Make uniform histogram bins based on the range of values in a random sample of traces.
+        Allows to compute histograms in the same pass through the data as the actual range of values:
+        values outside of provisional bins are put into the edge ones, which are extended later.
+
+        Parameters
+        ----------
+        bins : int or str
+            Number of bins or name of automatic algorithm of defining number of bins.
+        num_keep : int
+            Number of traces to sample.
+        """
+        num_traces = len(self.dataframe)
+        sample_indices = np.sort(np.random.choice(num_traces, min(num_keep, num_traces), replace=False))
+        sample = self.load_traces(sample_indices)
+        return np.histogram_bin_edges(sample, bins, range=(sample.min(), sample.max())).astype(np.float)
+
+    def make_stats_matrices(self, n_bins):
+        """ Create containers for spatial stats, filled with `np.nan`. """
+        matrices = {name: np.full(self.lens, np.nan)
+                    for name in ['min_matrix', 'max_matrix', 'mean_matrix', 'std_matrix']}
+        matrices['hist_matrix'] = np.full((*self.lens, n_bins), np.nan, dtype=np.float32)
+        return matrices
+
+    @staticmethod
+    def put_trace_stats(matrices, key, stats):
+        """ Put stats, computed by :func:`.compute_trace_stats`, into spatial matrices at `key` positions.
+        Histograms, means and stds of constant traces are left as `np.nan`.
+        """
+        mins, maxs, means, stds, histograms = stats
+        mask = mins != maxs
+        masked_key = tuple(item[mask] for item in key)
+
+        matrices['min_matrix'][key] = mins
+        matrices['max_matrix'][key] = maxs
+        matrices['mean_matrix'][masked_key] = means[mask]
+        matrices['std_matrix'][masked_key] = stds[mask]
+        matrices['hist_matrix'][masked_key] = histograms[mask]
+
+    def assign_stats(self, value_min, value_max, trace_container):
+        """ Store amplitude stats into instance. """
         self.value_min, self.value_max = value_min, value_max
         self.trace_container = np.array(trace_container)
         self.q001, self.q01, self.q99, self.q999 = np.quantile(trace_container, [0.001, 0.01, 0.99, 0.999])
         self.has_stats = True
-        self.store_meta()
+
+    def assign_spatial_stats(self, min_matrix, max_matrix, mean_matrix, std_matrix, hist_matrix, bins):
+        """ Store spatial stats into instance. """
+        self.bins = bins
+        self.min_matrix, self.max_matrix = min_matrix, max_matrix
+        self.mean_matrix, self.std_matrix = mean_matrix, std_matrix
+        self.hist_matrix = hist_matrix
+        self.zero_traces = (min_matrix == max_matrix).astype(np.int)
+        self.zero_traces[np.isnan(min_matrix)] = 1
 
     def add_rotation_matrix(self):
         """ Add transform from INLINE/CROSSLINE corrdinates to CDP system. """
@@ -978,6 +1314,24 @@ class SeismicGeometrySEGY(SeismicGeometry):
         self.index_headers = index_headers
         self.add_attributes()
 
+        if self.memmap is not None:
+            self.make_memmap()
+
+    @property
+    def worker_state(self):
+        """ Headers and index of the cube, so that worker processes do not parse trace headers again. """
+        return {'headers': self.headers, 'index_headers': self.index_headers, 'dataframe': self.dataframe,
+                'use_memmap': self.memmap is not None}
+
+    def restore_worker_state(self, state):
+        """ Open the file and infer index attributes from the dataframe, built by the main process. """
+        self.headers, self.index_headers = state['headers'], state['index_headers']
+        self.dataframe = state['dataframe']
+        self.open_file()
+        self.add_attributes()
+        if state['use_memmap']:
+            self.make_memmap()
+
     # Methods to load actual data from SEG-Y
     def load_trace(self, index):
         """ Load individual trace from segyfile.
@@ -987,9 +1341,54 @@ class SeismicGeometrySEGY(SeismicGeometry):
             return self.segyfile.trace.raw[int(index)]
         return self._zero_trace
 
-    def load_traces(self, trace_indices):
-        """ Stack multiple traces together. """
-        return np.stack([self.load_trace(idx) for idx in trace_indices])
+    def load_traces(self, trace_indices, heights=None, buffer=None):
+        """ Load multiple traces at once.
+        Consecutive indices with the same step are coalesced into one strided read from the mmapped file;
+        `np.nan` indices are filled with zeros.
+
+        Parameters
+        ----------
+        trace_indices : sequence of numbers
+            Indices of traces to load. Can contain `np.nan` for missing traces.
+        heights : slice, optional
+            Range of samples to load from each trace. By default, whole traces are loaded.
+        buffer : ndarray, optional
+            Preallocated array of (len(trace_indices), n_samples) shape to put traces into.
+        """
+        trace_indices = np.asarray(trace_indices)
+        start, stop, step = (heights or slice(None)).indices(self.depth)
+        n_samples = len(range(start, stop, step))
+
+        dtype = self.segyfile.dtype
+        if buffer is None:
+            buffer = np.empty((len(trace_indices), n_samples), dtype=dtype)
+
+        if np.issubdtype(trace_indices.dtype, np.floating):
+            mask = np.isnan(trace_indices)
+            buffer[mask] = 0
+            positions = np.nonzero(~mask)[0]
+            trace_indices = trace_indices[positions].astype(np.int64)
+        else:
+            positions = np.arange(len(trace_indices))
+            trace_indices = trace_indices.astype(np.int64)
+
+        direct = buffer.flags.c_contiguous and buffer.dtype == dtype
+        filehandle = self.segyfile.trace.filehandle
+
+        for position, length, trace_step in find_strided_runs(trace_indices):
+            # Rows of the buffer for the current run: if they are contiguous, read directly into them
+            rows = positions[position : position + length]
+            first = rows[0]
+
+            if direct and rows[-1] - first == length - 1:
+                filehandle.gettr(buffer[first : first + length], trace_indices[position], trace_step, length,
+                                 start, stop, step, n_samples)
+            else:
+                chunk = np.empty((length, n_samples), dtype=dtype)
+                filehandle.gettr(chunk, trace_indices[position], trace_step, length,
+                                 start, stop, step, n_samples)
+                buffer[rows] = chunk
+        return buffer
 
 
     @lru_cache(128, attributes='index_headers')
@@ -1006,11 +1405,18 @@ class SeismicGeometrySEGY(SeismicGeometry):
         axis : int
             Number of axis to load slide along.
         start, end, step : ints
-            Parameters of slice loading for 1D index.
+            Parameters of slice loading for 1D index. Can't be used with `memmap`, as it is made for 2D index only.
         stable : bool
             Whether or not to use the same sorting order as in the segyfile.
+            Has no effect with `memmap`: traces of such cubes are already sorted.
         """
-        if axis in [0, 1]:
+        if self.memmap is not None:
+            if start is not None or end is not None or step != 1:
+                raise ValueError('`start`, `end` and `step` are used for 1D index only and are not supported '
+                                 'for cubes, viewed as `memmap`.')
+            locations = self.make_slide_locations(loc, axis=axis)
+            slide = self._load_memmap(locations).squeeze(axis=axis)
+        elif axis in [0, 1]:
             indices = self.make_slide_indices(loc=loc, start=start, end=end, step=step, axis=axis, stable=stable)
             slide = self.load_traces(indices)
         elif axis == 2:
@@ -1084,6 +1490,13 @@ class SeismicGeometrySEGY(SeismicGeometry):
         return indices
 
 
+    def _load_memmap(self, locations):
+        """ Slice `memmap` view of the cube and convert the result to the dtype of loaded traces. """
+        crop = self.memmap[locations[0], locations[1], locations[2]]
+        if self.memmap_ibm:
+            return ibm_to_ieee(crop)
+        return crop.astype(self.segyfile.dtype)
+
     def _load_crop(self, locations):
         """ Load 3D crop from the cube.
 
@@ -1100,7 +1513,7 @@ class SeismicGeometrySEGY(SeismicGeometry):
         """
         shape = np.array([(slc.stop - slc.start) for slc in locations])
         indices = self.make_crop_indices(locations)
-        crop = self.load_traces(indices)[..., locations[-1]].reshape(shape)
+        crop = self.load_traces(indices, heights=locations[-1]).reshape(shape)
         return crop
 
     def make_crop_indices(self, locations):
@@ -1123,6 +1536,9 @@ class SeismicGeometrySEGY(SeismicGeometry):
             Upper bound for amount of slides to load. Used only in `adaptive` mode.
         """
         _ = kwargs
+        if self.memmap is not None:
+            return self._load_memmap(locations)
+
         shape = np.array([(slc.stop - slc.start) for slc in locations])
         axis = np.argmin(shape)
         if mode == 'adaptive':
@@ -1170,8 +1586,11 @@ class SeismicGeometrySEGY(SeismicGeometry):
         return crop
 
     # Convert SEG-Y to HDF5
-    def make_hdf5(self, path_hdf5=None, postfix='', unsafe=True):
-        """ Converts `.segy` cube to `.hdf5` format.
+    def make_hdf5(self, path_hdf5=None, postfix='', unsafe=True, chunk_shape=(1, 64, 64), compression=None,
+                  block_size=64, n_workers=1, bins=25, num_keep=5000):
+        """ Converts `.segy` cube to `.hdf5` format in one pass through the file.
+        The cube is read by blocks of ilines, that are used to fill all of the projections.
+        If the instance has no stats yet, they are collected from the same blocks.
 
         Parameters
         ----------
@@ -1179,6 +1598,19 @@ class SeismicGeometrySEGY(SeismicGeometry):
             Path to store converted cube. By default, new cube is stored right next to original.
         postfix : str
             Postfix to add to the name of resulting cube.
+        chunk_shape : sequence of ints or None
+            Shape of chunks for each of the projections, in the order of its axes: the first one is
+            the axis to take slides along. If None, datasets are stored contiguously.
+        compression : str or None
+            Compression filter for datasets, for example, `lzf` or `gzip`.
+        block_size : int
+            Number of ilines to process at once.
+        n_workers : int
+            Number of processes to read blocks with.
+        bins : int
+            Number of histogram bins to use for stats collection.
+        num_keep : int
+            Number of traces to store in `trace_container` during stats collection.
         """
         if self.index_headers != self.INDEX_POST and not unsafe:
             # Currently supports only INLINE/CROSSLINE cubes
@@ -1190,38 +1622,116 @@ class SeismicGeometrySEGY(SeismicGeometry):
         if os.path.exists(path_hdf5):
             os.remove(path_hdf5)
 
+        index_matrix = self.make_trace_index_matrix()
+        collect_stats = not self.has_stats
+
+        if collect_stats:
+            bins = self.make_provisional_bins(bins, num_keep)
+            matrices = self.make_stats_matrices(len(bins) - 1)
+            reservoir, seen = np.empty((num_keep, self.depth), dtype=self.segyfile.dtype), 0
+        else:
+            bins = None
+
         # Create file and datasets inside
         with h5py.File(path_hdf5, "a") as file_hdf5:
-            cube_hdf5 = file_hdf5.create_dataset('cube', self.cube_shape)
-            cube_hdf5_x = file_hdf5.create_dataset('cube_x', self.cube_shape[[1, 2, 0]])
-            cube_hdf5_h = file_hdf5.create_dataset('cube_h', self.cube_shape[[2, 0, 1]])
-
-            # Default projection (ilines, xlines, depth) and depth-projection (depth, ilines, xlines)
-            pbar = tqdm(total=self.cube_shape[0] + self.cube_shape[1], ncols=1000)
-
-            pbar.set_description(f'Converting {self.long_name}; ilines projection')
-            for i in range(self.cube_shape[0]):
-                slide = self.load_slide(i, stable=False)
-                cube_hdf5[i, :, :] = slide.reshape(1, self.cube_shape[1], self.cube_shape[2])
-                cube_hdf5_h[:, i, :] = slide.T
-                pbar.update()
-
-            # xline-oriented projection: (xlines, depth, ilines)
-            pbar.set_description(f'Converting {self.long_name} to hdf5; xlines projection')
-            for x in range(self.cube_shape[1]):
-                slide = self.load_slide(x, axis=1, stable=False).T
-                cube_hdf5_x[x, :, :,] = slide
-                pbar.update()
-            pbar.close()
-
-        if not self.has_stats:
-            self.collect_stats()
+            projections = {'cube': [0, 1, 2], 'cube_x': [1, 2, 0], 'cube_h': [2, 0, 1]}
+            datasets = {}
+            for name, order in projections.items():
+                shape = self.cube_shape[order]
+                chunks = tuple(min(c, s) for c, s in zip(chunk_shape, shape)) if chunk_shape is not None else None
+                datasets[name] = file_hdf5.create_dataset(name, shape, chunks=chunks, compression=compression)
+
+            # Each block is used to fill all of the projections
+            block_ranges = [(start, min(start + block_size, self.cube_shape[0]))
+                            for start in range(0, self.cube_shape[0], block_size)]
+            blocks = self._iterate_blocks([index_matrix[start:stop].ravel() for start, stop in block_ranges],
+                                          n_workers=n_workers)
+
+            description = f'Converting {self.long_name} to hdf5'
+            for i, traces in tqdm(enumerate(blocks), total=len(block_ranges), desc=description, ncols=1000):
+                start, stop = block_ranges[i]
+                block = traces.reshape(stop - start, self.cube_shape[1], self.cube_shape[2])
+                datasets['cube'][start:stop, :, :] = block
+                datasets['cube_x'][:, :, start:stop] = block.transpose((1, 2, 0))
+                datasets['cube_h'][:, start:stop, :] = block.transpose((2, 0, 1))
+
+                if collect_stats:
+                    # Missing traces are not stored
+                    present = ~np.isnan(index_matrix[start:stop])
+                    rows, columns = np.nonzero(present)
+                    traces = traces[present.ravel()]
+                    stats = compute_trace_stats(traces, bins)
+
+                    self.put_trace_stats(matrices, (rows + start, columns), stats)
+                    seen = update_reservoir(reservoir, seen, traces[stats[0] != stats[1]])
+
+        if collect_stats:
+            value_min, value_max = np.nanmin(matrices['min_matrix']), np.nanmax(matrices['max_matrix'])
+            bins[0], bins[-1] = min(bins[0], value_min), max(bins[-1], value_max)
+            self.assign_spatial_stats(**matrices, bins=bins)
+            self.assign_stats(value_min, value_max, reservoir[:seen].ravel())
         self.store_meta()
 
+    def _iterate_blocks(self, blocks, n_workers=1):
+        """ Load traces for each of the sequences of trace indices in `blocks`, preserving their order.
+        If `n_workers` is bigger than one, blocks are spread across a process pool with a bounded
+        amount of simultaneously loaded ones.
+        """
+        if n_workers == 1:
+            for trace_indices in blocks:
+                yield self.load_traces(trace_indices)
+            return
+
+        # Workers are spawned, as forking a process with running threading layer of `numba` is unsafe
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=get_context('spawn'),
+                                 initializer=_init_block_loader, initargs=(self.path,)) as executor:
+            futures = deque()
+            for trace_indices in blocks:
+                futures.append(executor.submit(_load_block, trace_indices))
+                if len(futures) >= 2 * n_workers:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+
 
     # Convenient alias
     convert_to_hdf5 = make_hdf5
 
+
+# Helpers to load blocks of SEG-Y traces in worker processes
+_BLOCK_LOADER = None
+
+def _init_block_loader(path):
+    """ Open SEG-Y file in the worker process. No headers are parsed. """
+    global _BLOCK_LOADER #pylint: disable=global-statement
+    _BLOCK_LOADER = SeismicGeometry(path, process=False)
+    _BLOCK_LOADER.open_file()
+
+def _load_block(trace_indices):
+    """ Load block of traces in the worker process. """
+    return _BLOCK_LOADER.load_traces(trace_indices)
+
+
+# Helpers to load crops in worker processes
+_CROP_LOADER = None
+
+def _init_crop_loader(path, state, shared_cache, budget):
+    """ Open the cube in the worker process, restoring its `state` and cache settings from the main process. """
+    global _CROP_LOADER #pylint: disable=global-statement
+    if state is None:
+        _CROP_LOADER = SeismicGeometry(path)
+    else:
+        _CROP_LOADER = SeismicGeometry(path, process=False)
+        _CROP_LOADER.restore_worker_state(state)
+
+    _CROP_LOADER.shared_cache = shared_cache
+    _CROP_LOADER.cache_budget = MemoryBudget(budget) if budget is not None else None
+
+def _load_crops_in_worker(locations, **kwargs):
+    """ Load crops in the worker process. """
+    return _CROP_LOADER.load_crops(locations, **kwargs)
+
+
 class SeismicGeometryHDF5(SeismicGeometry):
     """ Class to infer information about HDF5 cubes and provide convenient methods of working with them.
 
@@ -1231,12 +1741,33 @@ class SeismicGeometryHDF5(SeismicGeometry):
     are preserved, with the exception of `dataframe` and `uniques`.
     """
     #pylint: disable=attribute-defined-outside-init
+    # Names of the projections and order of axes in each of them
+    PROJECTION_NAMES = {0: 'cube', 1: 'cube_x', 2: 'cube_h'}
+    PROJECTION_ORDERS = {0: (0, 1, 2), 1: (1, 2, 0), 2: (2, 0, 1)}
+    # Fixed cost of one read from disk, expressed in bytes: roughly the latency of a random read
+    READ_OVERHEAD = 64 * 1024
+
     def __init__(self, path, **kwargs):
         self.structured = True
+        self._handles = local()
         self.file_hdf5 = None
 
         super().__init__(path, **kwargs)
 
+    @property
+    def file_hdf5(self):
+        """ Opened HDF5 file. Each thread uses its own handle, opened on the first access. """
+        file_hdf5 = getattr(self._handles, 'file_hdf5', None)
+        if file_hdf5 is None and self.path_opened is not None:
+            file_hdf5 = h5py.File(self.path, mode='r')
+            self._handles.file_hdf5 = file_hdf5
+        return file_hdf5
+
+    @file_hdf5.setter
+    def file_hdf5(self, value):
+        self._handles.file_hdf5 = value
+        self.path_opened = self.path if value is not None else None
+
     def process(self, **kwargs):
         """ Put info from `.hdf5` groups to attributes.
         No passing through data whatsoever.
@@ -1257,20 +1788,81 @@ class SeismicGeometryHDF5(SeismicGeometry):
         self.has_stats = True
 
     # Methods to load actual data from HDF5
-    def load_crop(self, locations, axis=None, **kwargs):
+    def load_crop(self, locations, axis=None, mode='adaptive', buffer=None, **kwargs):
         """ Load 3D crop from the cube.
         Automatically chooses the fastest axis to use: as `hdf5` files store multiple copies of data with
         various orientations, some axis are faster than others depending on exact crop location and size.
 
+        Along the chosen projection, slides that are already cached are taken from the cache. The rest are either
+        loaded as full slides (and cached), or read directly as hyperslabs of the crop size, depending on
+        the estimated amount of data to read from disk in each case.
+
         Parameters
         locations : sequence of slices
             Location to load: slices along the first index, the second, and depth.
         axis : str or int
             Identificator of the axis to use to load data.
             Can be `iline`, `xline`, `height`, `depth`, `i`, `x`, `h`, 0, 1, 2.
+        mode : str
+            If `adaptive`, then the way to read non-cached slides is chosen by the estimated cost.
+            If `slide` or `crop`, then full slides or hyperslabs are always read.
+        buffer : np.ndarray, optional
+            Array of the crop shape to put loaded data into.
+            If it is C-contiguous and has the dtype of the cube, data is read into it without intermediate copies.
+        """
+        if buffer is not None:
+            self._load_crops([locations], axis=axis, mode=mode, buffer=buffer[np.newaxis], **kwargs)
+            return buffer
+        return self._load_crops([locations], axis=axis, mode=mode, **kwargs)[0]
+
+    def _load_crops(self, locations, axis=None, mode='adaptive', buffer=None, **kwargs):
+        """ Load multiple crops in the current thread. Used by :meth:`.load_crops`, which passes all of the parameters.
+        Each of the crops is loaded from the projection, chosen as in :meth:`.load_crop`.
+
+        Data, needed by multiple crops, is read only once: along each projection, the range of slides is split into
+        intervals with the same set of crops. In each of them, cached slides are reused, and the rest are read either
+        as full slides (and cached), as separate hyperslabs for each crop, or as one hyperslab around all of them,
+        whichever has the lowest estimated cost.
+
+        Parameters
+        ----------
+        locations : sequence
+            Locations of crops, each is a sequence of slices along the first index, the second, and depth.
+        axis : str or int, optional
+            Identificator of the axis to use to load data for all of the crops.
+        mode : str
+            If `adaptive`, then the way to read non-cached slides is chosen by the estimated cost.
+            If `slide` or `crop`, then full slides or hyperslabs are always read.
+        buffer : np.ndarray or sequence of np.ndarrays, optional
+            Arrays to put loaded crops into.
+
+        Returns
+        -------
+        np.ndarray of (n_crops, *crop_shape) shape, if all of the crops have the same shape; list of arrays otherwise.
+        """
+        shapes = [tuple(slc.stop - slc.start for slc in location) for location in locations]
+        if buffer is None:
+            dtype = self.file_hdf5['cube'].dtype
+            if len(set(shapes)) == 1:
+                buffer = np.empty((len(locations), *shapes[0]), dtype=dtype)
+            else:
+                buffer = [np.empty(shape, dtype=dtype) for shape in shapes]
+
+        # Group crops by the projection to load them from
+        groups = defaultdict(list)
+        for i, shape in enumerate(shapes):
+            groups[self.choose_projection(shape, axis=axis)].append(i)
+
+        for projection, indices in groups.items():
+            self._load_projection(projection, [locations[i] for i in indices], [buffer[i] for i in indices],
+                                  mode=mode, **kwargs)
+        return buffer
+
+    def choose_projection(self, shape, axis=None):
+        """ Number of the axis, along which the projection to load a crop of `shape` from is stored.
+        If `axis` is not given, then the thinnest dimension of the crop is used.
         """
         if axis is None:
-            shape = np.array([(slc.stop - slc.start) for slc in locations])
             axis = np.argmin(shape)
         else:
             mapping = {0: 0, 1: 1, 2: 2,
@@ -1278,50 +1870,140 @@ class SeismicGeometryHDF5(SeismicGeometry):
                        'iline': 0, 'xline': 1, 'height': 2, 'depth': 2}
             axis = mapping[axis]
 
-        if axis == 1 and 'cube_x' in self.file_hdf5:
-            crop = self._load_x(*locations, **kwargs)
-        elif axis == 2 and 'cube_h' in self.file_hdf5:
-            crop = self._load_h(*locations, **kwargs)
-        else: # backward compatibility
-            crop = self._load_i(*locations, **kwargs)
-        return crop
-
-    def _load_i(self, ilines, xlines, heights, **kwargs):
-        cube_hdf5 = self.file_hdf5['cube']
-        return np.stack([self._cached_load(cube_hdf5, iline, **kwargs)[xlines, :][:, heights]
-                         for iline in range(ilines.start, ilines.stop)])
-
-    def _load_x(self, ilines, xlines, heights, **kwargs):
-        cube_hdf5 = self.file_hdf5['cube_x']
-        return np.stack([self._cached_load(cube_hdf5, xline, **kwargs)[heights, :][:, ilines].transpose([1, 0])
-                         for xline in range(xlines.start, xlines.stop)], axis=1)
+        if self.PROJECTION_NAMES[axis] in self.file_hdf5:
+            return axis
+        return 0 # backward compatibility
 
-    def _load_h(self, ilines, xlines, heights, **kwargs):
-        cube_hdf5 = self.file_hdf5['cube_h']
-        return np.stack([self._cached_load(cube_hdf5, height, **kwargs)[ilines, :][:, xlines]
-                         for height in range(heights.start, heights.stop)], axis=2)
+    @property
+    def spatial_chunks(self):
+        """ Spatial shape of chunks of the `cube` projection. """
+        chunks = self.file_hdf5['cube'].chunks
+        return np.array(chunks[:2]) if chunks is not None else np.array([1, 1])
+
+    def _load_projection(self, axis, locations, outputs, mode='adaptive', **kwargs):
+        """ Load crops from one projection into `outputs`. """
+        name = self.PROJECTION_NAMES[axis]
+        cube_hdf5 = self.file_hdf5[name]
+        order = self.PROJECTION_ORDERS[axis]
+
+        # Locations and crops in the order of projection axes
+        projected = [[location[i] for i in order] for location in locations]
+        crops = []
+        for location, output in zip(projected, outputs):
+            if axis == 0 and output.dtype == cube_hdf5.dtype and output.flags.c_contiguous:
+                crops.append(output)
+            else:
+                crops.append(np.empty(tuple(slc.stop - slc.start for slc in location), dtype=cube_hdf5.dtype))
+
+        slide_cost = self.estimate_read_cost(cube_hdf5, [slice(0, 1), slice(None), slice(None)])
+        starts = np.array([location[0].start for location in projected])
+        stops = np.array([location[0].stop for location in projected])
+        bounds = np.unique(np.concatenate([starts, stops]))
+
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            active = np.flatnonzero((starts <= start) & (stops >= stop))
+            if len(active) == 0:
+                continue
+            cached = [self._cached_load.is_cached(self, name, loc, **kwargs) for loc in range(start, stop)]
+
+            # Process runs of consecutive slides: either all of them are cached, or none of them
+            run_start = start
+            while run_start < stop:
+                run_stop = run_start + 1
+                while run_stop < stop and cached[run_stop - start] == cached[run_start - start]:
+                    run_stop += 1
+                run = slice(run_start, run_stop)
+
+                if cached[run_start - start] or mode == 'slide':
+                    run_mode = 'slide'
+                else:
+                    locations_ = [projected[i] for i in active]
+                    box = [run, *[slice(min(location[j].start for location in locations_),
+                                        max(location[j].stop for location in locations_)) for j in (1, 2)]]
+                    costs = {
+                        'slide': slide_cost * (run_stop - run_start) if mode == 'adaptive' else np.inf,
+                        'crop': sum(self.estimate_read_cost(cube_hdf5, [run, *location[1:]])
+                                    for location in locations_),
+                        'box': self.estimate_read_cost(cube_hdf5, box),
+                    }
+                    run_mode = min(costs, key=costs.get)
+
+                self._read_run(name, run, run_mode, [projected[i] for i in active],
+                               [crops[i] for i in active], **kwargs)
+                run_start = run_stop
+
+        for crop, output in zip(crops, outputs):
+            if crop is not output:
+                output[...] = crop.transpose(np.argsort(order))
+
+    def _read_run(self, name, run, mode, locations, crops, **kwargs):
+        """ Read slides in `run` for each of the crops: either by loading full slides, by reading
+        a hyperslab for each crop, or by reading one hyperslab around all of them.
+        """
+        cube_hdf5 = self.file_hdf5[name]
+        if mode == 'slide':
+            for loc in range(run.start, run.stop):
+                slide = self._cached_load(name, loc, **kwargs)
+                for location, crop in zip(locations, crops):
+                    crop[loc - location[0].start] = slide[location[1], location[2]]
+
+        elif mode == 'crop':
+            for location, crop in zip(locations, crops):
+                shift = location[0].start
+                cube_hdf5.read_direct(crop, source_sel=np.s_[run, location[1], location[2]],
+                                      dest_sel=np.s_[run.start - shift:run.stop - shift])
+
+        elif mode == 'box':
+            start_1 = min(location[1].start for location in locations)
+            start_2 = min(location[2].start for location in locations)
+            stop_1 = max(location[1].stop for location in locations)
+            stop_2 = max(location[2].stop for location in locations)
+
+            box = np.empty((run.stop - run.start, stop_1 - start_1, stop_2 - start_2), dtype=cube_hdf5.dtype)
+            cube_hdf5.read_direct(box, source_sel=np.s_[run, start_1:stop_1, start_2:stop_2])
+            for location, crop in zip(locations, crops):
+                shift = location[0].start
+                slc_1 = slice(location[1].start - start_1, location[1].stop - start_1)
+                slc_2 = slice(location[2].start - start_2, location[2].stop - start_2)
+                crop[run.start - shift:run.stop - shift] = box[:, slc_1, slc_2]
+
+    def estimate_read_cost(self, cube_hdf5, locations):
+        """ Estimate amount of bytes to read from disk to get data at `locations` of a dataset.
+        Each touched chunk is read and decompressed as a whole; if the dataset is not chunked,
+        then each row along the last axis is a separate read. Every read also has a fixed overhead.
+        """
+        locations = [slice(*slc.indices(size)[:2]) for slc, size in zip(locations, cube_hdf5.shape)]
+        lengths = [slc.stop - slc.start for slc in locations]
+
+        if cube_hdf5.chunks is not None:
+            chunks = cube_hdf5.chunks
+            n_reads = np.prod([(slc.stop - 1) // chunk - slc.start // chunk + 1
+                               for slc, chunk in zip(locations, chunks)])
+            read_size = np.prod(chunks)
+        else:
+            n_reads = lengths[0] * lengths[1]
+            read_size = lengths[2]
+        return n_reads * (read_size * cube_hdf5.dtype.itemsize + self.READ_OVERHEAD)
 
     @lru_cache(128)
-    def _cached_load(self, cube, loc, **kwargs):
+    def _cached_load(self, name, loc, **kwargs):
         """ Load one slide of data from a certain cube projection.
-        Caches the result in a thread-safe manner.
+        Caches the result in a thread-safe manner: projection is referenced by its `name`,
+        so that the cache is shared between file handles of different threads.
         """
         _ = kwargs
-        return cube[loc, :, :]
+        return self.file_hdf5[name][loc, :, :]
 
     def load_slide(self, loc, axis='iline', **kwargs):
         """ Load desired slide along desired axis. """
         axis = self.parse_axis(axis)
 
         if axis == 0:
-            cube = self.file_hdf5['cube']
-            slide = self._cached_load(cube, loc, **kwargs)
+            slide = self._cached_load('cube', loc, **kwargs)
         elif axis == 1:
-            cube = self.file_hdf5['cube_x']
-            slide = self._cached_load(cube, loc, **kwargs).T
+            slide = self._cached_load('cube_x', loc, **kwargs).T
         elif axis == 2:
-            cube = self.file_hdf5['cube_h']
-            slide = self._cached_load(cube, loc, **kwargs)
+            slide = self._cached_load('cube_h', loc, **kwargs)
         return slide
 
     def __getitem__(self, key):
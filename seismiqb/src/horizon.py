@@ -1,7 +1,9 @@
 """ Horizon class and metrics. """
 #pylint: disable=too-many-lines, import-error
 import os
+import heapq
 from copy import copy
+from hashlib import blake2b
 from textwrap import dedent
 from itertools import product
 
@@ -12,7 +14,6 @@ from numba import njit, prange
 
 import cv2
 from scipy.ndimage.morphology import binary_fill_holes, binary_erosion
-from scipy.ndimage import find_objects
 from scipy.spatial import Delaunay
 from scipy.signal import hilbert
 from skimage.measure import label
@@ -20,7 +21,7 @@ from skimage.measure import label
 import plotly
 import plotly.figure_factory as ff
 
-from .utils import round_to_array, groupby_mean, groupby_min, groupby_max, HorizonSampler, filter_simplices, lru_cache
+from .utils import round_to_array, HorizonSampler, filter_simplices, lru_cache
 from .utils import make_gaussian_kernel, retrieve_function_arguments
 from .plotters import plot_image
 
@@ -322,6 +323,12 @@ class Horizon:
           Stored height is corrected on `time_delay` and `sample_rate` of the cube.
           In order to initialize from this storage, one must supply (N, 3) ndarray.
 
+        - `tiles` is an optional sparse storage, :class:`.HorizonTiles`: square tiles of depths, allocated only where
+          the horizon is present. If `tile_size` is supplied at initialization, it becomes the main storage,
+          and `matrix` is created from it at each access without being kept in memory; `points` are still cached.
+          Merges, `add_to_mask` and `full_matrix` of tiled horizons work tile by tile.
+          That allows to cut memory usage for large, but sparse horizons: carcasses or thin predictions.
+
     Independently of type of initial storage, Horizon provides following:
         - Attributes `i_min`, `x_min`, `i_max`, `x_max`, `h_min`, `h_max`, `h_mean`, `h_std`, `bbox`,
           to completely describe location of the horizon in the 3D volume of the seismic cube.
@@ -378,7 +385,7 @@ class Horizon:
     ATTRIBUTE_TO_METHOD = {attr: func for func, attrs in METHOD_TO_ATTRIBUTE.items() for attr in attrs}
 
 
-    def __init__(self, storage, geometry, name=None, dtype=np.int32, **kwargs):
+    def __init__(self, storage, geometry, name=None, dtype=np.int32, tile_size=None, **kwargs):
         # Meta information
         self.path = None
         self.name = name
@@ -396,6 +403,7 @@ class Horizon:
         self._matrix = None
         self._points = None
         self._depths = None
+        self._tiles = None
 
         # Heights information
         self._h_min, self._h_max = None, None
@@ -418,6 +426,10 @@ class Horizon:
             # mapping from (iline, xline) to (height)
             self.format = 'dict'
 
+        elif isinstance(storage, HorizonTiles):
+            # sparse tiles of depths
+            self.format = 'tiles'
+
         elif isinstance(storage, np.ndarray):
             if storage.ndim == 2 and storage.shape[1] == 3:
                 # array with row in (iline, xline, height) format
@@ -433,12 +445,17 @@ class Horizon:
 
         getattr(self, 'from_{}'.format(self.format))(storage, **kwargs)
 
+        if tile_size is not None and self._tiles is None:
+            self.to_tiles(tile_size)
+
 
     @property
     def points(self):
         """ Storage of horizon data as (N, 3) array of (iline, xline, height) in cubic coordinates.
         If the horizon is created not from (N, 3) array, evaluated at the time of the first access.
         """
+        if self._points is None and self._tiles is not None:
+            self._points = self._tiles.to_points()
         if self._points is None and self.matrix is not None:
             points = self.matrix_to_points(self.matrix)
             points += np.array([self.i_min, self.x_min, 0])
@@ -464,7 +481,13 @@ class Horizon:
         """ Storage of horizon data as depth map: matrix of (ilines_length, xlines_length) with each point
         corresponding to height. Matrix is shifted to a (i_min, x_min) point so it takes less space.
         If the horizon is created not from matrix, evaluated at the time of the first access.
+        If the horizon is stored in tiles, created from them at each access and not kept in memory: the result
+        is read-only, as changes to it would be lost. Use :meth:`.matrix_window` to get only a part of it.
         """
+        if self._matrix is None and self._tiles is not None:
+            matrix = self._tiles.crop(self.i_min, self.i_max + 1, self.x_min, self.x_max + 1, dtype=self.dtype)
+            matrix.flags.writeable = False
+            return matrix
         if self._matrix is None and self.points is not None:
             self._matrix = self.points_to_matrix(self.points, self.i_min, self.x_min,
                                                  self.i_length, self.x_length, self.dtype)
@@ -474,6 +497,26 @@ class Horizon:
     def matrix(self, value):
         self._matrix = value
 
+    @property
+    def tiles(self):
+        """ Sparse tiled storage of horizon data, :class:`.HorizonTiles`. None, if the horizon is not tiled. """
+        return self._tiles
+
+    def to_tiles(self, tile_size=64):
+        """ Make sparse tiles the main storage of the horizon, releasing the dense `matrix`. """
+        self._tiles = HorizonTiles.from_points(self.points, tile_size=tile_size)
+        self._matrix = None
+
+    def matrix_window(self, i_start, i_stop, x_start, x_stop):
+        """ Part of the `matrix`, located at [i_start:i_stop, x_start:x_stop] in cubic coordinates.
+        Must be inside the horizon bbox. For tiled horizons, only tiles that intersect the window are used.
+        """
+        if self._matrix is None and self._tiles is not None:
+            window = self._tiles.crop(i_start, i_stop, x_start, x_stop, dtype=self.dtype)
+            window.flags.writeable = False
+            return window
+        return self.matrix[i_start - self.i_min:i_stop - self.i_min, x_start - self.x_min:x_stop - self.x_min]
+
     @staticmethod
     def points_to_matrix(points, i_min, x_min, i_length, x_length, dtype=np.int32):
         """ Convert array of (N, 3) shape to a depth map (matrix). """
@@ -488,8 +531,11 @@ class Horizon:
         if self._depths is None:
             if self._points is not None:
                 self._depths = self.points[:, -1]
+            elif self._tiles is not None:
+                self._depths = self._tiles.depths()
             else:
-                self._depths = self.matrix[self.matrix != self.FILL_VALUE]
+                matrix = self.matrix
+                self._depths = matrix[matrix != self.FILL_VALUE]
         return self._depths
 
 
@@ -537,6 +583,17 @@ class Horizon:
         self._h_mean, self._h_std = None, None
         self._len = None
 
+        if self._tiles is not None:
+            # Tiles are the main storage: re-create them from the changed one
+            if storage == 'points' and self._matrix is not None:
+                self._tiles = HorizonTiles.from_matrix(self._matrix, self.i_min, self.x_min,
+                                                       tile_size=self._tiles.tile_size)
+                self._matrix, self._points = None, None
+            elif storage == 'matrix' and self._points is not None:
+                self._tiles = HorizonTiles.from_points(self._points, tile_size=self._tiles.tile_size)
+                self._matrix = None
+            return
+
         if storage == 'matrix':
             self._matrix = None
         elif storage == 'points':
@@ -653,6 +710,24 @@ class Horizon:
         self._len = length
 
 
+    def from_tiles(self, tiles, length=None, **kwargs):
+        """ Init from sparse tiles of depths. """
+        _ = kwargs
+
+        self._tiles = tiles
+        self._matrix, self._points = None, None
+        self.reset_storage()
+
+        self.i_min, self.i_max, self.x_min, self.x_max = tiles.bounds()
+        self.i_length = (self.i_max - self.i_min) + 1
+        self.x_length = (self.x_max - self.x_min) + 1
+        self.bbox = np.array([[self.i_min, self.i_max],
+                              [self.x_min, self.x_max],
+                              [self.h_min, self.h_max]],
+                             dtype=np.int32)
+        self._len = length
+
+
     def from_full_matrix(self, matrix, **kwargs):
         """ Init from matrix that covers the whole cube. """
         kwargs = {
@@ -680,10 +755,15 @@ class Horizon:
 
     @staticmethod
     def from_mask(mask, grid_info=None, geometry=None, shifts=None,
-                  mode='mean', threshold=0.5, minsize=0, prefix='predict', **kwargs):
+                  mode='mean', threshold=0.5, minsize=0, prefix='predict', chunk_size=None, **kwargs):
         """ Convert mask to a list of horizons.
         Returned list is sorted on length of horizons.
 
+        Mask is processed in spatial chunks, overlapping by one trace: connected regions are labeled in each chunk
+        separately and then stitched along the overlaps with union-find. Depths of each region are reduced over traces
+        inside chunks, so that horizon matrices are created directly, and only one chunk of the mask is in memory
+        at a time. Therefore, `mask` can be a `np.memmap` or an HDF5 dataset of any size.
+
         Parameters
         ----------
         grid_info : dict
@@ -698,6 +778,8 @@ class Horizon:
             Minimum length of a horizon to be saved.
         prefix : str
             Name of horizon to use.
+        chunk_size : int, sequence of two ints or None
+            Spatial size of chunks to label the mask in. If None, the whole mask is labeled at once.
         """
         _ = kwargs
         if grid_info is not None:
@@ -707,35 +789,101 @@ class Horizon:
         if geometry is None or shifts is None:
             raise TypeError('Pass `grid_info` or `geometry` and `shifts` to `from_mask` method of Horizon creation.')
 
-        if mode in ['mean', 'avg']:
-            group_function = groupby_mean
-        elif mode in ['min']:
-            group_function = groupby_min
-        elif mode in ['max']:
-            group_function = groupby_max
+        modes = {'mean': 0, 'avg': 0, 'min': 1, 'max': 2}
+        if mode not in modes:
+            raise ValueError(f'Unknown mode `{mode}`: use one of {list(modes)}.')
+
+        records = Horizon._mask_to_records(mask, threshold=threshold, chunk_size=chunk_size, mode=modes[mode])
 
-        # Labeled connected regions with an integer
-        labeled = label(mask >= threshold)
-        objects = find_objects(labeled)
+        # Filter small regions by the number of points
+        sizes = np.bincount(records[:, 0], weights=records[:, 4])
+        records = records[sizes[records[:, 0]] >= minsize]
+        records = records[np.argsort(records[:, 0], kind='stable')]
+        bounds = np.nonzero(np.diff(records[:, 0]))[0] + 1
 
-        # Create an instance of Horizon for each separate region
+        # Create an instance of Horizon for each separate region directly from its matrix
         horizons = []
-        for i, sl in enumerate(objects):
-            max_possible_length = 1
-            for j in range(3):
-                max_possible_length *= sl[j].stop - sl[j].start
+        for i, region in enumerate(np.split(records, bounds) if len(records) else []):
+            i_min, x_min = region[:, 1].min(), region[:, 2].min()
+            matrix = Horizon._records_to_matrix(region, i_min, x_min, mode=modes[mode])
+            matrix[matrix != Horizon.FILL_VALUE] += shifts[2]
+            horizons.append(Horizon(matrix, geometry, name=f'{prefix}_{i}',
+                                    i_min=i_min + shifts[0], x_min=x_min + shifts[1]))
 
-            if max_possible_length >= minsize:
-                indices = np.nonzero(labeled[sl] == i + 1)
+        horizons.sort(key=len)
+        return horizons
 
-                if len(indices[0]) >= minsize:
-                    coords = np.vstack([indices[i] + sl[i].start for i in range(3)]).T
+    @staticmethod
+    def _mask_to_records(mask, threshold=0.5, chunk_size=None, mode=0):
+        """ Label mask in spatial chunks and reduce depths of each region along traces, see :func:`._mask_to_traces`.
+        Labels of regions, connected through the borders of chunks, are made the same with :class:`.LabelsUnion`.
 
-                    points = group_function(coords) + shifts
-                    horizons.append(Horizon(points, geometry, name=f'{prefix}_{i}'))
+        Returns
+        -------
+        np.ndarray
+            Array of (N, 5) shape with (label, iline, xline, value, number of points) records.
+        """
+        shape = mask.shape
+        chunk_size = np.broadcast_to(shape[:2] if chunk_size is None else chunk_size, (2,))
+        labels_union = LabelsUnion()
+
+        records = []
+        i_planes = {}
+        for i_start in range(0, shape[0], chunk_size[0]):
+            i_stop = min(i_start + chunk_size[0], shape[0])
+            x_plane = None
+            for x_start in range(0, shape[1], chunk_size[1]):
+                x_stop = min(x_start + chunk_size[1], shape[1])
+
+                # Label chunk with one trace of overlap with the next chunks along both axes
+                chunk = np.asarray(mask[i_start:i_stop + 1, x_start:x_stop + 1]) >= threshold
+                labeled, num = label(chunk, return_num=True)
+                labeled = labeled.astype(np.int64, copy=False)
+                labeled[labeled > 0] += labels_union.add(num)
+
+                # Stitch with the previous chunks on the shared planes
+                if i_start > 0:
+                    labels_union.union(i_planes[x_start], labeled[0])
+                if x_start > 0:
+                    labels_union.union(x_plane, labeled[:, 0])
+                i_planes[x_start] = labeled[i_stop - i_start] if i_stop < shape[0] else None
+                x_plane = labeled[:, x_stop - x_start] if x_stop < shape[1] else None
+
+                # Reduce depths of each region along traces, owned by this chunk
+                chunk_records = _mask_to_traces(labeled, i_stop - i_start, x_stop - x_start, mode)
+                chunk_records[:, 1] += i_start
+                chunk_records[:, 2] += x_start
+                records.append(chunk_records)
+
+        records = np.concatenate(records)
+        records[:, 0] = labels_union.roots()[records[:, 0]]
+        return records
 
-        horizons.sort(key=len)
-        return horizons
+    @staticmethod
+    def _records_to_matrix(records, i_min, x_min, mode=0):
+        """ Depth map of one region from its records, located at (i_min, x_min): depths are averaged for `mode` 0,
+        minimum and maximum of them are taken for `mode` 1 and 2 respectively.
+        """
+        shape = (records[:, 1].max() - i_min + 1, records[:, 2].max() - x_min + 1)
+        idx = (records[:, 1] - i_min, records[:, 2] - x_min)
+
+        if mode == 1:
+            matrix = np.full(shape, np.iinfo(np.int64).max, dtype=np.int64)
+            np.minimum.at(matrix, idx, records[:, 3])
+            present = matrix != np.iinfo(np.int64).max
+        elif mode == 2:
+            matrix = np.full(shape, -1, dtype=np.int64)
+            np.maximum.at(matrix, idx, records[:, 3])
+            present = matrix != -1
+        else:
+            matrix, counts = np.zeros(shape, dtype=np.int64), np.zeros(shape, dtype=np.int64)
+            np.add.at(matrix, idx, records[:, 3])
+            np.add.at(counts, idx, records[:, 4])
+            present = counts > 0
+            matrix[present] //= counts[present]
+
+        matrix[~present] = Horizon.FILL_VALUE
+        return matrix.astype(np.int32)
 
 
     # Functions to use to change the horizon
@@ -751,7 +899,9 @@ class Horizon:
         kwargs : dict
             Additional arguments to pass to the function.
         """
-        result = function(self.matrix, **kwargs)
+        # Matrix, created from tiles, is read-only: pass its copy, so that it can be changed in-place
+        matrix = self.matrix if self._tiles is None else np.array(self.matrix)
+        result = function(matrix, **kwargs)
         if isinstance(result, tuple) and len(result) == 3:
             matrix, i_min, x_min = result
         else:
@@ -916,8 +1066,7 @@ class Horizon:
         x_min, x_max = max(self.x_min, mask_x_min), min(self.x_max + 1, mask_x_max)
 
         if i_max > i_min and x_max > x_min:
-            overlap = self.matrix[i_min - self.i_min : i_max - self.i_min,
-                                  x_min - self.x_min : x_max - self.x_min]
+            overlap = self.matrix_window(i_min, i_max, x_min, x_max)
 
             # Coordinates of points to use in overlap local system
             idx_i, idx_x = np.asarray((overlap != self.FILL_VALUE) &
@@ -975,10 +1124,12 @@ class Horizon:
         return array
 
 
-    @lru_cache(maxsize=1, apply_by_default=False)
-    def get_cube_values(self, window=23, offset=0, chunk_size=256, **kwargs):
+    @lru_cache(maxsize=1, apply_by_default=False, persistent=True)
+    def get_cube_values(self, window=23, offset=0, chunk_size=128, compact=False, **kwargs):
         """ Get values from the cube along the horizon.
 
+        Only traces with the horizon present are read, tile by tile: see :meth:`.SeismicGeometry.load_horizons_values`.
+
         Parameters
         ----------
         window : int
@@ -989,51 +1140,25 @@ class Horizon:
             If True, then values are scaled to [0, 1] range.
             If callable, then it is applied to data cropped along horizon.
         chunk_size : int
-            Size of data along height axis processed at a time.
+            Spatial size of tiles of traces processed at a time.
+        compact : bool
+            If True, then array of (n_points, window) shape is returned, with rows in the order of :attr:`.points`.
+            Otherwise, values are put into array of (cube_ilines, cube_xlines, window) shape.
         nan_zero_traces : bool
             Whether fill zero traces with nans or not.
             Defaults to True.
         kwargs :
-            Passed directly to :meth:`.transform_where_present`.
+            Passed directly to :meth:`.transform_where_present`. Not used, if `compact` is True.
         """
         transform_kwargs = retrieve_function_arguments(self.transform_where_present, kwargs)
-        low = window // 2
-        high = max(window - low, 0)
-        chunk_size = min(chunk_size, self.h_max - self.h_min + window)
-
-        background = np.zeros((self.geometry.ilines_len, self.geometry.xlines_len, window), dtype=np.float32)
-
-        for h_start in range(max(low, self.h_min), self.h_max + 1, chunk_size):
-            h_end = min(h_start + chunk_size, self.h_max + 1)
-
-            # Get chunk from the cube (depth-wise)
-            data_chunk = self.geometry[:, :, (h_start - low) : min(h_end + high, self.geometry.depth)]
+        values = self.geometry.load_horizons_values([self], window=window, offset=offset,
+                                                    chunk_size=chunk_size, compact=compact)[0]
+        if compact:
+            return values
+        return self.transform_where_present(values, **transform_kwargs)
 
-            # Check which points of the horizon are in the current chunk (and present)
-            idx_i, idx_x = np.asarray((self.matrix != self.FILL_VALUE) &
-                                      (self.matrix >= h_start) &
-                                      (self.matrix < h_end)).nonzero()
-            heights = self.matrix[idx_i, idx_x]
 
-            # Convert spatial coordinates to cubic, convert height to current chunk local system
-            idx_i += self.i_min
-            idx_x += self.x_min
-            heights -= (h_start - offset)
-
-            # Subsequently add values from the cube to background, then shift horizon 1 unit lower
-            for j in range(window):
-                background[idx_i, idx_x, np.full_like(heights, j)] = data_chunk[idx_i, idx_x, heights]
-                heights += 1
-                mask = heights < data_chunk.shape[2]
-                idx_i = idx_i[mask]
-                idx_x = idx_x[mask]
-                heights = heights[mask]
-
-        background[self.geometry.zero_traces == 1] = np.nan
-        return self.transform_where_present(background, **transform_kwargs)
-
-
-    @lru_cache(maxsize=1, apply_by_default=False)
+    @lru_cache(maxsize=1, apply_by_default=False, persistent=True)
     def get_instantaneous_amplitudes(self, window=23, depths=None, **kwargs):
         """ Calculate instantaneous amplitude along the horizon.
 
@@ -1063,7 +1188,7 @@ class Horizon:
         return self.transform_where_present(result, **transform_kwargs)
 
 
-    @lru_cache(maxsize=1, apply_by_default=False)
+    @lru_cache(maxsize=1, apply_by_default=False, persistent=True)
     def get_instantaneous_phases(self, window=23, depths=None, **kwargs):
         """ Calculate instantaneous phase along the horizon.
 
@@ -1103,7 +1228,7 @@ class Horizon:
             Passed directly to :meth:`.put_on_full` and :meth:`.transform_where_present`.
         """
         transform_kwargs = retrieve_function_arguments(self.transform_where_present, kwargs)
-        matrix = self.put_on_full(self.matrix, **kwargs)
+        matrix = self.put_on_full(**kwargs)
         return self.transform_where_present(matrix, **transform_kwargs)
 
 
@@ -1216,7 +1341,7 @@ class Horizon:
         # compute start and end-points of the ilines-xlines overlap between
         # array and matrix in horizon and array-coordinates
         horizon_shift, shifts = np.array(horizon_shift), np.array(shifts)
-        horizon_max = horizon_shift[:2] + np.array(self.matrix.shape)
+        horizon_max = horizon_shift[:2] + np.array((self.i_length, self.x_length))
         array_max = np.array(array.shape[:2]) + shifts[:2]
         overlap_shape = np.minimum(horizon_max[:2], array_max[:2]) - np.maximum(horizon_shift[:2], shifts[:2])
         overlap_start = np.maximum(0, horizon_shift[:2] - shifts[:2])
@@ -1226,7 +1351,10 @@ class Horizon:
         slc_array = [slice(l, h) for l, h in zip(overlap_start, overlap_start + overlap_shape)]
         slc_horizon = [slice(l, h) for l, h in zip(heights_start, heights_start + overlap_shape)]
         overlap_matrix = np.full(array.shape[:2], fill_value=self.FILL_VALUE, dtype=np.float32)
-        overlap_matrix[slc_array] = self.matrix[slc_horizon]
+        overlap_matrix[tuple(slc_array)] = self.matrix_window(self.i_min + slc_horizon[0].start,
+                                                              self.i_min + slc_horizon[0].stop,
+                                                              self.x_min + slc_horizon[1].start,
+                                                              self.x_min + slc_horizon[1].stop)
         overlap_matrix -= shifts[-1]
 
         # make the cut-array and fill it with array-data located on needed heights
@@ -1277,7 +1405,8 @@ class Horizon:
             cube_hdf5 = self.geometry.file_hdf5['cube']
             slide_transform = lambda array: array
 
-            hor_line = np.squeeze(self.matrix[line, :])
+            hor_line = np.squeeze(self.matrix_window(self.i_min + line, self.i_min + line + 1,
+                                                     self.x_min, self.x_max + 1))
             background = np.zeros((self.geometry.xlines_len, window))
             idx_offset = self.x_min
             bad_traces = np.squeeze(self.geometry.zero_traces[line, :])
@@ -1286,7 +1415,8 @@ class Horizon:
             cube_hdf5 = self.geometry.file_hdf5['cube_x']
             slide_transform = lambda array: array.T
 
-            hor_line = np.squeeze(self.matrix[:, line])
+            hor_line = np.squeeze(self.matrix_window(self.i_min, self.i_max + 1,
+                                                     self.x_min + line, self.x_min + line + 1))
             background = np.zeros((self.geometry.ilines_len, window))
             idx_offset = self.i_min
             bad_traces = np.squeeze(self.geometry.zero_traces[:, line])
@@ -1374,6 +1504,8 @@ class Horizon:
     @property
     def presence_matrix(self):
         """ Binary matrix in cubic coordinate system. """
+        if self._matrix is None and self._tiles is not None:
+            return self.put_on_full(dtype=np.int32) != self.FILL_VALUE
         return self.put_on_full(self.binary_matrix, fill_value=False, dtype=bool)
 
     @property
@@ -1388,8 +1520,25 @@ class Horizon:
 
     @property
     def hash(self):
-        """ Hash on current data of the horizon. """
-        return hash(self.matrix.data.tobytes())
+        """ Hash on current data of the horizon. Stays the same between runs, so can be used to store results
+        of computations on disk.
+        """
+        matrix = self.matrix
+        digest = blake2b(digest_size=16)
+        digest.update(repr((self.i_min, self.x_min, matrix.shape, matrix.dtype.str)).encode('utf-8'))
+        digest.update(np.ascontiguousarray(matrix).data.tobytes())
+        return digest.hexdigest()
+
+    @property
+    def cache_identity(self):
+        """ Identity of the horizon for the disk cache: hash of data, path and modification time of the cube. """
+        path = self.geometry.path
+        return (self.hash, os.path.abspath(path), os.path.getmtime(path))
+
+    @property
+    def disk_cache(self):
+        """ Persistent cache of computed attributes and metrics: set by :meth:`.SeismicGeometry.set_disk_cache`. """
+        return getattr(self.geometry, 'disk_cache', None)
 
     @property
     def horizon_metrics(self):
@@ -1480,7 +1629,7 @@ class Horizon:
         return None
 
 
-    @lru_cache(maxsize=1, apply_by_default=False)
+    @lru_cache(maxsize=1, apply_by_default=False, persistent=True)
     def evaluate_metric(self, metric='support_corrs', supports=50, agg='nanmean', **kwargs):
         """ Cached metrics calcucaltion with disabled plotting option.
 
@@ -1576,11 +1725,8 @@ class Horizon:
 
         # Compare matrices on overlap without adjacency:
         if merge_code != 1 and i_range < 0 and x_range < 0:
-            self_overlap = self.matrix[overlap_i_min - self.i_min:overlap_i_max - self.i_min,
-                                       overlap_x_min - self.x_min:overlap_x_max - self.x_min]
-
-            other_overlap = other.matrix[overlap_i_min - other.i_min:overlap_i_max - other.i_min,
-                                         overlap_x_min - other.x_min:overlap_x_max - other.x_min]
+            self_overlap = self.matrix_window(overlap_i_min, overlap_i_max, overlap_x_min, overlap_x_max)
+            other_overlap = other.matrix_window(overlap_i_min, overlap_i_max, overlap_x_min, overlap_x_max)
 
             self_mask = self_overlap != self.FILL_VALUE
             other_mask = other_overlap != self.FILL_VALUE
@@ -1611,7 +1757,12 @@ class Horizon:
     def overlap_merge(self, other, inplace=False):
         """ Merge two horizons into one.
         Note that this function can either merge horizons in-place of the first one (`self`), or create a new instance.
+        If any of the horizons is tiled, merge is done tile by tile, and the result is tiled.
         """
+        if self.tiles is not None or other.tiles is not None:
+            self_tiles, other_tiles = self.shared_tiles(other)
+            return self.from_merged_tiles(self_tiles.overlap_merge(other_tiles), inplace=inplace)
+
         # Create shared background for both horizons
         shared_i_min, shared_i_max = min(self.i_min, other.i_min), max(self.i_max, other.i_max)
         shared_x_min, shared_x_max = min(self.x_min, other.x_min), max(self.x_max, other.x_max)
@@ -1673,12 +1824,26 @@ class Horizon:
             Margin to consider horizons close (spatially).
         inplace : bool
             Whether to create new instance or update `self`.
+
+        Notes
+        -----
+        For dense horizons, only points of `self` outside of the bbox of `other` are compared to it.
+        For tiled horizons, every point of `self`, where `other` is absent, is compared to the dilated `other`,
+        so horizons, that are adjacent inside the bbox of `other`, can be merged too.
         """
         # Simplest possible check: horizons are too far away from one another (depth-wise)
         overlap_h_min, overlap_h_max = max(self.h_min, other.h_min), min(self.h_max, other.h_max)
         if overlap_h_max - overlap_h_min < 0:
             return False
 
+        # Tiled horizons: compare points of `self` to dilated `other` tile by tile
+        if self.tiles is not None or other.tiles is not None:
+            self_tiles, other_tiles = self.shared_tiles(other)
+            diffs = self_tiles.adjacent_diffs(other_tiles, adjacency=adjacency)
+            if len(diffs) == 0 or np.mean(diffs) >= mean_threshold:
+                return False
+            return self.from_merged_tiles(self_tiles.overlap_merge(other_tiles), inplace=inplace)
+
         # Create shared background for both horizons
         shared_i_min, shared_i_max = min(self.i_min, other.i_min), max(self.i_max, other.i_max)
         shared_x_min, shared_x_max = min(self.x_min, other.x_min), max(self.x_max, other.x_max)
@@ -1738,49 +1903,49 @@ class Horizon:
             return merged
         return False
 
+    def shared_tiles(self, other):
+        """ Tiles of both horizons with the same tile size. Dense horizons are tiled on the fly. """
+        tile_size = (self.tiles if self.tiles is not None else other.tiles).tile_size
+        return tuple(horizon.tiles if horizon.tiles is not None and horizon.tiles.tile_size == tile_size
+                     else HorizonTiles.from_points(horizon.points, tile_size=tile_size)
+                     for horizon in (self, other))
+
+    def from_merged_tiles(self, tiles, inplace=False):
+        """ Change `self` inplace or create a new instance from merged tiles. """
+        if inplace:
+            self.from_tiles(tiles)
+            return True
+        return Horizon(tiles, self.geometry, self.name)
+
 
     @staticmethod
     def merge_list(horizons, mean_threshold=2.0, adjacency=3, minsize=50):
-        """ Iteratively try to merge every horizon in a list to every other, until there are no possible merges.
+        """ Try to merge every horizon in a list to every next one.
         Parameters are passed directly to :meth:`~.verify_merge`, :meth:`~.overlap_merge` and :meth:`~.adjacent_merge`.
+
+        Each horizon absorbs the next ones in order, growing inplace. Only pairs of horizons, that are close both
+        spatially and depth-wise, are checked: they are found with :class:`.HorizonMergeIndex`.
         """
-        horizons = [horizon for horizon in horizons if len(horizon) >= minsize]
-
-        # Iterate over the list of horizons to merge everything that can be merged
-        i = 0
-        flag = True
-        while flag:
-            # Continue while at least one pair of horizons was merged at previous iteration
-            flag = False
-            while True:
-                if i >= len(horizons):
-                    break
-
-                j = i + 1
-                while True:
-                    # Attempt to merge j-th horizon to i-th horizon
-                    if j >= len(horizons):
-                        break
-
-                    merge_code, _ = Horizon.verify_merge(horizons[i], horizons[j],
-                                                         mean_threshold=mean_threshold,
-                                                         adjacency=adjacency)
-                    if merge_code == 3:
-                        merged = Horizon.overlap_merge(horizons[i], horizons[j], inplace=True)
-                    elif merge_code == 2:
-                        merged = Horizon.adjacent_merge(horizons[i], horizons[j], inplace=True,
-                                                        mean_threshold=mean_threshold,
-                                                        adjacency=adjacency)
-                    else:
-                        merged = False
-
-                    if merged:
-                        _ = horizons.pop(j)
-                        flag = True
-                    else:
-                        j += 1
-                i += 1
-        return horizons
+        index = HorizonMergeIndex(mean_threshold=mean_threshold, adjacency=adjacency)
+        for horizon in horizons:
+            if len(horizon) >= minsize:
+                index.add(horizon)
+
+        for i in range(len(index)):
+            if not index.is_root(i):
+                continue
+
+            # Candidates are checked in the order of the list; after each merge, the grown horizon is queried again
+            queue = index.candidates(index.horizons[i], start=i + 1)
+            queued = set(queue)
+            while queue:
+                j = heapq.heappop(queue)
+                if index.absorb(i, j):
+                    for k in index.candidates(index.horizons[i], start=j + 1):
+                        if k not in queued:
+                            heapq.heappush(queue, k)
+                            queued.add(k)
+        return index.roots()
 
 
     @staticmethod
@@ -1792,10 +1957,19 @@ class Horizon:
         counts_matrix = np.zeros(geometry.lens, dtype=np.int32)
 
         for horizon in horizons:
-            fm = horizon.full_matrix
-            horizon_matrix[fm != Horizon.FILL_VALUE] += fm[fm != Horizon.FILL_VALUE]
-            std_matrix[fm != Horizon.FILL_VALUE] += fm[fm != Horizon.FILL_VALUE] ** 2
-            counts_matrix[fm != Horizon.FILL_VALUE] += 1
+            # Add each horizon block by block: whole matrix for dense ones, separate tiles for tiled ones
+            if horizon.tiles is not None:
+                blocks = horizon.tiles.blocks()
+            else:
+                blocks = [(horizon.i_min, horizon.x_min, horizon.matrix)]
+
+            for i_start, x_start, block in blocks:
+                block = block[:geometry.lens[0] - i_start, :geometry.lens[1] - x_start].astype(np.float32)
+                location = (slice(i_start, i_start + block.shape[0]), slice(x_start, x_start + block.shape[1]))
+                mask = block != Horizon.FILL_VALUE
+                horizon_matrix[location][mask] += block[mask]
+                std_matrix[location][mask] += block[mask] ** 2
+                counts_matrix[location][mask] += 1
 
         horizon_matrix[counts_matrix != 0] /= counts_matrix[counts_matrix != 0]
         horizon_matrix[counts_matrix == 0] = Horizon.FILL_VALUE
@@ -1967,11 +2141,17 @@ class Horizon:
 
 
     def put_on_full(self, matrix=None, fill_value=None, dtype=np.float32):
-        """ Create a matrix in cubic coordinate system. """
-        matrix = matrix if matrix is not None else self.matrix
+        """ Create a matrix in cubic coordinate system.
+        If `matrix` is not supplied for a tiled horizon, its tiles are put directly on the background.
+        """
         fill_value = fill_value if fill_value is not None else self.FILL_VALUE
-
         background = np.full(self.cube_shape[:-1], fill_value, dtype=dtype)
+
+        if matrix is None and self.tiles is not None:
+            self.tiles.put(background)
+            return background
+
+        matrix = matrix if matrix is not None else self.matrix
         background[self.i_min:self.i_max+1, self.x_min:self.x_max+1] = matrix
         return background
 
@@ -2220,6 +2400,18 @@ class Horizon:
         for attr in self._cached_attributes:
             getattr(self, attr).reset_instance(self)
 
+    def invalidate_disk_cache(self):
+        """ Remove attributes and metrics of the current horizon data from the disk cache.
+
+        Returns
+        -------
+        int
+            Number of removed values.
+        """
+        if self.disk_cache is None:
+            return 0
+        return self.disk_cache.invalidate(self.cache_identity)
+
 
     def __copy__(self):
         """ Create a shallow copy of a horizon.
@@ -2228,6 +2420,8 @@ class Horizon:
         -------
         A horizon object with new matrix object and a reference to the old geometry attribute.
         """
+        if self.tiles is not None:
+            return Horizon(self.tiles.copy(), self.geometry, name=f'copy_of_{self.name}')
         return Horizon(np.copy(self.matrix), self.geometry, i_min=self.i_min, x_min=self.x_min,
                        name=f'copy_of_{self.name}')
 
@@ -2236,6 +2430,349 @@ class StructuredHorizon(Horizon):
     """ Convenient alias for :class:`.Horizon` class. """
 
 
+class HorizonTiles:
+    """ Sparse tiled storage of a depth map.
+
+    Spatial range of the cube is split into square tiles of `tile_size`, aligned to its origin, and only tiles with
+    at least one point of the horizon are allocated. Each tile is a matrix of depths, filled with
+    :attr:`.Horizon.FILL_VALUE` where the horizon is absent. As tiles of all horizons share the same grid,
+    merges are done tile by tile, without allocating arrays over the shared bbox.
+
+    Parameters
+    ----------
+    tiles : dict
+        Mapping from (iline, xline) index of a tile to its matrix.
+    tile_size : int
+        Spatial size of tiles.
+    """
+    def __init__(self, tiles=None, tile_size=64):
+        self.tiles = tiles if tiles is not None else {}
+        self.tile_size = tile_size
+
+    @classmethod
+    def from_points(cls, points, tile_size=64, dtype=np.int32):
+        """ Create tiles from (N, 3) array of points in cubic coordinates. """
+        points = np.asarray(points).astype(np.int64)
+        keys = points[:, :2] // tile_size
+        order = np.lexsort((keys[:, 1], keys[:, 0]))
+        bounds = np.nonzero(np.any(np.diff(keys[order], axis=0), axis=1))[0] + 1
+
+        tiles = {}
+        for group in np.split(order, bounds):
+            if len(group) == 0:
+                continue
+            key = tuple(keys[group[0]])
+            tile = np.full((tile_size, tile_size), Horizon.FILL_VALUE, dtype=dtype)
+            tile[points[group, 0] - key[0] * tile_size, points[group, 1] - key[1] * tile_size] = points[group, 2]
+            tiles[key] = tile
+        return cls(tiles, tile_size)
+
+    @classmethod
+    def from_matrix(cls, matrix, i_min, x_min, tile_size=64):
+        """ Create tiles from depth map, located at (i_min, x_min). """
+        points = Horizon.matrix_to_points(matrix) + np.array([i_min, x_min, 0])
+        return cls.from_points(points, tile_size=tile_size, dtype=matrix.dtype)
+
+    def __len__(self):
+        return sum(np.count_nonzero(tile != Horizon.FILL_VALUE) for tile in self.tiles.values())
+
+    def copy(self):
+        """ Copy of the storage with copies of all the tiles. """
+        return HorizonTiles({key: np.copy(tile) for key, tile in self.tiles.items()}, self.tile_size)
+
+    def blocks(self):
+        """ Generate (i_start, x_start, tile) for every allocated tile. """
+        for (i, x), tile in sorted(self.tiles.items()):
+            yield i * self.tile_size, x * self.tile_size, tile
+
+    def to_points(self):
+        """ Convert to (N, 3) array of points in cubic coordinates. """
+        points = [Horizon.matrix_to_points(tile) + np.array([i_start, x_start, 0])
+                  for i_start, x_start, tile in self.blocks()]
+        return np.concatenate(points) if points else np.zeros((0, 3), dtype=np.int32)
+
+    def depths(self):
+        """ Array of depths of all points. """
+        depths = [tile[tile != Horizon.FILL_VALUE] for _, _, tile in self.blocks()]
+        return np.concatenate(depths) if depths else np.zeros(0, dtype=np.int32)
+
+    def bounds(self):
+        """ Spatial bbox of present points: i_min, i_max, x_min, x_max. """
+        i_min, x_min = np.inf, np.inf
+        i_max, x_max = -np.inf, -np.inf
+        for i_start, x_start, tile in self.blocks():
+            mask = tile != Horizon.FILL_VALUE
+            rows, columns = np.nonzero(mask.any(axis=1))[0], np.nonzero(mask.any(axis=0))[0]
+            if len(rows) == 0:
+                continue
+            i_min, i_max = min(i_min, i_start + rows[0]), max(i_max, i_start + rows[-1])
+            x_min, x_max = min(x_min, x_start + columns[0]), max(x_max, x_start + columns[-1])
+        return int(i_min), int(i_max), int(x_min), int(x_max)
+
+    def put(self, background, i_start=0, x_start=0):
+        """ Put present points of tiles on `background`, located at (i_start, x_start) in cubic coordinates. """
+        size = self.tile_size
+        i_stop, x_stop = i_start + background.shape[0], x_start + background.shape[1]
+
+        for i in range(i_start // size, (i_stop - 1) // size + 1):
+            for x in range(x_start // size, (x_stop - 1) // size + 1):
+                tile = self.tiles.get((i, x))
+                if tile is None:
+                    continue
+
+                # Overlap of the tile and the background in cubic coordinates
+                overlap_i_min, overlap_i_max = max(i * size, i_start), min((i + 1) * size, i_stop)
+                overlap_x_min, overlap_x_max = max(x * size, x_start), min((x + 1) * size, x_stop)
+
+                part = tile[overlap_i_min - i * size:overlap_i_max - i * size,
+                            overlap_x_min - x * size:overlap_x_max - x * size]
+                mask = part != Horizon.FILL_VALUE
+                background[overlap_i_min - i_start:overlap_i_max - i_start,
+                           overlap_x_min - x_start:overlap_x_max - x_start][mask] = part[mask]
+        return background
+
+    def crop(self, i_start, i_stop, x_start, x_stop, dtype=np.int32):
+        """ Dense depth map of [i_start:i_stop, x_start:x_stop] region in cubic coordinates. """
+        background = np.full((i_stop - i_start, x_stop - x_start), Horizon.FILL_VALUE, dtype=dtype)
+        return self.put(background, i_start, x_start)
+
+    def overlap_merge(self, other):
+        """ Merge tiles of two horizons: depths are averaged where both are present, same as in dense merges. """
+        tiles = {key: np.copy(tile) for key, tile in self.tiles.items()}
+        for key, tile in other.tiles.items():
+            if key not in tiles:
+                tiles[key] = np.copy(tile)
+                continue
+
+            merged = tiles[key]
+            present, other_present = merged != Horizon.FILL_VALUE, tile != Horizon.FILL_VALUE
+            both = present & other_present
+            merged[both] = (merged[both] + tile[both]) // 2
+            merged[~present & other_present] = tile[~present & other_present]
+        return HorizonTiles(tiles, self.tile_size)
+
+    def adjacent_diffs(self, other, adjacency=3):
+        """ Absolute differences between depths of `self` and depths of `other`, dilated by `adjacency`,
+        at points where `self` is present and `other` is not.
+        """
+        kernel = np.ones((3, 3), np.float32)
+        diffs = []
+        for i_start, x_start, tile in self.blocks():
+            window = other.crop(i_start - adjacency, i_start + tile.shape[0] + adjacency,
+                                x_start - adjacency, x_start + tile.shape[1] + adjacency)
+            if (window == Horizon.FILL_VALUE).all():
+                continue
+
+            dilated = cv2.dilate(window.astype(np.float32), kernel, iterations=adjacency).astype(np.int32)
+            dilated = dilated[adjacency:adjacency + tile.shape[0], adjacency:adjacency + tile.shape[1]]
+            window = window[adjacency:adjacency + tile.shape[0], adjacency:adjacency + tile.shape[1]]
+
+            mask = (tile != Horizon.FILL_VALUE) & (window == Horizon.FILL_VALUE) & (dilated != Horizon.FILL_VALUE)
+            diffs.append(np.abs(tile[mask] - dilated[mask]))
+        return np.concatenate(diffs) if diffs else np.zeros(0, dtype=np.int32)
+
+
+class HorizonMergeIndex:
+    """ Spatial index over horizons to find the ones, that can possibly be merged, without checking every pair.
+
+    Each horizon is registered in buckets of a regular spatial grid, that intersect its bbox, dilated by `adjacency`.
+    Candidates for a query are taken from the buckets of its bbox and then filtered by exact spatial and depth ranges:
+    pairs, rejected by this filtering, are never mergeable by :meth:`.Horizon.verify_merge`.
+    Horizons, merged into other ones, are tracked in a union-find structure instead of being removed from the list.
+
+    Parameters
+    ----------
+    mean_threshold : number
+        Height threshold for mean distances. Also used as a margin for depth ranges.
+    adjacency : int
+        Margin to consider horizons close (spatially).
+    bucket_size : int
+        Spatial size of buckets of the grid.
+    """
+    def __init__(self, mean_threshold=2.0, adjacency=3, bucket_size=64):
+        self.mean_threshold, self.adjacency, self.bucket_size = mean_threshold, adjacency, bucket_size
+
+        self.horizons = []
+        self.parents = []
+        self.bounds = []
+        self.buckets = {}
+
+    def __len__(self):
+        return len(self.horizons)
+
+    def add(self, horizon):
+        """ Register a new horizon in the index and return its position. """
+        index = len(self.horizons)
+        self.horizons.append(horizon)
+        self.parents.append(index)
+        self.bounds.append(None)
+        self.update(index)
+        return index
+
+    def update(self, index):
+        """ Refresh bounds of a horizon, changed inplace, and register it in the new buckets. """
+        horizon = self.horizons[index]
+        bounds = (horizon.i_min, horizon.i_max, horizon.x_min, horizon.x_max, horizon.h_min, horizon.h_max)
+        self.bounds[index] = bounds
+
+        for key in self._keys(bounds, margin=self.adjacency):
+            self.buckets.setdefault(key, set()).add(index)
+
+    def _keys(self, bounds, margin=0):
+        """ Buckets, intersecting with bbox, dilated by `margin`. """
+        i_min, i_max, x_min, x_max = bounds[:4]
+        size = self.bucket_size
+        return product(range((i_min - margin) // size, (i_max + margin) // size + 1),
+                       range((x_min - margin) // size, (x_max + margin) // size + 1))
+
+    def find(self, index):
+        """ Position of the horizon, that the `index`-th one was merged into. """
+        while self.parents[index] != index:
+            self.parents[index] = self.parents[self.parents[index]]
+            index = self.parents[index]
+        return index
+
+    def is_root(self, index):
+        """ Whether the `index`-th horizon was not merged into any other. """
+        return self.parents[index] == index
+
+    def roots(self):
+        """ Horizons, that were not merged into any other, in the order of addition. """
+        return [horizon for index, horizon in enumerate(self.horizons) if self.is_root(index)]
+
+    def candidates(self, horizon, start=0):
+        """ Sorted positions of not merged horizons, starting from `start`, that can possibly be merged with `horizon`.
+        """
+        bounds = (horizon.i_min, horizon.i_max, horizon.x_min, horizon.x_max, horizon.h_min, horizon.h_max)
+        i_min, i_max, x_min, x_max, h_min, h_max = bounds
+
+        indices = set()
+        for key in self._keys(bounds):
+            indices.update(self.buckets.get(key, ()))
+
+        result = []
+        for index in indices:
+            if index < start or not self.is_root(index):
+                continue
+
+            other_i_min, other_i_max, other_x_min, other_x_max, other_h_min, other_h_max = self.bounds[index]
+            if other_i_min > i_max + self.adjacency or i_min > other_i_max + self.adjacency:
+                continue
+            if other_x_min > x_max + self.adjacency or x_min > other_x_max + self.adjacency:
+                continue
+            if other_h_min >= h_max + self.mean_threshold or h_min >= other_h_max + self.mean_threshold:
+                continue
+            result.append(index)
+        return sorted(result)
+
+    def merge(self, target, horizon):
+        """ Try to merge `horizon` into the `target`-th one inplace. Same checks, as in :meth:`.Horizon.merge_list`.
+
+        Returns
+        -------
+        bool
+            Whether the horizons were merged.
+        """
+        target_horizon = self.horizons[target]
+        merge_code, _ = Horizon.verify_merge(target_horizon, horizon,
+                                             mean_threshold=self.mean_threshold,
+                                             adjacency=self.adjacency)
+        if merge_code == 3:
+            merged = Horizon.overlap_merge(target_horizon, horizon, inplace=True)
+        elif merge_code == 2:
+            merged = Horizon.adjacent_merge(target_horizon, horizon, inplace=True,
+                                            mean_threshold=self.mean_threshold,
+                                            adjacency=self.adjacency)
+        else:
+            merged = False
+
+        if merged:
+            self.update(target)
+        return bool(merged)
+
+    def absorb(self, target, index):
+        """ Try to merge the `index`-th horizon into the `target`-th one, and mark it as merged on success. """
+        merged = self.merge(target, self.horizons[index])
+        if merged:
+            self.parents[index] = target
+        return merged
+
+
+class LabelsUnion:
+    """ Union-find over labels of regions from separately labeled chunks: zero is the background.
+    Labels of each chunk are shifted to be unique with :meth:`.add`, and labels of regions, that touch each other
+    on the shared planes of chunks, are merged with :meth:`.union`.
+    """
+    def __init__(self):
+        self.parents = [0]
+
+    def add(self, num):
+        """ Register `num` new labels. Returns the shift to add to positive labels of the chunk. """
+        shift = len(self.parents) - 1
+        self.parents.extend(range(len(self.parents), len(self.parents) + num))
+        return shift
+
+    def find(self, label_):
+        """ Root label of the region, with path halving. """
+        parents = self.parents
+        while parents[label_] != label_:
+            parents[label_] = parents[parents[label_]]
+            label_ = parents[label_]
+        return label_
+
+    def union(self, prev_plane, plane):
+        """ Merge labels at the same positions of two labeled planes. """
+        both = (prev_plane > 0) & (plane > 0)
+        for label_a, label_b in np.unique(np.stack([prev_plane[both], plane[both]], axis=1), axis=0):
+            root_a, root_b = self.find(label_a), self.find(label_b)
+            if root_a != root_b:
+                self.parents[max(root_a, root_b)] = min(root_a, root_b)
+
+    def roots(self):
+        """ Array with the root label for each of the labels. """
+        return np.array([self.find(label_) for label_ in range(len(self.parents))], dtype=np.int64)
+
+
+@njit
+def _mask_to_traces(labeled, i_stop, x_stop, mode):
+    """ Reduce depths of each labeled region along traces up to `i_stop`, `x_stop`.
+    Each run of the same label along a trace makes a record of (label, iline, xline, value, number of points),
+    where value is the sum, minimum or maximum of depths for `mode` 0, 1 and 2 respectively.
+    """
+    n_records = 0
+    for i in range(i_stop):
+        for x in range(x_stop):
+            prev = 0
+            for h in range(labeled.shape[2]):
+                current = labeled[i, x, h]
+                if current not in (0, prev):
+                    n_records += 1
+                prev = current
+
+    records = np.empty((n_records, 5), dtype=np.int64)
+    position = -1
+    for i in range(i_stop):
+        for x in range(x_stop):
+            prev = 0
+            for h in range(labeled.shape[2]):
+                current = labeled[i, x, h]
+                if current != 0:
+                    if current != prev:
+                        position += 1
+                        records[position, 0] = current
+                        records[position, 1] = i
+                        records[position, 2] = x
+                        records[position, 3] = 0 if mode == 0 else h
+                        records[position, 4] = 0
+
+                    if mode == 0:
+                        records[position, 3] += h
+                    elif mode == 2:
+                        records[position, 3] = h
+                    records[position, 4] += 1
+                prev = current
+    return records
+
 @njit(parallel=True)
 def _smoothing_function(src, kernel, fill_value, preserve=False, margin=33):
     #pylint: disable=not-an-iterable
@@ -1,10 +1,14 @@
 """ Contains metrics for various labels (horizons, facies, etc) and cubes. """
 #pylint: disable=too-many-lines, not-an-iterable
+import json
 from copy import copy
 from textwrap import dedent
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from tqdm.auto import tqdm
 
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 from numba import njit, prange
 import matplotlib.colors as mcolors
 
@@ -90,8 +94,7 @@ class BaseSeismicMetric(Metrics):
                 agg = 'nanmean'
 
         # Get metric, then aggregate
-        metric_fn = getattr(self, metric)
-        metric_val, plot_dict = metric_fn(**kwargs)
+        metric_val, plot_dict = self.compute_metric(metric, **kwargs)
         metric_val = self._aggregate(metric_val, agg)
 
         # Get plot parameters
@@ -113,6 +116,10 @@ class BaseSeismicMetric(Metrics):
                 pass
         return metric_val
 
+    def compute_metric(self, metric, **kwargs):
+        """ Compute metric by its name: returns metric values and parameters of its plot. """
+        return getattr(self, metric)(**kwargs)
+
     def _aggregate(self, metric, agg=None):
         if agg is not None:
             if callable(agg):
@@ -575,6 +582,9 @@ class HorizonMetrics(BaseSeismicMetric):
     other parameters
         Passed directly to :meth:`.Horizon.get_cube_values` or :meth:`.Horizon.get_cube_values_line`.
     """
+    # Placeholder for `METRIC_CMAP` in parameters of plots, stored in the disk cache
+    METRIC_CMAP_NAME = '__METRIC_CMAP__'
+
     AVAILABLE_METRICS = [
         'local_corrs', 'support_corrs',
         'local_btch', 'support_btch',
@@ -624,6 +634,56 @@ class HorizonMetrics(BaseSeismicMetric):
         self._data[self._data == Horizon.FILL_VALUE] = np.nan
         return self._data
 
+    @staticmethod
+    def load_data(metrics):
+        """ Cut data along horizons of multiple instances at once, in one pass over each of the cubes.
+        Should be used instead of accessing `data` of each instance, when many horizons of the same cube are evaluated.
+
+        Note that data of all of the instances is kept in memory at once: each of them is an array of
+        (ilines, xlines, window) shape, so peak memory grows with the number of instances.
+        Use :meth:`.iterate_loaded` to evaluate many horizons with bounded memory.
+
+        Parameters
+        ----------
+        metrics : sequence of :class:`.HorizonMetrics`
+            Instances to load data for. Ones with already loaded data or computed on a slide are skipped.
+        """
+        #pylint: disable=protected-access
+        groups = {}
+        for item in metrics:
+            if item.spatial and item._data is None:
+                groups.setdefault(id(item.horizon.geometry), []).append(item)
+
+        for group in groups.values():
+            geometry = group[0].horizon.geometry
+            values = geometry.load_horizons_values([item.horizon for item in group],
+                                                   window=[item.window for item in group],
+                                                   offset=[item.offset for item in group],
+                                                   chunk_size=group[0].chunk_size)
+            for item, data in zip(group, values):
+                item._data = data
+
+    @staticmethod
+    def iterate_loaded(metrics, group_size=4):
+        """ Iterate over instances, loading data for `group_size` of them at a time with :meth:`.load_data`.
+        Data of each instance is released, when the next one is requested, so that no more than `group_size`
+        arrays of (ilines, xlines, window) shape are kept in memory.
+
+        Parameters
+        ----------
+        metrics : sequence of :class:`.HorizonMetrics`
+            Instances to load data for.
+        group_size : int
+            Number of instances to load data for in one pass over the cube.
+        """
+        #pylint: disable=protected-access
+        for start in range(0, len(metrics), group_size):
+            group = metrics[start:start + group_size]
+            HorizonMetrics.load_data(group)
+            for item in group:
+                yield item
+                item._data, item._probs = None, None
+
     @property
     def probs(self):
         """ Probabilistic interpretation of `data`. """
@@ -638,6 +698,36 @@ class HorizonMetrics(BaseSeismicMetric):
             self._probs = hist_matrix / np.sum(hist_matrix, axis=-1, keepdims=True) + self.EPS
         return self._probs
 
+    def compute_metric(self, metric, use_cache=True, **kwargs):
+        """ Compute metric by its name. If the cube has a disk cache, then results are stored there, keyed by data
+        of the horizons and parameters of evaluation, and loaded on subsequent calls, even from other runs.
+        """
+        disk_cache = self.horizon.disk_cache
+        if not use_cache or disk_cache is None or not all(hasattr(item, 'cache_identity') for item in self.horizons):
+            return super().compute_metric(metric, **kwargs)
+
+        key = (type(self).__name__, metric, sorted(kwargs.items()),
+               [item.cache_identity for item in self.horizons[1:]],
+               self.orientation, self.line, self.window, self.offset, self.normalize)
+        result = disk_cache.get(self.horizon.cache_identity, key, with_info=True)
+        if result is not None:
+            metric_val, plot_dict = result
+            return metric_val, {key_: METRIC_CMAP if value == self.METRIC_CMAP_NAME else value
+                                for key_, value in plot_dict.items()}
+
+        metric_val, plot_dict = super().compute_metric(metric, **kwargs)
+
+        # Parameters of plot are stored as JSON: the only non-serializable value, expected there, is the colormap
+        info = {key_: self.METRIC_CMAP_NAME if value is METRIC_CMAP else value for key_, value in plot_dict.items()}
+        try:
+            json.dumps(info)
+        except TypeError:
+            info = None
+
+        if info is not None and isinstance(metric_val, np.ndarray) and metric_val.dtype != object:
+            disk_cache.put(self.horizon.cache_identity, key, metric_val, info=info)
+        return metric_val, plot_dict
+
     def instantaneous_phase(self, **kwargs):
         """ Compute instantaneous phase via Hilbert transform. """
         #pylint: disable=unexpected-keyword-arg
@@ -776,7 +866,13 @@ class HorizonMetrics(BaseSeismicMetric):
 
 
 class GeometryMetrics(BaseSeismicMetric):
-    """ Metrics of cube quality. """
+    """ Metrics of cube quality.
+
+    When evaluated by :meth:`.evaluate`, `local` and `support` metrics are computed in spatial tiles of `tile_size`:
+    slices of `hist_matrix` are loaded lazily from the stored meta of a geometry, and `probs` are computed
+    for each tile separately, so that the memory usage does not depend on the size of the cube.
+    Direct calls to metric methods use the whole `hist_matrix`.
+    """
     AVAILABLE_METRICS = [
         'local_corrs', 'support_corrs',
         'local_btch', 'support_btch',
@@ -788,7 +884,7 @@ class GeometryMetrics(BaseSeismicMetric):
     ]
 
 
-    def __init__(self, geometries):
+    def __init__(self, geometries, tile_size=512):
         super().__init__()
 
         geometries = list(geometries) if isinstance(geometries, tuple) else geometries
@@ -800,13 +896,19 @@ class GeometryMetrics(BaseSeismicMetric):
         self._probs = None
         self._bad_traces = None
 
+        # Data of the currently processed tile
+        self.tile_size = tile_size
+        self._tile = None
+
         self.spatial = True
         self.name = 'hist_matrix'
         self.cube_name = self.geometry.name
 
     @property
     def data(self):
-        """ Histogram of values for every trace in the cube. """
+        """ Histogram of values for every trace in the cube or in the current tile. """
+        if self._tile is not None:
+            return self._tile['data']
         if self._data is None:
             self._data = self.geometry.hist_matrix
         return self._data
@@ -814,6 +916,8 @@ class GeometryMetrics(BaseSeismicMetric):
     @property
     def bad_traces(self):
         """ Traces to exclude from metric evaluations: bad traces are marked with `1`s. """
+        if self._tile is not None:
+            return self._tile['bad_traces']
         if self._bad_traces is None:
             self._bad_traces = self.geometry.zero_traces
         return self._bad_traces
@@ -821,30 +925,130 @@ class GeometryMetrics(BaseSeismicMetric):
     @property
     def probs(self):
         """ Probabilistic interpretation of `data`. """
+        if self._tile is not None:
+            if self._tile.get('probs') is None:
+                data = self._tile['data']
+                self._tile['probs'] = data / np.sum(data, axis=-1, keepdims=True) + self.EPS
+            return self._tile['probs']
         if self._probs is None:
             self._probs = self.data / np.sum(self.data, axis=-1, keepdims=True) + self.EPS
         return self._probs
 
 
-    def tracewise(self, func, l=3, pbar=True, **kwargs):
-        """ Apply `func` to compare two cubes tracewise. """
-        pbar = tqdm if pbar else lambda iterator, *args, **kwargs: iterator
-        metric = np.full((*self.geometry.ranges, l), np.nan)
+    def compute_metric(self, metric, **kwargs):
+        """ Compute `local` and `support` metrics in spatial tiles, others on the whole data. """
+        if metric.startswith('local'):
+            return self.compute_tiled(metric, **kwargs)
+        if metric.startswith('support') and not isinstance(kwargs.get('supports', 10), str):
+            return self.compute_tiled(metric, **kwargs)
+        return super().compute_metric(metric, **kwargs)
 
-        indices = [geometry.dataframe['trace_index'] for geometry in self.geometries]
+    def compute_tiled(self, metric, **kwargs):
+        """ Compute metric in spatial tiles.
+        For `local` metrics, each tile is loaded with margins of half of the kernel size.
+        For `support` metrics, support traces are loaded once and appended to the data of each tile.
+        """
+        method = getattr(self, metric)
+        bad_traces = self.geometry.zero_traces
+        i_range, x_range = bad_traces.shape
+        tile_size = np.broadcast_to(self.tile_size, (2,))
 
-        for idx, _ in pbar(indices[0].iteritems(), total=len(indices[0])):
-            trace_indices = [ind[idx] for ind in indices]
+        if metric.startswith('local'):
+            margin = int(kwargs.get('kernel_size', self.LOCAL_DEFAULTS['kernel_size']) // 2)
+        else:
+            # Same traces are excluded both from the choice of supports and from the result
+            margin = 0
+            bad_traces = self.make_bad_traces()
+            n_supports = kwargs.pop('supports', 10)
+            supports = self.make_supports(n_supports, kwargs.pop('safe_strip', 0), bad_traces=bad_traces)
+            support_data = np.stack([self.geometry.load_meta_slice('hist_matrix', (i, x)) for i, x in supports])
+
+        metric_matrix, plot_dict = None, None
+        try:
+            for i_start in range(0, i_range, tile_size[0]):
+                for x_start in range(0, x_range, tile_size[1]):
+                    i_stop, x_stop = min(i_start + tile_size[0], i_range), min(x_start + tile_size[1], x_range)
+                    i_from, x_from = max(i_start - margin, 0), max(x_start - margin, 0)
+                    locations = (slice(i_from, min(i_stop + margin, i_range)),
+                                 slice(x_from, min(x_stop + margin, x_range)))
+                    data = self.geometry.load_meta_slice('hist_matrix', locations)
+                    tile_bad_traces = bad_traces[locations]
+
+                    if metric.startswith('local'):
+                        self._tile = {'data': data, 'bad_traces': tile_bad_traces}
+                        values, plot_dict = method(**kwargs)
+                        values = values[i_start - i_from : i_stop - i_from, x_start - x_from : x_stop - x_from]
+                    else:
+                        # Supports are put after traces of the tile, as a column of traces
+                        shape = data.shape[:2]
+                        data = np.concatenate([data.reshape(-1, data.shape[-1]), support_data])[:, np.newaxis]
+                        tile_bad_traces = np.concatenate([tile_bad_traces.ravel(),
+                                                          np.zeros(len(supports), dtype=bad_traces.dtype)])
+                        positions = np.stack([np.arange(len(supports)) + np.prod(shape),
+                                              np.zeros(len(supports), dtype=np.int64)], axis=1)
+
+                        self._tile = {'data': data, 'bad_traces': tile_bad_traces[:, np.newaxis]}
+                        values, plot_dict = method(supports=positions, **kwargs)
+                        values = values[:np.prod(shape), 0].reshape(*shape, *values.shape[2:])
+
+                    if metric_matrix is None:
+                        metric_matrix = np.full((i_range, x_range, *values.shape[2:]), np.nan)
+                    metric_matrix[i_start:i_stop, x_start:x_stop] = values
+        finally:
+            self._tile = None
+
+        if metric.startswith('support'):
+            metric_matrix[bad_traces == 1] = np.nan
+            if isinstance(n_supports, int):
+                plot_dict['title'] = plot_dict['title'].replace(f'with {n_supports} supports',
+                                                                f'with {n_supports} random supports', 1)
+        return metric_matrix, plot_dict
+
+    def make_bad_traces(self):
+        """ Zero traces of the geometry and traces with constant histogram, same as in :func:`.compute_support_func`.
+        Histograms are loaded in spatial tiles.
+        """
+        bad_traces = np.copy(self.geometry.zero_traces)
+        i_range, x_range = bad_traces.shape
+        tile_size = np.broadcast_to(self.tile_size, (2,))
+
+        for i_start in range(0, i_range, tile_size[0]):
+            for x_start in range(0, x_range, tile_size[1]):
+                locations = (slice(i_start, min(i_start + tile_size[0], i_range)),
+                             slice(x_start, min(x_start + tile_size[1], x_range)))
+                data = self.geometry.load_meta_slice('hist_matrix', locations)
+                bad_traces[locations][np.std(data, axis=-1) == 0.0] = 1
+        return bad_traces
+
+    def make_supports(self, supports, safe_strip=0, bad_traces=None):
+        """ Positions of support traces: either random non-bad traces, made by :func:`.make_random_supports`
+        same as in :func:`.compute_support_func`, or the given ones.
+        If given, `bad_traces` are used to choose random supports from, and traces near borders are marked in them.
+        """
+        if isinstance(supports, int):
+            bad_traces = bad_traces if bad_traces is not None else self.make_bad_traces()
+            return make_random_supports(bad_traces, supports, safe_strip=safe_strip)
+        return np.array(supports)
 
-            header = self.geometries[0].segyfile.header[trace_indices[0]]
-            keys = [header.get(field) for field in self.geometries[0].byte_no]
-            store_key = [self.geometries[0].uniques_inversed[i][item] for i, item in enumerate(keys)]
-            store_key = tuple(store_key)
 
-            traces = [geometry.load_trace(trace_index) for
-                      geometry, trace_index in zip(self.geometries, trace_indices)]
+    def tracewise(self, func, l=3, pbar=True, block_size=10000, vectorized=False, **kwargs):
+        """ Apply `func` to compare two cubes tracewise.
+        Traces are matched by the values of indexing headers, and loaded by blocks of `block_size` traces.
 
-            metric[store_key] = func(*traces, **kwargs)
+        Parameters
+        ----------
+        func : callable
+            Function to compare traces with: takes one trace from each of the cubes and returns `l` numbers.
+        vectorized : bool
+            If True, `func` takes arrays of (n_traces, depth) shape from each of the cubes at once
+            and returns array of (n_traces, l) shape.
+        """
+        # Trace indices in each of the cubes, aligned to the traces of the first one
+        indices = [geometry.dataframe['trace_index'] for geometry in self.geometries]
+        trace_indices = [indices[0].values] + [ind.reindex(indices[0].index).values for ind in indices[1:]]
+
+        metric = self._tracewise(func, trace_indices, l=l, pbar=pbar, block_size=block_size,
+                                 vectorized=vectorized, **kwargs)
 
         title = f"tracewise {func}"
         plot_dict = {
@@ -858,21 +1062,14 @@ class GeometryMetrics(BaseSeismicMetric):
         }
         return metric, plot_dict
 
-    def tracewise_unsafe(self, func, l=3, pbar=True, **kwargs):
+    def tracewise_unsafe(self, func, l=3, pbar=True, block_size=10000, vectorized=False, **kwargs):
         """ Apply `func` to compare two cubes tracewise in an unsafe way:
         structure of cubes is assumed to be identical.
+        Parameters are the same, as in :meth:`.tracewise`.
         """
-        pbar = tqdm if pbar else lambda iterator, *args, **kwargs: iterator
-        metric = np.full((*self.geometry.ranges, l), np.nan)
-
-        for idx in pbar(range(len(self.geometries[0].dataframe))):
-            header = self.geometries[0].segyfile.header[idx]
-            keys = [header.get(field) for field in self.geometries[0].byte_no]
-            store_key = [self.geometries[0].uniques_inversed[i][item] for i, item in enumerate(keys)]
-            store_key = tuple(store_key)
-
-            traces = [geometry.load_trace(idx) for geometry in self.geometries]
-            metric[store_key] = func(*traces, **kwargs)
+        trace_index = np.arange(len(self.geometries[0].dataframe))
+        metric = self._tracewise(func, [trace_index] * len(self.geometries), l=l, pbar=pbar,
+                                 block_size=block_size, vectorized=vectorized, **kwargs)
 
         title = f"tracewise unsafe {func}"
         plot_dict = {
@@ -886,14 +1083,46 @@ class GeometryMetrics(BaseSeismicMetric):
         }
         return metric, plot_dict
 
+    def _tracewise(self, func, trace_indices, l=3, pbar=True, block_size=10000, vectorized=False, **kwargs):
+        """ Compare traces with `trace_indices` in each of the cubes, loading them by blocks. """
+        pbar = tqdm if pbar else lambda iterator, *args, **kwargs: iterator
+        metric = np.full((*self.geometry.ranges, l), np.nan)
+
+        # Spatial position of each trace of the first cube
+        positions = self.geometries[0].make_trace_positions()[trace_indices[0]]
+
+        for start in pbar(range(0, len(positions), block_size)):
+            stop = min(start + block_size, len(positions))
+            blocks = [geometry.load_traces(indices[start:stop])
+                      for geometry, indices in zip(self.geometries, trace_indices)]
+            key = (positions[start:stop, 0], positions[start:stop, 1])
+
+            if vectorized:
+                metric[key] = func(*blocks, **kwargs)
+            else:
+                metric[key] = [func(*traces, **kwargs) for traces in zip(*blocks)]
+        return metric
+
 
     def blockwise(self, func, l=3, pbar=True, kernel=(5, 5), block_size=(1000, 1000),
-                  heights=None, prep_func=None, **kwargs):
-        """ Apply function to all traces in lateral window """
+                  heights=None, prep_func=None, vectorized=False, n_workers=1, **kwargs):
+        """ Apply function to all traces in lateral window.
+        Windows are taken from each block as views by `sliding_window_view`, and blocks are processed
+        by `n_workers` threads, while the next ones are loaded.
 
+        Parameters
+        ----------
+        func : callable
+            Function to apply: takes array of (n_window_traces, depth) shape from each of the cubes
+            and returns `l` numbers.
+        vectorized : bool
+            If True, `func` takes arrays of (n_windows, n_window_traces, depth) shape for all of the windows
+            along one iline of a block at once, and returns array of (n_windows, l) shape.
+        n_workers : int
+            Number of threads to apply `func` to blocks with.
+        """
         window = np.array(kernel)
         low = window // 2
-        high = window - low
 
         total = np.product(self.geometries[0].ranges-window)
         prep_func = prep_func if prep_func else lambda x: x
@@ -903,26 +1132,43 @@ class GeometryMetrics(BaseSeismicMetric):
 
         heights = slice(0, self.geometries[0].cube_shape[2]) if heights is None else slice(*heights)
 
-        with pbar(total=total) as prog_bar:
+        def apply(il_block, xl_block, blocks):
+            # Windows of (n_ilines, n_xlines, depth, *kernel) shape for each of the cubes
+            views = [sliding_window_view(block, tuple(window), axis=(0, 1)) for block in blocks]
+            n_ilines, n_xlines = views[0].shape[:2]
+
+            for il_kernel in range(n_ilines):
+                # Traces of each window along the iline, as (n_xlines, n_window_traces, depth) arrays
+                subsets = [view[il_kernel].transpose(0, 2, 3, 1).reshape(n_xlines, -1, view.shape[2])
+                           for view in views]
+                if vectorized:
+                    values = func(*subsets, **kwargs)
+                else:
+                    values = [func(*items, **kwargs) for items in zip(*subsets)]
+
+                metric[il_block + low[0] + il_kernel, xl_block + low[1] : xl_block + low[1] + n_xlines, :] = values
+            return n_ilines * n_xlines
+
+        with pbar(total=total) as prog_bar, ThreadPoolExecutor(max_workers=n_workers) as executor:
+            futures = deque()
             for il_block in np.arange(0, self.geometries[0].cube_shape[0], block_size[0]-window[0]):
                 for xl_block in np.arange(0, self.geometries[0].cube_shape[1], block_size[1]-window[1]):
                     block_len = np.min((np.array(self.geometries[0].ranges) - (il_block, xl_block),
                                         block_size), axis=0)
+                    if (block_len < window).any():
+                        continue
                     locations = [slice(il_block, il_block + block_len[0]),
                                  slice(xl_block, xl_block + block_len[1]),
                                  heights]
 
+                    # Blocks are loaded in the main thread, while the previous ones are processed
                     blocks = [prep_func(geometry.load_crop(locations)) for geometry in self.geometries]
+                    futures.append(executor.submit(apply, il_block, xl_block, blocks))
+                    while len(futures) > n_workers:
+                        prog_bar.update(futures.popleft().result())
 
-                    for il_kernel in range(low[0], blocks[0].shape[0] - high[0]):
-                        for xl_kernel in range(low[1], blocks[0].shape[1] - high[1]):
-
-                            il_from, il_to = il_kernel - low[0], il_kernel + high[0]
-                            xl_from, xl_to = xl_kernel - low[1], xl_kernel + high[1]
-
-                            subsets = [b[il_from:il_to, xl_from:xl_to, :].reshape((-1, b.shape[-1])) for b in blocks]
-                            metric[il_block + il_kernel, xl_block + xl_kernel, :] = func(*subsets, **kwargs)
-                            prog_bar.update(1)
+            while futures:
+                prog_bar.update(futures.popleft().result())
 
         title = f"Blockwise {func}"
         plot_dict = {
@@ -986,10 +1232,17 @@ class NumbaNumpy:
 
 
 # Functions to compute metric from data-array
-def compute_local_func(function, name, data, bad_traces, kernel_size=3, reduce_func='nanmean', **kwargs):
+REDUCTIONS = {'nanmean': 0, 'mean': 0, 'nanmin': 1, 'min': 1, 'nanmax': 2, 'max': 2,
+              'nanstd': 3, 'std': 3, 'geomean': 4, 'harmean': 5}
+
+def compute_local_func(function, name, data, bad_traces, kernel_size=3, reduce_func='nanmean',
+                       symmetric=True, standardize=False, tile_size=256, **kwargs):
     """ Apply `function` in a `local` way: each entry in `data` is compared against its
     neighbours, and then those values are reduced to one number with `reduce_func`.
 
+    Data is processed in tiles of ilines, each of them by a parallel jit-compiled kernel.
+    If `function` is symmetric, it is evaluated only once for each unordered pair of neighbouring traces.
+
     Parameters
     ----------
     function : callable
@@ -1002,50 +1255,145 @@ def compute_local_func(function, name, data, bad_traces, kernel_size=3, reduce_f
         Traces to ignore during metric evaluation.
     kernel_size : int
         Size of window to reduce values in.
-    reduce_func : str or callable
+    reduce_func : str
         Function to reduce values in window with, e.g. `mean` or `nanmax`.
+    symmetric : bool
+        Whether `function` gives the same result for both orders of its arguments.
+    standardize : bool
+        Whether to subtract mean and divide by standard deviation of each trace before applying `function`.
+    tile_size : int
+        Number of ilines to process at once.
     """
     _ = kwargs
+    if reduce_func not in REDUCTIONS:
+        raise ValueError(f'Unknown reduce_func `{reduce_func}`: use one of {list(REDUCTIONS)}.')
 
-    reduce_func = getattr(NumbaNumpy, reduce_func)
+    k = int(np.floor(kernel_size / 2))
+    offsets = [(i, x) for i in range(-k, k + 1) for x in range(-k, k + 1)
+               if ((i, x) > (0, 0) if symmetric else (i, x) != (0, 0))]
+    offsets = np.array(offsets, dtype=np.int64).reshape(-1, 2)
 
-    bad_traces = np.copy(bad_traces)
-    bad_traces[np.std(data, axis=-1) == 0.0] = 1
+    i_range, x_range = data.shape[:2]
+    metric = np.full((i_range, x_range), np.nan)
+    for start in range(0, i_range, tile_size):
+        stop = min(start + tile_size, i_range)
+
+        # Each tile is taken with neighbouring ilines, so that all the pairs for its traces can be computed
+        tile_start, tile_stop = max(start - k, 0), min(stop + k, i_range)
+        tile = data[tile_start:tile_stop]
+        stds = np.std(tile, axis=-1)
+        tile_bad_traces = (bad_traces[tile_start:tile_stop] != 0) | (stds == 0.0)
 
-    padded = np.pad(data, ((kernel_size, kernel_size), (kernel_size, kernel_size), (0, 0)), constant_values=np.nan)
-    bad_traces = np.pad(bad_traces, kernel_size, constant_values=1.0)
+        if standardize:
+            stds[stds == 0.0] = 1.0
+            tile = (tile - np.mean(tile, axis=-1, keepdims=True)) / stds[..., np.newaxis]
 
-    metric = apply_local_func(function, reduce_func, padded, bad_traces, kernel_size)
-    metric = metric[kernel_size:-kernel_size, kernel_size:-kernel_size]
+        metric[start:stop] = apply_local_func(function, REDUCTIONS[reduce_func], tile, tile_bad_traces, offsets,
+                                              symmetric, start - tile_start, stop - tile_start)
     title = f'local {name}'
     return metric, title
 
 
-@njit
-def apply_local_func(compute_func, reduce_func, data, bad_traces, kernel_size):
-    """ Apply function in window. """
+@njit(parallel=True)
+def apply_local_func(compute_func, reduction, data, bad_traces, offsets, symmetric, start, stop):
+    """ Apply function to each pair of traces at `offsets` from each other, and reduce values for each trace
+    in [start, stop) ilines range. For `symmetric` functions, values for the opposite offsets are taken from
+    the neighbours, so `offsets` should contain only one of each pair of opposite offsets.
+    """
     #pylint: disable=too-many-nested-blocks, consider-using-enumerate
-    k = int(np.floor(kernel_size / 2))
     i_range, x_range = data.shape[:2]
-    metric = np.full((i_range, x_range), np.nan)
-
-    for il in prange(i_range):
-        for xl in prange(x_range):
-            if bad_traces[il, xl] == 0:
-                trace = data[il, xl, :]
-
-                metric_element = np.full((kernel_size, kernel_size), np.nan)
-                for _idx in prange(-k, k+1):
-                    for _jdx in prange(-k, k+1):
-                        if bad_traces[il+_idx, xl+_jdx] == 0:
-                            trace_ = data[il+_idx, xl+_jdx]
-                            metric_element[k+_idx, k+_jdx] = compute_func(trace, trace_)
-                metric_element[k, k] = np.nan
-
-                if np.sum(~np.isnan(metric_element)):
-                    metric[il, xl] = reduce_func(metric_element)
+    n_offsets = len(offsets)
+
+    # Value for each trace and each offset: for symmetric functions, ilines before `start` are also required.
+    # Without offsets, e.g. for `kernel_size` less than 3, there are no values, and the metric is all `nan`s
+    first = start
+    if symmetric and n_offsets > 0:
+        first = max(start - np.abs(offsets[:, 0]).max(), 0)
+    values = np.full((stop - first, x_range, n_offsets), np.nan)
+    for il in prange(first, stop):
+        for xl in range(x_range):
+            if bad_traces[il, xl]:
+                continue
+            trace = data[il, xl, :]
+            for o in range(n_offsets):
+                il_, xl_ = il + offsets[o, 0], xl + offsets[o, 1]
+                if 0 <= il_ < i_range and 0 <= xl_ < x_range and not bad_traces[il_, xl_]:
+                    values[il - first, xl, o] = compute_func(trace, data[il_, xl_, :])
+
+    metric = np.full((stop - start, x_range), np.nan)
+    for il in prange(start, stop):
+        state = np.empty(7)
+        for xl in range(x_range):
+            if bad_traces[il, xl]:
+                continue
+
+            _reset_reduction(state)
+            for o in range(n_offsets):
+                _update_reduction(state, values[il - first, xl, o])
+                if symmetric:
+                    il_, xl_ = il - offsets[o, 0], xl - offsets[o, 1]
+                    if first <= il_ < i_range and 0 <= xl_ < x_range:
+                        _update_reduction(state, values[il_ - first, xl_, o])
+            metric[il - start, xl] = _finalize_reduction(state, reduction)
     return metric
 
+@njit
+def _reset_reduction(state):
+    """ State of reduction: count, sum, sum of squares, min, max, product, sum of inverses. """
+    state[0], state[1], state[2] = 0.0, 0.0, 0.0
+    state[3], state[4] = np.inf, -np.inf
+    state[5], state[6] = 1.0, 0.0
+
+@njit
+def _update_reduction(state, value):
+    if not np.isnan(value):
+        state[0] += 1
+        state[1] += value
+        state[2] += value * value
+        state[3] = min(state[3], value)
+        state[4] = max(state[4], value)
+        state[5] *= value
+        state[6] += 1 / value
+
+@njit
+def _finalize_reduction(state, reduction):
+    """ Same as the functions of :class:`.NumbaNumpy` with codes from `REDUCTIONS`. """
+    count = state[0]
+    if count == 0:
+        result = np.nan
+    elif reduction == 0:
+        result = state[1] / count
+    elif reduction == 1:
+        result = state[3]
+    elif reduction == 2:
+        result = state[4]
+    elif reduction == 3:
+        mean = state[1] / count
+        result = np.sqrt(max(state[2] / count - mean * mean, 0.0))
+    elif reduction == 4:
+        result = np.power(state[5], 1 / count)
+    else:
+        result = count / state[6]
+    return result
+
+def make_random_supports(bad_traces, n_supports, safe_strip=0):
+    """ Positions of `n_supports` random traces, that are not bad and are at least `safe_strip` away from borders.
+    Traces near borders are marked as bad in `bad_traces` in-place. Generated with a fixed seed,
+    so that the same supports are used for the same `bad_traces`.
+
+    Returns
+    -------
+    np.ndarray
+        Array of (n_supports, 2) shape with iline and xline of each support.
+    """
+    if safe_strip:
+        bad_traces[:, :safe_strip], bad_traces[:, -safe_strip:] = 1, 1
+        bad_traces[:safe_strip, :], bad_traces[-safe_strip:, :] = 1, 1
+
+    np.random.seed(0)
+    non_zero_traces = np.where(bad_traces == 0)
+    indices = np.random.choice(len(non_zero_traces[0]), n_supports)
+    return np.array([non_zero_traces[0][indices], non_zero_traces[1][indices]]).T
 
 def compute_support_func(function_ndarray, function_str, name,
                          data, supports, bad_traces, safe_strip=0, line_no=None, **kwargs):
@@ -1078,14 +1426,7 @@ def compute_support_func(function_ndarray, function_str, name,
     if isinstance(supports, (int, tuple, list, np.ndarray)):
         if isinstance(supports, int):
             title = f'{name} with {supports} random supports'
-            if safe_strip:
-                bad_traces[:, :safe_strip], bad_traces[:, -safe_strip:] = 1, 1
-                bad_traces[:safe_strip, :], bad_traces[-safe_strip:, :] = 1, 1
-
-            np.random.seed(0)
-            non_zero_traces = np.where(bad_traces == 0)
-            indices = np.random.choice(len(non_zero_traces[0]), supports)
-            supports = np.array([non_zero_traces[0][indices], non_zero_traces[1][indices]]).T
+            supports = make_random_supports(bad_traces, supports, safe_strip=safe_strip)
 
         elif isinstance(supports, (tuple, list, np.ndarray)):
             title = f'{name} with {len(supports)} supports'
@@ -1117,12 +1458,15 @@ def compute_support_func(function_ndarray, function_str, name,
 def compute_local_corrs(data, bad_traces, kernel_size=3, reduce_func='nanmean', **kwargs):
     """ Compute correlation between each column in data and nearest traces. """
     return compute_local_func(_compute_local_corrs, 'correlation',
-                              data=data, bad_traces=bad_traces,
+                              data=data, bad_traces=bad_traces, standardize=True,
                               kernel_size=kernel_size, reduce_func=reduce_func, **kwargs)
 
 @njit
 def _compute_local_corrs(array_1, array_2):
-    result = np.sum((array_1 - np.mean(array_1)) * (array_2 - np.mean(array_2))) / (np.std(array_1) * np.std(array_2))
+    # Traces are already standardized, so correlation is just a mean of products
+    result = 0.0
+    for i, value in enumerate(array_1):
+        result += value * array_2[i]
     return result / len(array_1)
 
 
@@ -1134,26 +1478,29 @@ def compute_support_corrs(data, supports, bad_traces, safe_strip=0, line_no=None
                                 data=data, supports=supports, bad_traces=bad_traces,
                                 safe_strip=safe_strip, line_no=line_no, **kwargs)
 
-def _compute_support_corrs(data, supports, bad_traces):
+def _compute_support_corrs(data, supports, bad_traces, tile_size=256):
+    """ Correlations of standardized traces with standardized supports, computed as one matrix product
+    for each tile of ilines, so that only the tile is converted to float and centered at once.
+    """
     n_supports = len(supports)
     i_range, x_range, depth = data.shape
 
-    data_n = data - np.mean(data, axis=-1, keepdims=True)
-    data_stds = np.std(data, axis=-1)
-
-    support_traces = np.zeros((n_supports, depth))
-    for i in range(n_supports):
-        coord = supports[i]
-        support_traces[i, :] = data[coord[0], coord[1], :]
-    support_n = support_traces - np.mean(support_traces, axis=-1, keepdims=True)
-    support_stds = np.std(support_traces, axis=-1)
-
-    corrs = np.zeros((i_range, x_range, n_supports))
-    for i in range(n_supports):
-        cov = np.sum(support_n[i] * data_n, axis=-1) / depth
-        temp = cov / (support_stds[i] * data_stds)
-        temp[bad_traces == 1] = np.nan
-        corrs[:, :, i] = temp
+    support_traces = data[supports[:, 0], supports[:, 1], :].astype(np.float64)
+    support_traces -= np.mean(support_traces, axis=-1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        support_traces /= np.std(support_traces, axis=-1, keepdims=True)
+
+    corrs = np.empty((i_range, x_range, n_supports))
+    for start in range(0, i_range, tile_size):
+        stop = min(start + tile_size, i_range)
+        tile = data[start:stop].reshape(-1, depth).astype(np.float64)
+        tile -= np.mean(tile, axis=-1, keepdims=True)
+        stds = np.sqrt(np.einsum('ij,ij->i', tile, tile) / depth)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tile_corrs = (tile @ support_traces.T) / (depth * stds[:, np.newaxis])
+        tile_corrs[bad_traces[start:stop].ravel() == 1] = np.nan
+        corrs[start:stop] = tile_corrs.reshape(stop - start, x_range, n_supports)
     return corrs
 
 def _compute_line_corrs(data, bad_traces, support_il=None, support_xl=None):
@@ -1186,7 +1533,7 @@ def _compute_line_corrs(data, bad_traces, support_il=None, support_xl=None):
 def compute_local_crosscorrs(data, bad_traces, kernel_size=3, reduce_func='nanmean', **kwargs):
     """ Compute cross-correlation between each column in data and nearest traces. """
     return compute_local_func(_compute_local_crosscorrs, 'Cross-correlation',
-                              data=data, bad_traces=bad_traces,
+                              data=data, bad_traces=bad_traces, symmetric=False,
                               kernel_size=kernel_size, reduce_func=reduce_func, **kwargs)
 
 @njit
@@ -1205,24 +1552,28 @@ def compute_support_crosscorrs(data, supports, bad_traces, safe_strip=0, **kwarg
                                 data=data, supports=supports, bad_traces=bad_traces,
                                 safe_strip=safe_strip, **kwargs)
 
-def _compute_support_crosscorrs(data, supports, bad_traces):
+def _compute_support_crosscorrs(data, supports, bad_traces, tile_size=256):
+    """ Shifts of the maximum cross-correlation between each trace and supports.
+    Products at all of the shifts are computed as one matrix product with a matrix of shifted support
+    for each tile of ilines. Only one such matrix is kept in memory at a time.
+    """
     n_supports = len(supports)
     i_range, x_range, depth = data.shape
+    shifts = np.arange(depth)[:, np.newaxis] + np.arange(depth)[np.newaxis, :]
 
-    support_traces = np.zeros((n_supports, depth*2))
-    for i in range(n_supports):
-        coord = supports[i]
-        support_traces[i, :] = np.pad(data[coord[0], coord[1], :], pad_width=(depth//2, depth - depth//2))
+    divs = np.empty((i_range, x_range, n_supports))
+    for i, coord in enumerate(supports):
+        # Matrix of (depth, depth) shape: k-th column is the padded support, shifted by k
+        padded = np.pad(data[coord[0], coord[1], :].astype(np.float64), pad_width=(depth//2, depth - depth//2))
+        support_matrix = padded[shifts]
 
-    divs = np.zeros((i_range, x_range, n_supports))
-    for i in range(n_supports):
-        supports_ = support_traces[i]
-        temp = np.zeros((i_range, x_range, depth))
-        for k in range(depth):
-            temp[:, :, k] = np.sum(supports_[k:k+depth] * data, axis=-1)
-        temp = np.argmax(temp, axis=-1).astype(float) - depth//2
-        temp[bad_traces == 1] = np.nan
-        divs[:, :, i] = temp
+        for start in range(0, i_range, tile_size):
+            stop = min(start + tile_size, i_range)
+            tile = data[start:stop].reshape(-1, depth).astype(np.float64)
+
+            temp = np.argmax(tile @ support_matrix, axis=-1).astype(float) - depth//2
+            temp[bad_traces[start:stop].ravel() == 1] = np.nan
+            divs[start:stop, :, i] = temp.reshape(stop - start, x_range)
     return divs
 
 
@@ -1267,7 +1618,7 @@ def _compute_support_btch(data, supports, bad_traces):
 def compute_local_kl(data, bad_traces, kernel_size=3, reduce_func='nanmean', **kwargs):
     """ Compute Kullback-Leibler divergence between each column in data and nearest traces. """
     return compute_local_func(_compute_local_kl, 'KL-divergence',
-                              data=data, bad_traces=bad_traces,
+                              data=data, bad_traces=bad_traces, symmetric=False,
                               kernel_size=kernel_size, reduce_func=reduce_func, **kwargs)
 
 @njit
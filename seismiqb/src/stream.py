@@ -0,0 +1,184 @@
+""" Asynchronous stream of crops, loaded in the background. """
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class CropStream:
+    """ Iterator over ready-to-use batches of crops from a :class:`.SeismicCubeset`.
+    Batches are loaded by a pool of background threads, while the previous ones are consumed,
+    so that loading data overlaps with computations on it.
+
+    At most `prefetch` batches are loaded or kept ready at any moment: if the consumer is slower than loading,
+    new batches are not started until the ready ones are taken, so the memory usage stays bounded.
+
+    Crops are defined either by a regular grid, made by :meth:`.SeismicCubeset.make_grid`, or by a sampler.
+    In the first case, batches are produced in the order of the grid, so that predictions can be
+    assembled by :meth:`.SeismicCubeset.assemble_crops`. Only locations of crops are computed,
+    without creating instances of :class:`.SeismicCropBatch`.
+
+    Each batch is a dictionary with `locations`, `images` and, if needed, `masks` keys.
+
+    Parameters
+    ----------
+    dataset : :class:`.SeismicCubeset`
+        Dataset with cubes to load crops from and labels to make masks of.
+    grid_info : dict, optional
+        Grid to load crops along. Should be created by :meth:`.SeismicCubeset.make_grid`.
+    sampler : callable, optional
+        Function that returns an array of (cube_name, iline, xline, height) points for a given amount of crops.
+        Coordinates of points are relative to the cube shape, as in samplers of :class:`.SeismicCubeset`.
+    crop_shape : sequence of ints, optional
+        Shape of crops to load with sampler. By default, shape of the grid is used.
+    batch_size : int
+        Number of crops in each batch.
+    n_iters : int, optional
+        Number of batches to produce. Required for sampler; for the grid, the whole grid is used by default.
+    shape : sequence of ints, optional
+        Shape of crops in produced batches: crops with (xline, iline, height) orientation are transposed to it.
+        If not provided and `side_view` is used, `crop_shape` is used.
+    side_view : bool or float
+        Probability to load crops of transposed shape with sampler, as in :meth:`.SeismicCropBatch.make_locations`.
+    masks : bool
+        Whether to make masks of labels for each of the crops.
+    width : int
+        Width of horizons in masks.
+    normalize : str, callable or None
+        Normalization of images: either a mode of :meth:`.SeismicGeometry.scaler` or a callable.
+    prefetch : int
+        Maximum number of batches, that are loaded or ready at the same time.
+    n_workers : int
+        Number of background threads, each loading its own batch.
+    load_kwargs : dict, optional
+        Passed directly to :meth:`.SeismicGeometry.load_crops`: for example, to load each batch with multiple workers.
+
+    Examples
+    --------
+    Predict on the whole grid, while the next batches are being loaded:
+
+    >>> dataset.make_grid(cube_name, crop_shape, batch_size=64)
+    >>> stream = CropStream(dataset, grid_info=dataset.grid_info, batch_size=64, normalize='q')
+    >>> predictions = [model.predict(batch['images']) for batch in stream]
+    """
+    def __init__(self, dataset, grid_info=None, sampler=None, crop_shape=None, batch_size=64, n_iters=None,
+                 shape=None, side_view=False, masks=False, width=3, normalize=None,
+                 prefetch=2, n_workers=1, load_kwargs=None):
+        if (grid_info is None) == (sampler is None):
+            raise ValueError('Pass exactly one of `grid_info` and `sampler`.')
+
+        self.dataset = dataset
+        self.grid_info, self.sampler = grid_info, sampler
+        self.batch_size = batch_size
+
+        if grid_info is not None:
+            self.crop_shape = np.array(grid_info['crop_shape'])
+            self.points = np.array(grid_info['grid_array'], dtype=np.int64).reshape(-1, 3) + grid_info['shifts']
+            n_iters = n_iters or -(-len(self.points) // batch_size)
+        else:
+            if crop_shape is None or n_iters is None:
+                raise ValueError('`crop_shape` and `n_iters` must be provided to load crops with sampler.')
+            self.crop_shape = np.array(crop_shape)
+            self.points = None
+        self.n_iters = n_iters
+
+        self.side_view = side_view if isinstance(side_view, float) else (0.5 if side_view else 0.)
+        if shape is None and self.side_view:
+            # Crops of both orientations are stacked into one batch
+            shape = self.crop_shape
+        self.shape = np.array(shape) if shape is not None else None
+        self.masks, self.width = masks, width
+        self.normalize = normalize
+        self.load_kwargs = load_kwargs or {}
+
+        self.prefetch = max(prefetch, 1)
+        self.n_workers = n_workers
+
+    def __len__(self):
+        return self.n_iters
+
+    def __iter__(self):
+        """ Produce batches in order, keeping at most `prefetch` of them in flight. """
+        with ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+            futures = deque()
+            try:
+                for i in range(self.n_iters):
+                    futures.append(executor.submit(self.load_batch, i))
+                    if len(futures) >= self.prefetch:
+                        yield futures.popleft().result()
+                while futures:
+                    yield futures.popleft().result()
+            finally:
+                # Do not wait for batches, that are not going to be consumed
+                for future in futures:
+                    future.cancel()
+
+
+    # Creating locations of crops
+    def make_locations(self, i):
+        """ Locations of crops in the `i`-th batch, as a list of (cube_name, location) pairs. """
+        if self.points is not None:
+            cube_name = self.grid_info['cube_name']
+            points = self.points[i * self.batch_size : (i + 1) * self.batch_size]
+            return [(cube_name, [slice(int(start), int(start + size)) for start, size in zip(point, self.crop_shape)])
+                    for point in points]
+
+        result = []
+        for point in self.sampler(self.batch_size):
+            cube_name = point[0]
+            shape = self.crop_shape
+            if self.side_view and np.random.random() < self.side_view:
+                shape = shape[[1, 0, 2]]
+
+            # Sampled coordinates are relative to the cube shape
+            if any(isinstance(item, float) for item in point[1:]):
+                cube_shape = np.array(self.dataset.geometries[cube_name].cube_shape)
+                anchor = np.rint(np.array(point[1:], dtype=np.float64) * (cube_shape - shape)).astype(np.int64)
+            else:
+                anchor = np.array(point[1:], dtype=np.int64)
+            anchor = np.maximum(anchor, 0)
+            result.append((cube_name, [slice(int(start), int(start + size)) for start, size in zip(anchor, shape)]))
+        return result
+
+
+    # Loading data
+    def load_batch(self, i):
+        """ Load images and, optionally, masks for the `i`-th batch. """
+        locations = self.make_locations(i)
+
+        # Load crops from each of the cubes at once
+        groups = {}
+        for position, (cube_name, _) in enumerate(locations):
+            groups.setdefault(cube_name, []).append(position)
+
+        images = [None] * len(locations)
+        for cube_name, positions in groups.items():
+            geometry = self.dataset.geometries[cube_name]
+            crops = geometry.load_crops([locations[position][1] for position in positions], **self.load_kwargs)
+            for position, crop in zip(positions, crops):
+                images[position] = self.postprocess(geometry, crop)
+        batch = {'locations': locations, 'images': np.stack(images)}
+
+        if self.masks:
+            masks = []
+            for cube_name, location in locations:
+                mask = np.zeros(tuple(slc.stop - slc.start for slc in location), dtype=np.float32)
+                for label in self.dataset.labels[cube_name]:
+                    mask = label.add_to_mask(mask, locations=location, width=self.width)
+                masks.append(self.reshape(mask))
+            batch['masks'] = np.stack(masks)
+        return batch
+
+    def postprocess(self, geometry, crop):
+        """ Normalize crop and change its orientation to the desired `shape`. """
+        if callable(self.normalize):
+            crop = self.normalize(crop)
+        elif self.normalize is not None:
+            crop = geometry.scaler(crop, mode=self.normalize)
+        return self.reshape(crop)
+
+    def reshape(self, crop):
+        """ Transpose crop of (xline, iline, height) orientation to the desired `shape`. """
+        if self.shape is not None and (np.array(crop.shape) != self.shape).any():
+            return crop.transpose([1, 0, 2])
+        return crop
@@ -1,11 +1,26 @@
 """ Utility functions. """
+import os
+import sys
+import json
+import weakref
+import tempfile
 from math import isnan
+from uuid import uuid4
 from collections import OrderedDict, defaultdict
-from threading import RLock
+from contextlib import contextmanager
+from threading import RLock, Lock
 from functools import wraps
 from hashlib import blake2b
 import inspect
 
+# File locks and shared memory segments without tracking are available on POSIX systems only: used by `SharedCache`
+try:
+    import fcntl
+    from multiprocessing import resource_tracker
+    from multiprocessing.shared_memory import SharedMemory
+except ImportError:
+    fcntl, resource_tracker, SharedMemory = None, None, None
+
 from tqdm import tqdm
 import numpy as np
 import pandas as pd
@@ -92,19 +107,497 @@ class Singleton:
         if not Singleton.instance:
             Singleton.instance = self
 
+
+def sizeof(value):
+    """ Size of value in bytes: `nbytes` for arrays, shallow size for everything else. """
+    nbytes = getattr(value, 'nbytes', None)
+    return nbytes if isinstance(nbytes, int) else sys.getsizeof(value)
+
+
+class MemoryBudget:
+    """ Limit on the total size of values, cached by :class:`.lru_cache`, that can be shared between
+    multiple instances and methods. Instance uses the budget if it is set as its `cache_budget` attribute.
+
+    When the limit is exceeded, values are evicted from the lowest priority level first;
+    inside one level, the least recently used values go first.
+
+    Parameters
+    ----------
+    maxbytes : number
+        Maximum total size of cached values in bytes.
+
+    Examples
+    --------
+    Share 24GB between slides, cached by all of the geometries:
+
+    >>> budget = MemoryBudget(24 * 1024 ** 3)
+    >>> for geometry in geometries:
+    >>>     geometry.cache_budget = budget
+    """
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.evicted = 0
+        self.levels = defaultdict(OrderedDict)
+        self.lock = Lock()
+
+    def add(self, cache, instance, key, nbytes, priority=0):
+        """ Account for a new cached value.
+
+        Returns
+        -------
+        list
+            Items to evict from caches, each is a tuple of (cache, instance, key).
+        """
+        evicted = []
+        with self.lock:
+            self.levels[priority][(cache, instance, key)] = nbytes
+            self.nbytes += nbytes
+
+            while self.nbytes > self.maxbytes:
+                level = min(priority for priority, items in self.levels.items() if items)
+                item, item_nbytes = self.levels[level].popitem(last=False)
+                self.nbytes -= item_nbytes
+                evicted.append(item)
+            self.evicted += len(evicted)
+        return evicted
+
+    def touch(self, cache, instance, key, priority=0):
+        """ Mark cached value as the most recently used. """
+        with self.lock:
+            items = self.levels[priority]
+            if (cache, instance, key) in items:
+                items.move_to_end((cache, instance, key))
+
+    def remove(self, cache, instance, key, priority=0):
+        """ Stop accounting for cached value. """
+        with self.lock:
+            nbytes = self.levels[priority].pop((cache, instance, key), None)
+            if nbytes is not None:
+                self.nbytes -= nbytes
+
+    @property
+    def stats(self):
+        """ Current size, limit and amount of evicted values. """
+        return {'nbytes': self.nbytes, 'maxbytes': self.maxbytes, 'evicted': self.evicted,
+                'length': sum(len(items) for items in self.levels.values())}
+
+
+def _open_segment(name, size=0):
+    """ Attach to the existing shared memory segment or, if `size` is positive, create a new one.
+    Segments are removed by :class:`.SharedCache` itself, so they are not tracked by the process that opened them.
+    """
+    segment = SharedMemory(name=name, create=size > 0, size=size)
+    resource_tracker.unregister(segment._name, 'shared_memory') # pylint: disable=protected-access
+    return segment
+
+def _unlink_segment(name):
+    """ Remove shared memory segment, if it exists. """
+    try:
+        segment = SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    segment.close()
+    segment.unlink()
+
+def _release_shared_cache(name, maxitems, pid):
+    """ Remove all of the segments of a cache. Does nothing outside of the process that created the cache. """
+    if os.getpid() != pid:
+        return
+    try:
+        segment = _open_segment(name)
+    except FileNotFoundError:
+        return
+    index = np.ndarray((maxitems,), dtype=SharedCache.INDEX_DTYPE, buffer=segment.buf, offset=SharedCache.HEADER_SIZE)
+    keys = [key.decode() for key in index['key'] if key]
+    del index
+    segment.close()
+
+    _unlink_segment(name)
+    for key in keys:
+        _unlink_segment(f'{name}_{key}')
+    if os.path.exists(SharedCache.lock_path(name)):
+        os.remove(SharedCache.lock_path(name))
+
+
+class SharedCache:
+    """ Least recently used cache of arrays, that is shared between processes on the same machine.
+    Each array is stored in a separate shared memory segment; a small index of stored keys, along with
+    their sizes, shapes and timings, lives in its own segment. Access to the index is guarded by a file lock,
+    so the cache is available on POSIX systems only.
+
+    Instance can be passed to other processes, either by fork or by pickling: all of them use the same storage.
+    Segments are removed when the instance is closed or garbage collected in the process that created it.
+
+    If the instance is set as the `shared_cache` attribute, it is used by :class:`.lru_cache` instead of the local one.
+    That allows worker processes to reuse loaded slides of each other, and keep only one copy of them in memory.
+
+    Parameters
+    ----------
+    maxbytes : number
+        Maximum total size of stored arrays in bytes.
+    maxitems : int
+        Maximum amount of stored arrays.
+    name : str, optional
+        Prefix for the names of shared memory segments. Generated automatically, if not provided.
+
+    Examples
+    --------
+    Share 16GB of slides between all of the processes, loading data from one geometry:
+
+    >>> geometry.shared_cache = SharedCache(16 * 1024 ** 3)
+    """
+    HEADER_SIZE = 32
+    INDEX_DTYPE = np.dtype([('key', 'S32'), ('used', np.int64), ('nbytes', np.int64),
+                            ('dtype', 'S8'), ('ndim', np.int64), ('shape', np.int64, (4,))])
+
+    def __init__(self, maxbytes, maxitems=4096, name=None):
+        if fcntl is None:
+            raise OSError('SharedCache relies on POSIX file locks and is not available on this platform.')
+        self.maxbytes = int(maxbytes)
+        self.maxitems = maxitems
+        self.name = name or f'seismiqb_{os.getpid()}_{uuid4().hex[:8]}'
+
+        segment = _open_segment(self.name, size=self.HEADER_SIZE + maxitems * self.INDEX_DTYPE.itemsize)
+        segment.buf[:] = b'\x00' * segment.size
+        segment.close()
+        self._finalizer = weakref.finalize(self, _release_shared_cache, self.name, maxitems, os.getpid())
+
+        self.attach()
+
+    def attach(self):
+        """ Open index segment and lock in the current process. """
+        self._pid = os.getpid()
+        self._thread_lock = Lock()
+        self._lock_file = open(self.lock_path(self.name), 'a', encoding='utf-8') # pylint: disable=consider-using-with
+
+        self._segment = _open_segment(self.name)
+        self._header = np.ndarray((self.HEADER_SIZE // 8,), dtype=np.int64, buffer=self._segment.buf)
+        self._index = np.ndarray((self.maxitems,), dtype=self.INDEX_DTYPE,
+                                 buffer=self._segment.buf, offset=self.HEADER_SIZE)
+        self.hits, self.misses = 0, 0
+
+    @staticmethod
+    def lock_path(name):
+        """ Path to the file, used as a lock between processes. """
+        return os.path.join(tempfile.gettempdir(), f'{name}.lock')
+
+    def __getstate__(self):
+        return {'maxbytes': self.maxbytes, 'maxitems': self.maxitems, 'name': self.name}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.attach()
+
+    @contextmanager
+    def locked(self):
+        """ Exclusive access to the index, both from threads and processes. """
+        # File locks are bound to open file descriptions, which are inherited by forked processes
+        if os.getpid() != self._pid:
+            self.attach()
+
+        with self._thread_lock:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                yield self._index
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def make_digest(key):
+        """ Hash of a key, that stays the same between processes. """
+        return blake2b(repr(key).encode(), digest_size=16).hexdigest().encode()
+
+    def get(self, key):
+        """ Copy of the stored array or None, if the key is not in the cache. """
+        digest = self.make_digest(key)
+        with self.locked() as index:
+            position = np.flatnonzero(index['key'] == digest)
+            if len(position) == 0:
+                self.misses += 1
+                return None
+
+            position = position[0]
+            self._header[0] += 1
+            index['used'][position] = self._header[0]
+            dtype = np.dtype(index['dtype'][position].decode())
+            shape = tuple(index['shape'][position][:index['ndim'][position]])
+
+            # Once attached, segment stays valid even if it is evicted by other process
+            segment = _open_segment(f'{self.name}_{digest.decode()}')
+            self.hits += 1
+
+        view = np.ndarray(shape, dtype=dtype, buffer=segment.buf)
+        result = view.copy()
+        del view
+        segment.close()
+        return result
+
+    def __contains__(self, key):
+        """ Check whether the key is in the cache, without counting it as a hit or miss. """
+        digest = self.make_digest(key)
+        with self.locked() as index:
+            return bool((index['key'] == digest).any())
+
+    def put(self, key, array):
+        """ Store a copy of array, evicting the least recently used ones, if needed. """
+        if not isinstance(array, np.ndarray) or array.ndim > 4 or array.nbytes > self.maxbytes:
+            return
+
+        digest = self.make_digest(key)
+        with self.locked() as index:
+            if (index['key'] == digest).any():
+                return
+
+            while (self._header[1] + array.nbytes > self.maxbytes) or (index['key'] != b'').all():
+                self._evict(index)
+
+            segment = _open_segment(f'{self.name}_{digest.decode()}', size=max(array.nbytes, 1))
+            view = np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf)
+            view[...] = array
+            del view
+            segment.close()
+
+            position = np.flatnonzero(index['key'] == b'')[0]
+            self._header[0] += 1
+            self._header[1] += array.nbytes
+            index[position] = (digest, self._header[0], array.nbytes, array.dtype.str.encode(),
+                               array.ndim, array.shape + (0,) * (4 - array.ndim))
+
+    def _evict(self, index):
+        """ Remove the least recently used array. Must be called under the lock. """
+        used = np.where(index['key'] != b'', index['used'], np.iinfo(np.int64).max)
+        position = np.argmin(used)
+
+        _unlink_segment(f'{self.name}_{index["key"][position].decode()}')
+        self._header[1] -= index['nbytes'][position]
+        self._header[2] += 1
+        index[position] = (b'', 0, 0, b'', 0, (0, 0, 0, 0))
+
+    def clear(self):
+        """ Remove all of the stored arrays. """
+        with self.locked() as index:
+            while (index['key'] != b'').any():
+                self._evict(index)
+
+    def close(self):
+        """ Detach from the storage. In the process that created the cache, also remove all of the segments. """
+        del self._header, self._index
+        self._segment.close()
+        self._lock_file.close()
+        if hasattr(self, '_finalizer'):
+            self._finalizer()
+
+    @property
+    def stats(self):
+        """ Hits and misses in the current process, as well as the current state of the storage. """
+        with self.locked() as index:
+            return {'hit': self.hits, 'miss': self.misses, 'evicted': int(self._header[2]),
+                    'nbytes': int(self._header[1]), 'length': int((index['key'] != b'').sum())}
+
+
+class DiskCache:
+    """ Least recently used cache of computed values, persistent between runs: each value is stored in its own
+    compressed `.npz` file in the `path` directory. Values are addressed by their content: the key of a value
+    consists of the `owner` identity (for example, hash of the horizon data, path and modification time of the cube)
+    and the description of computation (name of the method and its arguments), so that any change of the data
+    or of the source file leads to a new entry instead of a stale one.
+
+    Only arrays are stored, and they are loaded without unpickling, so that files, written by anyone with access
+    to the directory, can not execute code. Additional `info` about a value, for example, parameters of its plot,
+    can be stored in the `.json` file next to it: it must be serializable to JSON.
+
+    Total size of files is bound by `maxbytes`: the least recently used ones are removed first.
+    Files are written atomically, so the same directory can be used by multiple processes.
+
+    If the instance is set as the `disk_cache` attribute, it is used by :class:`.lru_cache` for methods, decorated
+    with `persistent=True`, when the value is not found in the local cache.
+
+    Parameters
+    ----------
+    path : str
+        Directory to store files in. Created, if needed.
+    maxbytes : number, optional
+        Maximum total size of stored files in bytes.
+
+    Examples
+    --------
+    Keep up to 10GB of horizon attributes and metrics next to the cube:
+
+    >>> geometry.set_disk_cache(gigabytes=10)
+    >>> horizon.get_cube_values(window=23, use_cache=True) # computed once, then loaded from disk
+    >>> horizon.invalidate_disk_cache()
+    """
+    EXTENSION = '.npz'
+    INFO_EXTENSION = '.json'
+
+    def __init__(self, path, maxbytes=None):
+        self.path = path
+        self.maxbytes = maxbytes
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def make_digest(key):
+        """ Digest of a key, that stays the same between runs. Arrays are hashed by their type, shape and content. """
+        digest = blake2b(digest_size=16)
+        for item in flatten_nested(key):
+            if isinstance(item, np.ndarray):
+                digest.update(f'{item.dtype.str}{item.shape}'.encode('utf-8'))
+                digest.update(item.tobytes())
+            else:
+                digest.update(repr(item).encode('utf-8'))
+        return digest.hexdigest()
+
+    def make_path(self, owner, key):
+        """ Path to the file of a value: files of the same owner share the prefix. """
+        return os.path.join(self.path, f'{self.make_digest(owner)}_{self.make_digest(key)}{self.EXTENSION}')
+
+    @property
+    def files(self):
+        """ Paths of stored files. """
+        return [os.path.join(self.path, name) for name in os.listdir(self.path) if name.endswith(self.EXTENSION)]
+
+    def make_info_path(self, path):
+        """ Path to the `info` of a value, stored in `path`. """
+        return os.path.splitext(path)[0] + self.INFO_EXTENSION
+
+    @property
+    def nbytes(self):
+        """ Total size of stored files in bytes. """
+        return sum(self.sizeof(path) for path in self.files)
+
+    def sizeof(self, path):
+        """ Size of the value file and its `info` in bytes. """
+        info_path = self.make_info_path(path)
+        return os.path.getsize(path) + (os.path.getsize(info_path) if os.path.exists(info_path) else 0)
+
+    def __len__(self):
+        return len(self.files)
+
+
+    def get(self, owner, key, with_info=False):
+        """ Load the value, if it is stored, otherwise return None. Marks the value as recently used.
+        If `with_info`, then also return its `info`: the value is considered missing, if it has no `info`.
+        """
+        path = self.make_path(owner, key)
+        try:
+            with np.load(path, allow_pickle=False) as file:
+                value = file['value']
+            info = None
+            if with_info:
+                with open(self.make_info_path(path), 'r', encoding='utf-8') as file:
+                    info = json.load(file)
+            os.utime(path)
+        except (OSError, KeyError, ValueError, EOFError):
+            return None
+        return (value, info) if with_info else value
+
+    def put(self, owner, key, value, info=None):
+        """ Store the array and, optionally, JSON-serializable `info` about it.
+        Evict the least recently used files, if the size limit is exceeded.
+        """
+        if not isinstance(value, np.ndarray) or value.dtype == object:
+            raise TypeError(f'Only arrays of numeric types can be stored on disk, got {type(value)}.')
+
+        # Write to a temporary file and rename it, so that other processes never see a partially written file.
+        # The value itself is written last: once it exists, its `info` is already in place
+        path = self.make_path(owner, key)
+        if info is not None:
+            self._write_atomic(self.make_info_path(path), lambda file: file.write(json.dumps(info).encode('utf-8')))
+        self._write_atomic(path, lambda file: np.savez_compressed(file, value=value))
+
+        if self.maxbytes is not None:
+            self.evict(self.maxbytes)
+
+    def _write_atomic(self, path, write):
+        """ Write to a temporary file in the same directory with `write` callable and rename it to `path`. """
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                write(file)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def remove(self, path):
+        """ Remove the value file and its `info`, if they exist. """
+        for path_ in [path, self.make_info_path(path)]:
+            try:
+                os.remove(path_)
+            except FileNotFoundError:
+                pass
+
+    def evict(self, maxbytes):
+        """ Remove the least recently used files, until their total size is not bigger than `maxbytes`. """
+        stats = []
+        for path in self.files:
+            try:
+                stats.append((os.stat(path).st_mtime, self.sizeof(path), path))
+            except FileNotFoundError:
+                continue
+
+        total = sum(size for _, size, _ in stats)
+        for _, size, path in sorted(stats):
+            if total <= maxbytes:
+                break
+            self.remove(path)
+            total -= size
+
+    def invalidate(self, owner=None, key=None):
+        """ Remove stored values: one value, if both `owner` and `key` are provided, all of the values
+        of the `owner`, if only it is provided, and everything otherwise.
+
+        Returns
+        -------
+        int
+            Number of removed files.
+        """
+        if owner is None:
+            paths = self.files
+        elif key is None:
+            prefix = f'{self.make_digest(owner)}_'
+            paths = [path for path in self.files if os.path.basename(path).startswith(prefix)]
+        else:
+            paths = [path for path in [self.make_path(owner, key)] if os.path.exists(path)]
+
+        for path in paths:
+            self.remove(path)
+        return len(paths)
+
+    def __repr__(self):
+        return f'<DiskCache at {self.path}: {len(self)} values, {self.nbytes / 1024 ** 3:.3f} GB>'
+
+
 class lru_cache:
     """ Thread-safe least recent used cache. Must be applied to class methods.
     Adds the `use_cache` argument to the decorated method to control whether the caching logic is applied.
     Stored values are individual for each instance of the class.
 
+    Size of the cache for each instance is bound by both amount of stored values and their total size in bytes.
+    If the instance has a :class:`.MemoryBudget` as its `cache_budget` attribute, then the budget is used instead:
+    it limits total size of values, cached by all of the instances and methods that share it.
+    If the instance has a :class:`.SharedCache` as its `shared_cache` attribute, then values are stored there,
+    and are visible to other processes: only arrays can be cached this way.
+    If the method is `persistent` and the instance has a :class:`.DiskCache` as its `disk_cache` attribute,
+    then values, missing in the local cache, are looked up on disk, and computed arrays are saved there.
+    The instance must provide the `cache_identity` attribute, that describes its content.
+
     Parameters
     ----------
     maxsize : int
         Maximum amount of stored values.
+    maxbytes : number, optional
+        Maximum total size of stored values in bytes.
     attributes: None, str or sequence of str
         Attributes to get from object and use as additions to key.
     apply_by_default : bool
         Whether the cache logic is on by default.
+    priority : int
+        Priority of values, cached by the method, in a shared `cache_budget`: values with lower priority
+        are evicted first.
+    persistent : bool
+        Whether to use the `disk_cache` of the instance.
 
     Examples
     --------
@@ -124,10 +617,14 @@ class lru_cache:
     -----
     On first call assigns an empty set to an instance attribute `_cached_attributes` to keep track of decorated methods.
     """
-    #pylint: disable=invalid-name, attribute-defined-outside-init
-    def __init__(self, maxsize=None, attributes=None, apply_by_default=True):
+    #pylint: disable=invalid-name, attribute-defined-outside-init, too-many-statements
+    def __init__(self, maxsize=None, maxbytes=None, attributes=None, apply_by_default=True, priority=0,
+                 persistent=False):
         self.maxsize = maxsize
+        self.maxbytes = maxbytes
         self.apply_by_default = apply_by_default
+        self.priority = priority
+        self.persistent = persistent
 
         # Make `attributes` always a list
         if isinstance(attributes, str):
@@ -143,14 +640,31 @@ class lru_cache:
 
     def reset(self, instance=None):
         """ Clear cache and stats. """
-        if instance is None:
-            self.cache = defaultdict(OrderedDict)
-            self.is_full = defaultdict(lambda: False)
-            self.stats = defaultdict(lambda: {'hit': 0, 'miss': 0})
-        else:
-            self.cache[instance] = OrderedDict()
-            self.is_full[instance] = False
-            self.stats[instance] = {'hit': 0, 'miss': 0}
+        # Values are removed from the budgets outside of the lock to avoid nested locking
+        with self.lock:
+            cache = getattr(self, 'cache', {})
+            instances = list(cache.keys()) if instance is None else [instance]
+            removed = [(item, key) for item in instances for key in cache.get(item, {})]
+
+            if instance is None:
+                self.cache = defaultdict(OrderedDict)
+                self.stats = defaultdict(lambda: {'hit': 0, 'miss': 0, 'evicted': 0, 'nbytes': 0})
+            else:
+                self.cache[instance] = OrderedDict()
+                self.stats[instance] = {'hit': 0, 'miss': 0, 'evicted': 0, 'nbytes': 0}
+
+        for item, key in removed:
+            budget = getattr(item, 'cache_budget', None)
+            if budget is not None:
+                budget.remove(self, item, key, self.priority)
+
+    def discard(self, instance, key):
+        """ Evict value from the cache. """
+        with self.lock:
+            result = self.cache[instance].pop(key, self.default)
+            if result is not self.default:
+                self.stats[instance]['nbytes'] -= sizeof(result)
+                self.stats[instance]['evicted'] += 1
 
     def make_key(self, instance, args, kwargs):
         """ Create a key from a combination of instance reference, method args, and instance attributes. """
@@ -166,6 +680,17 @@ class lru_cache:
 
         return flatten_nested(key)
 
+    def make_shared_key(self, instance, name, args, kwargs):
+        """ Create a key that stays the same between processes: instance is identified by its `path`, if possible. """
+        # Objects like `h5py.Dataset` are referenced by their names
+        key = [getattr(instance, 'path', type(instance).__name__), name]
+        key.extend(getattr(arg, 'name', arg) for arg in args)
+        key.extend(sorted(kwargs.items()))
+
+        if self.attributes:
+            key.extend(getattr(instance, attr) for attr in self.attributes)
+        return flatten_nested(key)
+
 
     def __call__(self, func):
         """ Add the cache to the function. """
@@ -188,34 +713,86 @@ class lru_cache:
                 result = func(instance, *args, **kwargs)
                 return result
 
+            # Use storage, shared between processes, instead of the local one
+            shared_cache = getattr(instance, 'shared_cache', None)
+            if shared_cache is not None:
+                key = self.make_shared_key(instance, func.__name__, args, kwargs)
+                result = shared_cache.get(key)
+                with self.lock:
+                    self.stats[instance]['hit' if result is not None else 'miss'] += 1
+
+                if result is None:
+                    result = func(instance, *args, **kwargs)
+                    shared_cache.put(key, result)
+                return result
+
             key = self.make_key(instance, args, kwargs)
+            budget = getattr(instance, 'cache_budget', None)
 
             # If result is already in cache, just retrieve it and update its timings
             with self.lock:
                 result = self.cache[instance].get(key, self.default)
                 if result is not self.default:
-                    del self.cache[instance][key]
-                    self.cache[instance][key] = result
+                    self.cache[instance].move_to_end(key)
                     self.stats[instance]['hit'] += 1
-                    return result
 
-            # The result was not found in cache: evaluate function
-            result = func(instance, *args, **kwargs)
+            if result is not self.default:
+                if budget is not None:
+                    budget.touch(self, instance, key, self.priority)
+                return result
+
+            # The result was not found in cache: load it from disk or evaluate function
+            disk_cache = getattr(instance, 'disk_cache', None) if self.persistent else None
+            if disk_cache is not None:
+                disk_key = (func.__name__, args, sorted(kwargs.items()))
+                result = disk_cache.get(instance.cache_identity, disk_key)
+                if result is None:
+                    result = func(instance, *args, **kwargs)
+                    if isinstance(result, np.ndarray) and result.dtype != object:
+                        disk_cache.put(instance.cache_identity, disk_key, result)
+            else:
+                result = func(instance, *args, **kwargs)
+            nbytes = sizeof(result)
 
             # Add the result to cache
             with self.lock:
                 self.stats[instance]['miss'] += 1
                 if key in self.cache[instance]:
-                    pass
-                elif self.is_full[instance]:
-                    self.cache[instance].popitem(last=False)
-                    self.cache[instance][key] = result
-                else:
-                    self.cache[instance][key] = result
-                    self.is_full[instance] = (len(self.cache[instance]) >= self.maxsize)
+                    return result
+
+                cache, stats = self.cache[instance], self.stats[instance]
+                cache[key] = result
+                stats['nbytes'] += nbytes
+
+                # Without the shared budget, evict the least recently used values of this instance
+                if budget is None:
+                    while cache and ((self.maxsize is not None and len(cache) > self.maxsize) or
+                                     (self.maxbytes is not None and stats['nbytes'] > self.maxbytes)):
+                        _, evicted = cache.popitem(last=False)
+                        stats['nbytes'] -= sizeof(evicted)
+                        stats['evicted'] += 1
+
+            if budget is not None:
+                for evicted_cache, evicted_instance, evicted_key in budget.add(self, instance, key,
+                                                                                nbytes, self.priority):
+                    evicted_cache.discard(evicted_instance, evicted_key)
             return result
 
+        def is_cached(instance, *args, **kwargs):
+            """ Check whether the result for given arguments is stored in the cache: the shared one,
+            if the instance has it, and the local one otherwise.
+            """
+            kwargs.pop('use_cache', None)
+            shared_cache = getattr(instance, 'shared_cache', None)
+            if shared_cache is not None:
+                return self.make_shared_key(instance, func.__name__, args, kwargs) in shared_cache
+
+            key = self.make_key(instance, args, kwargs)
+            with self.lock:
+                return key in self.cache[instance]
+
         wrapper.__name__ = func.__name__
+        wrapper.is_cached = is_cached
         wrapper.cache = lambda: self.cache
         wrapper.stats = lambda: self.stats
         wrapper.reset = self.reset
@@ -420,6 +997,133 @@ def gen_crop_coordinates(point, horizon_matrix, zero_traces,
                 orders_array[top])
 
 
+def gen_crop_coordinates_batch(points, horizon_matrix, zero_traces,
+                               stride, shape, depth, fill_value, zeros_threshold=0,
+                               empty_threshold=5, safe_stripe=0, num_points=2, coverage=None):
+    """ Generate crop coordinates next to each of the points, same as :func:`.gen_crop_coordinates`, at once.
+
+    Numbers of zero traces and empty points in candidate crops are taken from summed-area tables, computed once
+    in the region around the points. Candidates are scored and selected in a jit-compiled loop over points.
+    If `coverage` is provided, it is updated with areas of selected crops, and points inside them are skipped.
+
+    Parameters
+    ----------
+    points : array-like
+        Array of (N, 2) shape with coordinates of points.
+    coverage : ndarray, optional
+        Matrix of (ilines_len, xlines_len) shape with ones at already covered points. Changed inplace.
+    other parameters
+        Same, as in :func:`.gen_crop_coordinates`.
+
+    Returns
+    -------
+    crops, shapes, orders : np.ndarrays
+        Arrays of (n_crops, 3) shape with upper leftmost corners, shapes and axes orders of crops.
+    """
+    points = np.asarray(points, dtype=np.int64).reshape(-1, 2)
+    shape = np.asarray(shape, dtype=np.int64)
+    if len(points) == 0:
+        return (np.zeros((0, 3), dtype=np.int64),) * 3
+
+    # Region, that contains all of the candidate crops
+    margin = stride + shape[0] + shape[1]
+    region_start = np.maximum(points.min(axis=0) - margin, 0)
+    region_stop = np.minimum(points.max(axis=0) + margin + 1, horizon_matrix.shape)
+    region = (slice(region_start[0], region_stop[0]), slice(region_start[1], region_stop[1]))
+
+    zeros_table = _summed_area_table(zero_traces[region])
+    empty_table = _summed_area_table(horizon_matrix[region] == fill_value)
+
+    use_coverage = coverage is not None
+    coverage = coverage if use_coverage else np.zeros((1, 1), dtype=np.bool_)
+    return _gen_crop_coordinates_batch(points, horizon_matrix, zeros_table, empty_table, region_start,
+                                       coverage, use_coverage, stride, shape, depth,
+                                       zeros_threshold, empty_threshold, safe_stripe, num_points)
+
+def _summed_area_table(array):
+    """ Table with sums of `array` over [:i, :x] at each (i, x) position. """
+    table = np.zeros((array.shape[0] + 1, array.shape[1] + 1), dtype=np.int64)
+    table[1:, 1:] = np.cumsum(np.cumsum(array, axis=0, dtype=np.int64), axis=1)
+    return table
+
+@njit
+def _window_sum(table, origin, i, x, size_i, size_x):
+    """ Sum over [i:i+size_i, x:x+size_x] window from a summed-area table of a region, located at `origin`. """
+    length_i, length_x = table.shape[0] - 1, table.shape[1] - 1
+    i_start, i_stop = min(max(i - origin[0], 0), length_i), min(max(i + size_i - origin[0], 0), length_i)
+    x_start, x_stop = min(max(x - origin[1], 0), length_x), min(max(x + size_x - origin[1], 0), length_x)
+    return (table[i_stop, x_stop] - table[i_start, x_stop]
+            - table[i_stop, x_start] + table[i_start, x_start])
+
+@njit
+def _gen_crop_coordinates_batch(points, horizon_matrix, zeros_table, empty_table, origin,
+                                coverage, use_coverage, stride, shape, depth,
+                                zeros_threshold, empty_threshold, safe_stripe, num_points):
+    #pylint: disable=too-many-locals, too-many-branches
+    ilines_len, xlines_len = horizon_matrix.shape
+    crops = np.empty((len(points) * num_points, 3), dtype=np.int64)
+    shapes = np.empty((len(points) * num_points, 3), dtype=np.int64)
+    orders = np.empty((len(points) * num_points, 3), dtype=np.int64)
+
+    starts_i, starts_x = np.empty(4, dtype=np.int64), np.empty(4, dtype=np.int64)
+    selected, intersections = np.empty(4, dtype=np.int64), np.empty(4, dtype=np.int64)
+    count = 0
+    for k in range(len(points)):
+        point_i, point_x = points[k, 0], points[k, 1]
+        if use_coverage and coverage[point_i, point_x]:
+            continue
+
+        # Two candidates along ilines, then two along xlines
+        starts_i[0] = max(0, point_i - stride)
+        starts_i[1] = min(point_i - shape[1] + stride, ilines_len - shape[1])
+        starts_i[2], starts_i[3] = point_i, point_i
+        starts_x[0], starts_x[1] = point_x, point_x
+        starts_x[2] = max(0, point_x - stride)
+        starts_x[3] = min(point_x - shape[1] + stride, xlines_len - shape[1])
+
+        n_selected = 0
+        for c in range(4):
+            if c < 2:
+                size_i, size_x, position, length = shape[1], shape[0], starts_i[c], ilines_len
+            else:
+                size_i, size_x, position, length = shape[0], shape[1], starts_x[c], xlines_len
+            if not (position > safe_stripe and position + shape[1] < length - safe_stripe):
+                continue
+
+            num_missing_traces = _window_sum(zeros_table, origin, starts_i[c], starts_x[c], size_i, size_x)
+            if num_missing_traces > zeros_threshold:
+                continue
+            num_empty = _window_sum(empty_table, origin, starts_i[c], starts_x[c], size_i, size_x)
+            if num_empty <= empty_threshold:
+                continue
+
+            # Insert the candidate, keeping them sorted by intersection with the horizon
+            intersection = shape[1] - num_empty
+            j = n_selected
+            while j > 0 and intersections[j - 1] > intersection:
+                selected[j], intersections[j] = selected[j - 1], intersections[j - 1]
+                j -= 1
+            selected[j], intersections[j] = c, intersection
+            n_selected += 1
+
+        height = min(horizon_matrix[point_i, point_x] - shape[2] // 2, depth - shape[2] - 1)
+        for j in range(min(n_selected, num_points)):
+            c = selected[j]
+            if c < 2:
+                size_i, size_x = shape[1], shape[0]
+                orders[count, 0], orders[count, 1], orders[count, 2] = 0, 2, 1
+            else:
+                size_i, size_x = shape[0], shape[1]
+                orders[count, 0], orders[count, 1], orders[count, 2] = 2, 0, 1
+            crops[count, 0], crops[count, 1], crops[count, 2] = starts_i[c], starts_x[c], height
+            shapes[count, 0], shapes[count, 1], shapes[count, 2] = size_i, size_x, shape[2]
+            count += 1
+
+            if use_coverage:
+                coverage[starts_i[c]:starts_i[c] + size_i, starts_x[c]:starts_x[c] + size_x] = True
+    return crops[:count], shapes[:count], orders[:count]
+
+
 def make_axis_grid(axis_range, stride, length, crop_shape):
     """ Make separate grids for every axis. """
     grid = np.arange(*axis_range, stride)
@@ -428,6 +1132,27 @@ def make_axis_grid(axis_range, stride, length, crop_shape):
         grid_ += [axis_range[1] - crop_shape]
     return sorted(grid_)
 
+def sum_windows(matrix, ilines, xlines, shape):
+    """ Sums of `matrix` over windows of `shape` with upper leftmost corners at each pair of `ilines` and `xlines`.
+    Computed with one summed-area table, so the cost does not depend on the window size.
+    Windows that go out of the matrix are cut to fit in it.
+
+    Returns
+    -------
+    np.ndarray
+        Array of (len(ilines), len(xlines)) shape.
+    """
+    dtype = np.float64 if np.issubdtype(matrix.dtype, np.floating) else np.int64
+    table = np.zeros((matrix.shape[0] + 1, matrix.shape[1] + 1), dtype=dtype)
+    table[1:, 1:] = np.cumsum(np.cumsum(matrix, axis=0, dtype=dtype), axis=1)
+
+    ilines, xlines = np.asarray(ilines, dtype=np.int64), np.asarray(xlines, dtype=np.int64)
+    i_start = np.clip(ilines, 0, matrix.shape[0])[:, np.newaxis]
+    i_stop = np.clip(ilines + shape[0], 0, matrix.shape[0])[:, np.newaxis]
+    x_start = np.clip(xlines, 0, matrix.shape[1])[np.newaxis, :]
+    x_stop = np.clip(xlines + shape[1], 0, matrix.shape[1])[np.newaxis, :]
+    return table[i_stop, x_stop] - table[i_start, x_stop] - table[i_stop, x_start] + table[i_start, x_start]
+
 def infer_tuple(value, default):
     """ Transform int or tuple with Nones to tuple with values from default.
 
@@ -595,6 +1320,158 @@ def find_min_max(array):
     return min_val, max_val
 
 
+@njit
+def gather_windows(data, origin, points, rows, output):
+    """ Put windows of data, starting at each of the points, into rows of the output.
+    Parts of windows outside of `data` along depth are left untouched.
+
+    Parameters
+    ----------
+    data : ndarray
+        Crop of the cube of (ilines, xlines, depth) shape.
+    origin : ndarray
+        Cubic coordinates of the upper left corner of `data`.
+    points : ndarray
+        Array of (N, 3) shape with cubic coordinates of window starts. Must be inside `data` spatially.
+    rows : ndarray
+        Indices of the `output` rows to put windows for each of the points into.
+    output : ndarray
+        Array of (M, window) shape to fill.
+    """
+    #pylint: disable=consider-using-enumerate
+    depth, window = data.shape[2], output.shape[1]
+    for n in range(len(points)):
+        i, x = points[n, 0] - origin[0], points[n, 1] - origin[1]
+        start = points[n, 2] - origin[2]
+        for j in range(max(-start, 0), min(window, depth - start)):
+            output[rows[n], j] = data[i, x, start + j]
+
+
+@njit(parallel=True)
+def compute_trace_stats(traces, bins):
+    """ Compute min, max, mean, std and histogram of each trace in one pass through data.
+    Bins must be uniform; values outside of their range are put into the edge bins.
+
+    Parameters
+    ----------
+    traces : ndarray
+        Array of (N, depth) shape.
+    bins : ndarray
+        Edges of histogram bins.
+
+    Returns
+    -------
+    tuple of ndarrays
+        Minimum, maximum, mean and std of each trace and (N, len(bins) - 1) matrix of histograms.
+    """
+    #pylint: disable=not-an-iterable
+    n_traces, depth = traces.shape
+    n_bins = len(bins) - 1
+    first, width = bins[0], (bins[-1] - bins[0]) / n_bins
+
+    mins, maxs = np.empty(n_traces), np.empty(n_traces)
+    means, stds = np.empty(n_traces), np.empty(n_traces)
+    histograms = np.zeros((n_traces, n_bins), dtype=np.int64)
+
+    for i in prange(n_traces):
+        # Sums are computed for values shifted by the first one to avoid loss of precision
+        shift = traces[i, 0]
+        min_val = max_val = shift
+        sum_, sum_squares = 0., 0.
+
+        for j in range(depth):
+            value = traces[i, j]
+            min_val = min(value, min_val)
+            max_val = max(value, max_val)
+
+            shifted = value - shift
+            sum_ += shifted
+            sum_squares += shifted * shifted
+
+            idx = int(np.floor((value - first) / width))
+            histograms[i, min(max(idx, 0), n_bins - 1)] += 1
+
+        mins[i], maxs[i] = min_val, max_val
+        means[i] = shift + sum_ / depth
+        stds[i] = np.sqrt(max(sum_squares / depth - (sum_ / depth) ** 2, 0.))
+    return mins, maxs, means, stds, histograms
+
+
+def update_reservoir(reservoir, seen, items):
+    """ Update uniform random sample of items (reservoir sampling) with a new batch of items.
+
+    Parameters
+    ----------
+    reservoir : ndarray
+        Container to store sampled items in. Its length is the size of the sample.
+    seen : int
+        Number of items passed to the reservoir before.
+    items : ndarray
+        New items.
+
+    Returns
+    -------
+    int
+        Number of items passed to the reservoir, including new ones.
+    """
+    size = len(reservoir)
+    positions = seen + np.arange(len(items))
+
+    # First items fill the reservoir, other ones replace random element with probability `size / (position + 1)`
+    slots = np.where(positions < size, positions,
+                     (np.random.random(len(items)) * (positions + 1)).astype(np.int64))
+    mask = slots < size
+    slots, items = slots[mask], items[mask]
+
+    # Keep only the last assignment to each slot, as in the sequential algorithm
+    _, last = np.unique(slots[::-1], return_index=True)
+    last = len(slots) - 1 - last
+    reservoir[slots[last]] = items[last]
+    return seen + len(positions)
+
+
+@njit
+def find_strided_runs(indices):
+    """ Split sequence of non-negative integers into runs with constant positive step.
+    Used to coalesce multiple trace reads into a few strided ones.
+
+    Returns
+    -------
+    ndarray
+        Array of (N, 3) shape: position of run start in `indices`, length of the run and its step.
+    """
+    n = len(indices)
+    runs = np.empty((n, 3), dtype=np.int64)
+    n_runs = 0
+
+    position = 0
+    while position < n:
+        length, step = 1, 1
+        if position + 1 < n:
+            diff = indices[position + 1] - indices[position]
+            if diff > 0:
+                step = diff
+                length = 2
+                while position + length < n and \
+                      indices[position + length] - indices[position + length - 1] == step:
+                    length += 1
+
+        runs[n_runs, 0] = position
+        runs[n_runs, 1] = length
+        runs[n_runs, 2] = step
+        n_runs += 1
+        position += length
+    return runs[:n_runs]
+
+
+def ibm_to_ieee(array):
+    """ Convert array of IBM System/360 floats, stored as 4-byte unsigned integers, into IEEE float32. """
+    array = array.astype(np.uint32)
+    sign = np.where(array >> 31, -1., 1.)
+    exponent = ((array >> 24) & 0x7f).astype(np.int32) - 64
+    mantissa = (array & 0x00ffffff) / float(0x01000000)
+    return (sign * np.ldexp(mantissa, 4 * exponent)).astype(np.float32)
+
 
 def compute_running_mean(x, kernel_size):
     """ Fast analogue of scipy.signal.convolve2d with gaussian filter. """
@@ -0,0 +1,129 @@
+""" Tests for the accumulation of predictions on crops into one array. """
+import numpy as np
+import pytest
+
+from seismiqb import CropAccumulator
+
+
+
+@pytest.fixture
+def grid_info():
+    """ Grid of overlapping crops, some of which go out of the array. """
+    grid_array = np.array([[0, 0, 0], [0, 4, 0], [0, 8, 0], [3, 0, 0], [3, 4, 0], [3, 8, 0],
+                           [6, 2, 0], [7, 9, 2], [-2, -3, 0], [8, -1, -1]])
+    return {'grid_array': grid_array, 'crop_shape': (4, 5, 8), 'predict_shape': (10, 12, 9)}
+
+@pytest.fixture
+def crops(grid_info):
+    """ Random crops along the grid in the default order of axes of the inference pipeline. """
+    rng = np.random.default_rng(11)
+    crop_shape = grid_info['crop_shape']
+    return rng.random((len(grid_info['grid_array']), crop_shape[1], crop_shape[2], crop_shape[0])) - 0.5
+
+
+def assemble_reference(crops, grid_info, order=(2, 0, 1), aggregation='max', weights=None):
+    """ Put crops on the background one by one with numpy slicing: the maximum is kept, as in
+    the previous `SeismicCubeset.assemble_crops`, or values are averaged.
+    """
+    shape = grid_info['predict_shape']
+    values = np.full(shape, -np.inf) if aggregation == 'max' else np.zeros(shape)
+    counts = np.zeros(shape)
+
+    for crop, location in zip(crops, grid_info['grid_array']):
+        crop = np.transpose(crop, order)
+        crop_weights = np.ones_like(crop) if weights is None else weights
+
+        crop_slice, background_slice = [], []
+        for start, size, length in zip(location, crop.shape, shape):
+            crop_slice.append(slice(max(-start, 0), min(size, length - start)))
+            background_slice.append(slice(max(start, 0), min(start + size, length)))
+        crop_slice, background_slice = tuple(crop_slice), tuple(background_slice)
+
+        if aggregation == 'max':
+            values[background_slice] = np.maximum(values[background_slice], crop[crop_slice])
+        else:
+            values[background_slice] += crop[crop_slice] * crop_weights[crop_slice]
+            counts[background_slice] += crop_weights[crop_slice]
+
+    fill_value = np.min(crops)
+    if aggregation == 'max':
+        return np.where(values == -np.inf, fill_value, values)
+    return np.where(counts > 0, values / np.where(counts > 0, counts, 1), fill_value)
+
+
+def test_max_aggregation(grid_info, crops):
+    """ Default aggregation gives the same array as gluing crops with their maximum, with clipping at borders. """
+    accumulator = CropAccumulator.from_grid(grid_info)
+    accumulator.push(crops)
+    prediction = accumulator.aggregate()
+
+    assert prediction.shape == grid_info['predict_shape']
+    np.testing.assert_allclose(prediction, assemble_reference(crops, grid_info), rtol=1e-6)
+
+@pytest.mark.parametrize('aggregation', ['mean', 'weighted'])
+def test_average_aggregations(grid_info, crops, aggregation):
+    """ Overlapping values are averaged with the same or with the given weights. """
+    weights = None
+    if aggregation == 'weighted':
+        weights = np.random.default_rng(5).random(grid_info['crop_shape']) + 0.1
+
+    accumulator = CropAccumulator.from_grid(grid_info, aggregation=aggregation, weights=weights)
+    accumulator.push(crops)
+    prediction = accumulator.aggregate()
+
+    expected = assemble_reference(crops, grid_info, aggregation=aggregation, weights=weights)
+    np.testing.assert_allclose(prediction, expected, rtol=1e-5, atol=1e-6)
+
+def test_default_weights(grid_info):
+    """ Default weights decrease from the center of a crop to its borders. """
+    accumulator = CropAccumulator.from_grid(grid_info, aggregation='weighted')
+    weights = accumulator.weights
+    assert weights.shape == grid_info['crop_shape']
+    assert weights[2, 2, 4] == weights.max() and weights[0, 0, 0] == weights.min() > 0
+
+
+def test_push_order(grid_info, crops):
+    """ Crops, pushed in batches, are put at the next locations of the grid, same as with explicit locations. """
+    accumulator = CropAccumulator.from_grid(grid_info, aggregation='mean')
+    for start in range(0, len(crops), 3):
+        accumulator.push(crops[start:start + 3])
+    prediction = accumulator.aggregate()
+
+    explicit = CropAccumulator(grid_info['predict_shape'], aggregation='mean', order=(2, 0, 1))
+    explicit.update(crops, grid_info['grid_array'])
+    np.testing.assert_array_equal(prediction, explicit.aggregate())
+
+    with pytest.raises(ValueError):
+        accumulator.push(crops[:1])
+    with pytest.raises(ValueError):
+        CropAccumulator(grid_info['predict_shape']).push(crops[:1])
+
+
+def test_scatter_clipping():
+    """ Crops at negative locations or beyond the array are cut to fit in it. """
+    accumulator = CropAccumulator((4, 4, 4), fill_value=-1)
+    accumulator.update([np.ones((3, 3, 3)), np.full((3, 3, 3), 2.0), np.full((3, 3, 3), 3.0)],
+                       [(-2, -2, -2), (3, 3, 3), (10, 0, 0)])
+    prediction = accumulator.aggregate()
+
+    assert (prediction[0, 0, 0] == 1) and (prediction[3, 3, 3] == 2)
+    assert (prediction == 1).sum() == 1 and (prediction == 2).sum() == 1
+    assert (prediction == -1).sum() == 4 ** 3 - 2
+
+
+@pytest.mark.parametrize('aggregation', ['max', 'mean'])
+def test_memmap_path(tmp_path, grid_info, crops, aggregation):
+    """ Array, memory-mapped to a file, has the same values as the in-memory one, and they are stored in it. """
+    path = str(tmp_path / 'prediction.npy')
+    accumulator = CropAccumulator.from_grid(grid_info, aggregation=aggregation, path=path)
+    accumulator.push(crops)
+    prediction = accumulator.aggregate()
+
+    in_memory = CropAccumulator.from_grid(grid_info, aggregation=aggregation)
+    in_memory.push(crops)
+    expected = in_memory.aggregate()
+
+    assert isinstance(prediction, np.memmap)
+    np.testing.assert_array_equal(prediction, expected)
+    np.testing.assert_array_equal(np.load(path), expected)
+    assert (tmp_path / 'prediction_weights.npy').exists() == (aggregation != 'max')
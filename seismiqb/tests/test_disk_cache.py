@@ -0,0 +1,94 @@
+""" Tests for the persistent cache of computed arrays. """
+import os
+
+import numpy as np
+import pytest
+
+from seismiqb import DiskCache
+
+
+
+@pytest.fixture
+def cache(tmp_path):
+    """ Empty cache without the size limit. """
+    return DiskCache(str(tmp_path / 'cache'))
+
+
+def test_round_trip(cache):
+    """ Stored arrays and their info are loaded back, missing values are None. """
+    value = np.arange(12, dtype=np.float32).reshape(3, 4)
+    cache.put('horizon', ('get_cube_values', 23), value, info={'title': 'amplitudes', 'zmin': 0.5})
+
+    loaded, info = cache.get('horizon', ('get_cube_values', 23), with_info=True)
+    assert loaded.dtype == value.dtype and (loaded == value).all()
+    assert info == {'title': 'amplitudes', 'zmin': 0.5}
+    assert (cache.get('horizon', ('get_cube_values', 23)) == value).all()
+
+    assert cache.get('horizon', ('get_cube_values', 5)) is None
+    assert cache.get('other_horizon', ('get_cube_values', 23)) is None
+
+    # Values without info are missing, when info is required
+    cache.put('horizon', 'no_info', value)
+    assert cache.get('horizon', 'no_info', with_info=True) is None
+    assert len(cache) == 2
+
+
+def test_array_keys(cache):
+    """ Arrays in keys are told apart by their type and shape, not only by their bytes. """
+    array = np.zeros(8, dtype=np.int32)
+    keys = [array, array.reshape(2, 4), array.view(np.float32), array.astype(np.int64)[:4]]
+    assert len({cache.make_digest(key) for key in keys}) == len(keys)
+    assert cache.make_digest(array) == cache.make_digest(np.zeros(8, dtype=np.int32))
+
+    for i, key in enumerate(keys):
+        cache.put('horizon', key, np.array([i]))
+    assert [cache.get('horizon', key)[0] for key in keys] == list(range(len(keys)))
+
+
+def test_invalidate(cache):
+    """ Values are removed by key, by owner and all at once, along with their info. """
+    for owner in ['first', 'second']:
+        for key in range(3):
+            cache.put(owner, key, np.full(10, key), info={'key': key})
+
+    assert cache.invalidate('first', 0) == 1
+    assert cache.get('first', 0) is None and cache.get('first', 1) is not None
+
+    assert cache.invalidate('first') == 2
+    assert all(cache.get('first', key) is None for key in range(3))
+    assert all(cache.get('second', key) is not None for key in range(3))
+
+    assert cache.invalidate() == 3
+    assert len(cache) == 0 and os.listdir(cache.path) == []
+
+
+def test_eviction(tmp_path):
+    """ Least recently used values are removed, when the total size of files exceeds the limit. """
+    rng = np.random.default_rng(0)
+    values = [rng.random(1000) for _ in range(4)]
+
+    cache = DiskCache(str(tmp_path / 'cache'))
+    for i, value in enumerate(values[:3]):
+        cache.put('horizon', i, value)
+        os.utime(cache.make_path('horizon', i), (i + 1, i + 1))
+    size = max(cache.sizeof(path) for path in cache.files)
+
+    # Access makes the value the most recently used one
+    assert cache.get('horizon', 0) is not None
+
+    cache.maxbytes = 3 * size
+    cache.put('horizon', 3, values[3])
+    assert cache.nbytes <= cache.maxbytes
+    assert cache.get('horizon', 1) is None
+    assert all((cache.get('horizon', i) == values[i]).all() for i in [0, 2, 3])
+
+    cache.evict(0)
+    assert len(cache) == 0
+
+
+@pytest.mark.parametrize('value', [[1, 2, 3], {'a': 1}, 5, np.array([{'a': 1}, None], dtype=object)])
+def test_reject_non_arrays(cache, value):
+    """ Only numeric arrays are stored, so that values are loaded without unpickling. """
+    with pytest.raises(TypeError):
+        cache.put('horizon', 'key', value)
+    assert len(cache) == 0
@@ -0,0 +1,67 @@
+""" Tests for the incremental updates of the state of horizon extension. """
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from scipy.ndimage import binary_erosion
+
+from seismiqb import Horizon
+from seismiqb.src.extension import HorizonExtension, _update_boundaries # pylint: disable=protected-access
+
+
+
+def compute_boundaries(full_matrix):
+    """ Border points of the whole depth map, computed from scratch. """
+    presence = full_matrix != Horizon.FILL_VALUE
+    return presence ^ binary_erosion(presence, np.ones((3, 3)), border_value=0)
+
+
+@pytest.fixture
+def extension():
+    """ Extension of a rectangular horizon with a hole, that is close to the border of the cube. """
+    geometry = SimpleNamespace(name='cube', cube_shape=np.array([40, 50, 100]))
+    matrix = np.full((20, 25), 30, dtype=np.int32)
+    matrix[8:11, 10:14] = Horizon.FILL_VALUE
+    horizon = Horizon(matrix, geometry, name='horizon', i_min=0, x_min=15)
+    return HorizonExtension(horizon, crop_shape=(8, 8, 16), stride=4)
+
+
+def test_update_boundaries(extension):
+    """ Incremental update near added points must give the same borders as computing them from scratch. """
+    rng = np.random.default_rng(3)
+    for _ in range(5):
+        absent = np.stack(np.nonzero(extension.full_matrix == Horizon.FILL_VALUE), axis=1)
+        points = absent[rng.choice(len(absent), size=40, replace=False)]
+        extension.full_matrix[points[:, 0], points[:, 1]] = 30
+
+        _update_boundaries(extension.full_matrix, extension.boundaries, points, Horizon.FILL_VALUE)
+        assert (extension.boundaries == compute_boundaries(extension.full_matrix)).all()
+
+    # Filling the hole removes its borders
+    hole = np.stack(np.mgrid[8:11, 25:29].reshape(2, -1), axis=1)
+    extension.full_matrix[hole[:, 0], hole[:, 1]] = 30
+    _update_boundaries(extension.full_matrix, extension.boundaries, hole, Horizon.FILL_VALUE)
+    assert (extension.boundaries == compute_boundaries(extension.full_matrix)).all()
+
+
+def test_invalidate(extension):
+    """ Coverage is reset and border points become pending only in blocks around the changed points. """
+    reach = extension.reach
+    extension.coverage[:] = True
+    extension.pending = np.zeros((0, 2), dtype=np.int64)
+
+    point = np.array([[1, 20]])
+    extension.invalidate(point)
+
+    block_i, block_x = point[0] // reach
+    dirty = np.zeros_like(extension.coverage)
+    dirty[max(block_i - 1, 0) * reach:(block_i + 2) * reach, max(block_x - 1, 0) * reach:(block_x + 2) * reach] = True
+    assert (extension.coverage == ~dirty).all()
+
+    expected = np.stack(np.nonzero(extension.boundaries & dirty), axis=1)
+    assert len(expected) > 0
+    assert (extension.pending == expected).all()
+
+    # Already pending points are kept, and the same points are not added twice
+    extension.invalidate(point)
+    assert (extension.pending == expected).all()
@@ -0,0 +1,52 @@
+""" Tests for the choice of the way to read slides of HDF5 cubes, depending on the state of the slide cache. """
+import numpy as np
+import h5py
+import pytest
+
+from seismiqb import SeismicGeometry, SharedCache
+
+
+
+@pytest.fixture
+def geometry(tmp_path):
+    """ HDF5 cube, chunked so that reading a small crop is cheaper than reading full slides. """
+    path = str(tmp_path / 'cube.hdf5')
+    with h5py.File(path, 'w') as file:
+        data = np.random.rand(16, 256, 256).astype(np.float32)
+        file.create_dataset('cube', data=data, chunks=(1, 64, 64))
+
+    geometry = SeismicGeometry(path, process=False)
+    geometry.file_hdf5 = h5py.File(path, mode='r')
+    yield geometry
+
+    if geometry.shared_cache is not None:
+        geometry.shared_cache.close()
+    geometry.file_hdf5.close()
+
+
+def read_modes(geometry, locations):
+    """ Modes of reading each run of slides, chosen by the adaptive loading of a crop. """
+    modes = []
+    def read_run(name, run, mode, locations, crops, **kwargs):
+        _ = name, run, locations, crops, kwargs
+        modes.append(mode)
+    geometry._read_run = read_run # pylint: disable=protected-access
+
+    output = np.empty(tuple(slc.stop - slc.start for slc in locations), dtype=np.float32)
+    geometry._load_projection(0, [locations], [output], mode='adaptive') # pylint: disable=protected-access
+    return modes
+
+
+def test_adaptive_mode_uses_shared_cache(geometry):
+    """ Slides, stored in the shared cache, must be taken from it instead of being read as hyperslabs. """
+    geometry.shared_cache = SharedCache(64 * 1024 ** 2)
+    locations = [slice(0, 8), slice(10, 20), slice(10, 20)]
+
+    # Nothing is cached: a small crop is read directly from disk
+    assert 'slide' not in read_modes(geometry, locations)
+
+    for loc in range(8):
+        geometry._cached_load('cube', loc) # pylint: disable=protected-access
+    assert all(geometry._cached_load.is_cached(geometry, 'cube', loc) # pylint: disable=protected-access
+               for loc in range(8))
+    assert set(read_modes(geometry, locations)) == {'slide'}
@@ -0,0 +1,51 @@
+""" Tests for the evaluation of geometry metrics in spatial tiles. """
+import warnings
+
+import numpy as np
+import h5py
+import pytest
+
+from seismiqb import SeismicGeometry, GeometryMetrics
+
+
+
+@pytest.fixture
+def geometry(tmp_path):
+    """ Geometry with histograms of traces, some of which are zero traces or have constant histograms. """
+    path = str(tmp_path / 'cube.hdf5')
+    with h5py.File(path, 'w') as file:
+        file.create_dataset('cube', data=np.zeros((20, 30, 16), dtype=np.float32))
+
+    geometry = SeismicGeometry(path, process=False)
+    rng = np.random.default_rng(42)
+    hist_matrix = rng.integers(0, 50, size=(20, 30, 8)).astype(np.int64)
+    hist_matrix[3, 5:9] = 7
+    hist_matrix[17, 20] = 7
+    zero_traces = np.zeros((20, 30), dtype=np.int32)
+    zero_traces[0:2, 10:14] = 1
+    zero_traces[12, 25] = 1
+
+    geometry.hist_matrix = hist_matrix
+    geometry.zero_traces = zero_traces
+    return geometry
+
+
+@pytest.mark.parametrize('safe_strip', [0, 3])
+def test_tiled_support_corrs(geometry, safe_strip):
+    """ Evaluation in tiles must give the same supports, values and bad traces as on the whole `hist_matrix`. """
+    metrics = GeometryMetrics(geometry, tile_size=7)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        tiled = metrics.evaluate('support_corrs', supports=10, safe_strip=safe_strip)
+        untiled, plot_dict = metrics.support_corrs(supports=10, safe_strip=safe_strip)
+        untiled = np.nanmean(untiled, axis=-1)
+
+    np.testing.assert_allclose(tiled, untiled, atol=1e-10)
+    assert np.isnan(tiled[3, 5:9]).all() and np.isnan(tiled[0:2, 10:14]).all()
+    if safe_strip:
+        assert np.isnan(tiled[:safe_strip]).all() and np.isnan(tiled[:, -safe_strip:]).all()
+
+    _, tiled_plot_dict = metrics.compute_tiled('support_corrs', supports=10, safe_strip=safe_strip)
+    assert 'with 10 random supports' in tiled_plot_dict['title']
+    assert tiled_plot_dict['title'] == plot_dict['title']
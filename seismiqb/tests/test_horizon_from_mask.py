@@ -0,0 +1,46 @@
+""" Tests for the extraction of horizons from a mask in spatial chunks. """
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from seismiqb import Horizon
+
+
+
+@pytest.fixture
+def mask():
+    """ Mask with surfaces, that cross borders of chunks, and small regions, that are filtered out. """
+    mask = np.zeros((24, 20, 40), dtype=np.float32)
+    i, x = np.meshgrid(np.arange(24), np.arange(20), indexing='ij')
+
+    # Thick inclined surface over the whole spatial range
+    depths = 5 + (i + x) // 4
+    for shift in range(3):
+        mask[i, x, depths + shift] = 1.0
+
+    # U-shaped surface: its branches are connected only in the last ilines
+    u_shape = ((x < 4) | (x >= 14)) | (i >= 20)
+    mask[i[u_shape], x[u_shape], 25] = 0.9
+    mask[i[u_shape], x[u_shape], 26] = 0.8
+
+    # Small region below `minsize` and values below threshold
+    mask[2:4, 8:10, 35] = 1.0
+    mask[10:14, 5:15, 32] = 0.2
+    return mask
+
+
+@pytest.mark.parametrize('mode', ['mean', 'min', 'max'])
+@pytest.mark.parametrize('chunk_size', [(7, 6), 5, (24, 3)])
+def test_from_mask_chunks(mask, chunk_size, mode):
+    """ Chunked extraction must give the same horizons as extraction from the whole mask at once. """
+    geometry = SimpleNamespace(name='cube', cube_shape=np.array([30, 30, 50]))
+    kwargs = {'geometry': geometry, 'shifts': np.array([3, 2, 1]), 'mode': mode, 'minsize': 10}
+
+    expected = Horizon.from_mask(mask, **kwargs)
+    horizons = Horizon.from_mask(mask, chunk_size=chunk_size, **kwargs)
+    assert len(expected) == len(horizons) == 2
+
+    for horizon, expected_horizon in zip(horizons, expected):
+        assert len(horizon) == len(expected_horizon)
+        assert (horizon.full_matrix == expected_horizon.full_matrix).all()
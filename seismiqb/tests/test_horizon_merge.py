@@ -0,0 +1,126 @@
+""" Tests for merges of dense and tiled horizons. """
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from seismiqb import Horizon
+
+
+
+@pytest.fixture
+def geometry():
+    """ The only attributes of a geometry, used by horizons in these tests. """
+    return SimpleNamespace(name='cube', cube_shape=np.array([64, 64, 200]))
+
+
+def make_points(i_range, x_range, depth):
+    """ Points of a flat horizon on the given spatial ranges. """
+    i, x = np.meshgrid(np.arange(*i_range), np.arange(*x_range), indexing='ij')
+    return np.stack([i.ravel(), x.ravel(), np.full(i.size, depth)], axis=1).astype(np.int32)
+
+
+def test_tiled_presence_matrix(geometry):
+    """ Every point of a tiled horizon is present, including the ones at zero depth. """
+    points = np.concatenate([make_points((0, 4), (0, 4), 0), make_points((10, 12), (10, 12), 5)])
+    presence_matrix = Horizon(points, geometry, tile_size=16).presence_matrix
+    assert presence_matrix.sum() == len(points)
+    assert presence_matrix[points[:, 0], points[:, 1]].all()
+
+
+def test_adjacent_merge_disjoint_bboxes(geometry):
+    """ For horizons with disjoint bboxes, tiled and dense merges give the same horizon. """
+    self_points, other_points = make_points((0, 20), (0, 10), 50), make_points((0, 20), (12, 22), 50)
+
+    dense = Horizon(self_points, geometry).adjacent_merge(Horizon(other_points, geometry), adjacency=3)
+    tiled = Horizon(self_points, geometry, tile_size=16).adjacent_merge(Horizon(other_points, geometry,
+                                                                                 tile_size=16), adjacency=3)
+    assert dense is not False and tiled is not False
+    assert (tiled.full_matrix == dense.full_matrix).all()
+
+    far_points = make_points((0, 20), (20, 30), 50)
+    assert Horizon(self_points, geometry, tile_size=16).adjacent_merge(Horizon(far_points, geometry,
+                                                                               tile_size=16), adjacency=3) is False
+
+
+def test_adjacent_merge_inside_bbox(geometry):
+    """ Tiled merge compares points of `self` inside the bbox of `other` too, while the dense one skips them. """
+    # `other` is L-shaped, `self` is adjacent to its vertical part and lies inside of its bbox
+    other_points = np.concatenate([make_points((0, 20), (0, 4), 50), make_points((0, 4), (4, 20), 50)])
+    other_points = np.unique(other_points, axis=0)
+    self_points = make_points((10, 20), (6, 16), 50)
+
+    dense = Horizon(self_points, geometry).adjacent_merge(Horizon(other_points, geometry), adjacency=3)
+    assert dense is False
+
+    tiled = Horizon(self_points, geometry, tile_size=16).adjacent_merge(Horizon(other_points, geometry,
+                                                                                 tile_size=16), adjacency=3)
+    assert tiled is not False
+    assert len(tiled) == len(self_points) + len(other_points)
+
+    # Horizons are too far away depth-wise
+    deep_points = make_points((10, 20), (6, 16), 60)
+    assert Horizon(deep_points, geometry, tile_size=16).adjacent_merge(Horizon(other_points, geometry,
+                                                                               tile_size=16), adjacency=3) is False
+
+
+def merge_list_pairwise(horizons, mean_threshold=2.0, adjacency=3, minsize=50):
+    """ Try to merge every horizon to every next one, without any index. """
+    horizons = [horizon for horizon in horizons if len(horizon) >= minsize]
+
+    i = 0
+    while i < len(horizons):
+        j = i + 1
+        while j < len(horizons):
+            merge_code, _ = Horizon.verify_merge(horizons[i], horizons[j],
+                                                 mean_threshold=mean_threshold, adjacency=adjacency)
+            if merge_code == 3:
+                merged = Horizon.overlap_merge(horizons[i], horizons[j], inplace=True)
+            elif merge_code == 2:
+                merged = Horizon.adjacent_merge(horizons[i], horizons[j], inplace=True,
+                                                mean_threshold=mean_threshold, adjacency=adjacency)
+            else:
+                merged = False
+
+            if merged:
+                _ = horizons.pop(j)
+            else:
+                j += 1
+        i += 1
+    return horizons
+
+def make_chunks(geometry, seed, n_surfaces=3, chunk_size=12, coverage=0.8):
+    """ Points of smooth surfaces, cut into shuffled rectangular chunks, some of which overlap or are too small. """
+    rng = np.random.default_rng(seed)
+    i_grid, x_grid = np.meshgrid(np.arange(60), np.arange(60), indexing='ij')
+
+    chunks = []
+    for k in range(n_surfaces):
+        phase = rng.uniform(0, 2 * np.pi, size=2)
+        depths = 50 * (k + 1) + 5 * np.sin(i_grid / 15 + phase[0]) + 5 * np.cos(x_grid / 15 + phase[1])
+        depths = np.rint(depths).astype(np.int32)
+
+        for i_start in range(0, 60, chunk_size):
+            for x_start in range(0, 60, chunk_size):
+                if rng.uniform() > coverage:
+                    continue
+                size = rng.integers(5, chunk_size + 4)
+                slc = slice(i_start, i_start + size), slice(x_start, x_start + size)
+                chunks.append(np.stack([i_grid[slc].ravel(), x_grid[slc].ravel(), depths[slc].ravel()], axis=1))
+
+    order = rng.permutation(len(chunks))
+    return [chunks[i] for i in order]
+
+@pytest.mark.parametrize('seed', range(3))
+def test_merge_list(geometry, seed):
+    """ Merge with the spatial index gives the same horizons, as checking every pair of them. """
+    geometry.cube_shape = np.array([60, 60, 200])
+    chunks = make_chunks(geometry, seed)
+
+    merged = Horizon.merge_list([Horizon(points, geometry) for points in chunks])
+    expected = merge_list_pairwise([Horizon(points, geometry) for points in chunks])
+
+    assert len(merged) == len(expected) < len(chunks)
+    for horizon, expected_horizon in zip(merged, expected):
+        assert (horizon.i_min, horizon.x_min) == (expected_horizon.i_min, expected_horizon.x_min)
+        assert np.array_equal(horizon.matrix, expected_horizon.matrix)
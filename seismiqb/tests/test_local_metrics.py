@@ -0,0 +1,80 @@
+""" Tests for the evaluation of `local` metrics, compared to separate evaluation for each pair of traces. """
+import warnings
+
+import numpy as np
+import pytest
+
+from seismiqb.src.metrics import compute_local_corrs, compute_local_btch, compute_local_kl
+from seismiqb.src.metrics import _compute_local_btch, _compute_local_kl # pylint: disable=protected-access
+
+
+
+REFERENCE_REDUCTIONS = {
+    'nanmean': np.mean,
+    'nanmin': np.min,
+    'nanmax': np.max,
+    'nanstd': np.std,
+    'geomean': lambda array: np.power(np.prod(array), 1 / len(array)),
+    'harmean': lambda array: len(array) / np.sum(1 / array),
+}
+
+def correlation(array_1, array_2):
+    """ Correlation of two traces. """
+    return np.corrcoef(array_1, array_2)[0, 1]
+
+def local_reference(function, data, bad_traces, kernel_size, reduce_func):
+    """ Compare each trace to each of its neighbours separately, then reduce the values. """
+    k = kernel_size // 2
+    bad_traces = (bad_traces != 0) | (np.std(data, axis=-1) == 0.0)
+    i_range, x_range = bad_traces.shape
+
+    metric = np.full((i_range, x_range), np.nan)
+    for il, xl in zip(*np.nonzero(~bad_traces)):
+        values = [function(data[il, xl], data[il + i, xl + x])
+                  for i in range(-k, k + 1) for x in range(-k, k + 1)
+                  if (i, x) != (0, 0) and 0 <= il + i < i_range and 0 <= xl + x < x_range
+                  and not bad_traces[il + i, xl + x]]
+        if values:
+            metric[il, xl] = REFERENCE_REDUCTIONS[reduce_func](np.array(values))
+    return metric
+
+
+@pytest.fixture
+def probs():
+    """ Distributions for each trace, some of which are bad or constant. """
+    rng = np.random.default_rng(7)
+    data = rng.random((11, 9, 16)) + 0.1
+    data[4, 4] = 1.0
+    data /= np.sum(data, axis=-1, keepdims=True)
+
+    bad_traces = np.zeros((11, 9), dtype=np.int32)
+    bad_traces[0, :3] = 1
+    bad_traces[7, 2] = 1
+    return data, bad_traces
+
+
+@pytest.mark.parametrize('reduce_func', list(REFERENCE_REDUCTIONS))
+@pytest.mark.parametrize('kernel_size', [3, 5])
+@pytest.mark.parametrize('compute_func, function', [
+    (compute_local_corrs, correlation),
+    (compute_local_btch, _compute_local_btch),
+    (compute_local_kl, _compute_local_kl),
+])
+def test_local_metrics(probs, compute_func, function, kernel_size, reduce_func):
+    """ Symmetric and tiled evaluation must give the same values as separate evaluation for each pair. """
+    data, bad_traces = probs
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        metric, _ = compute_func(data, bad_traces, kernel_size=kernel_size, reduce_func=reduce_func, tile_size=4)
+        expected = local_reference(function, data, bad_traces, kernel_size, reduce_func)
+
+    np.testing.assert_allclose(metric, expected, rtol=1e-6, atol=1e-8)
+    assert np.isnan(metric[bad_traces == 1]).all() and np.isnan(metric[4, 4])
+
+
+def test_local_metrics_without_neighbours(probs):
+    """ With kernel of one trace, there is nothing to compare to. """
+    data, bad_traces = probs
+    metric, _ = compute_local_corrs(data, bad_traces, kernel_size=1)
+    assert metric.shape == bad_traces.shape
+    assert np.isnan(metric).all()
@@ -0,0 +1,69 @@
+""" Tests for the evaluation of `support` metrics, compared to separate evaluation for each of the supports. """
+import warnings
+
+import numpy as np
+import pytest
+
+from seismiqb.src.metrics import _compute_support_corrs, _compute_support_crosscorrs # pylint: disable=protected-access
+
+
+
+def support_corrs_reference(data, supports, bad_traces):
+    """ Correlations with each of the supports, computed over the whole data at once. """
+    depth = data.shape[-1]
+    data_n = data - np.mean(data, axis=-1, keepdims=True)
+    data_stds = np.std(data, axis=-1)
+
+    corrs = np.zeros((*data.shape[:2], len(supports)))
+    for i, (il, xl) in enumerate(supports):
+        support = data[il, xl]
+        cov = np.sum((support - np.mean(support)) * data_n, axis=-1) / depth
+        temp = cov / (np.std(support) * data_stds)
+        temp[bad_traces == 1] = np.nan
+        corrs[:, :, i] = temp
+    return corrs
+
+def support_crosscorrs_reference(data, supports, bad_traces):
+    """ Shifts of maximum cross-correlation with each of the supports, computed shift by shift. """
+    depth = data.shape[-1]
+    divs = np.zeros((*data.shape[:2], len(supports)))
+    for i, (il, xl) in enumerate(supports):
+        padded = np.pad(data[il, xl], pad_width=(depth//2, depth - depth//2))
+        temp = np.zeros((*data.shape[:2], depth))
+        for k in range(depth):
+            temp[:, :, k] = np.sum(padded[k:k+depth] * data, axis=-1)
+        temp = np.argmax(temp, axis=-1).astype(float) - depth//2
+        temp[bad_traces == 1] = np.nan
+        divs[:, :, i] = temp
+    return divs
+
+
+def make_data(seed):
+    """ Random traces with some of them bad and some of them constant, including one of the supports. """
+    rng = np.random.default_rng(seed)
+    data = rng.normal(size=(13, 7, 20)).astype(np.float32)
+    bad_traces = (rng.random((13, 7)) < 0.2).astype(np.int32)
+
+    supports = np.stack([rng.integers(0, 13, size=6), rng.integers(0, 7, size=6)], axis=1)
+    data[supports[0, 0], supports[0, 1]] = 3.0
+    data[5, 5] = 0.0
+    return data, supports, bad_traces
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('function, reference', [
+    (_compute_support_corrs, support_corrs_reference),
+    (_compute_support_crosscorrs, support_crosscorrs_reference),
+])
+def test_support_metrics(seed, function, reference):
+    """ Tiled evaluation by matrix products must give the same values, including `nan`s for bad traces
+    and for supports with zero standard deviation.
+    """
+    data, supports, bad_traces = make_data(seed)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        result = function(data, supports, bad_traces, tile_size=4)
+        expected = reference(data.astype(np.float64), supports, bad_traces)
+
+    np.testing.assert_allclose(result, expected, rtol=1e-6, atol=1e-8)
+    assert np.isnan(result[bad_traces == 1]).all()